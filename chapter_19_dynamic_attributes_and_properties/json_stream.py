@@ -0,0 +1,179 @@
+# -*- coding:utf-8 -*-
+"""增量解析osconfeed.json，逐条产出Schedule中的记录
+
+load和load_db原来用json.loads(f.read())：整个文件先读成一个字符串，再解析成一棵完整的对象树，两份数据同时在内存中，
+而且要等全部解析完才能处理第一条记录。
+
+这里分三层，全部用纯Python实现：
+
+* tokens：每次从文件读chunk_size个字符，切分出JSON的词法单元。一个单元被切在两次读取之间时，
+把剩下的部分和下一块拼起来再试，缓冲区中只保留还没处理的部分。
+* parse_events：把词法单元变成事件流(start_map、map_key、end_map、start_array、end_array、string、number、boolean、null)，
+只做最基本的检查，假定输入是合法的JSON。
+* schedule_records：跟踪事件在文档中的路径，遇到Schedule.<collection>数组中的每个对象就把它组装成dict，
+产出(collection, record)。
+
+内存占用只与最大的一条记录和chunk_size有关，与文件大小无关，比内存还大的数据源也能逐条写进shelve。
+
+>>> import json
+>>> with open('data/osconfeed.json', 'r', encoding='utf-8') as f:
+...     collection, record = next(schedule_records(f))
+>>> collection, record
+('conferences', {'serial': 115})
+>>> with open('data/osconfeed.json', 'r', encoding='utf-8') as f:
+...     streamed = list(schedule_records(f, chunk_size=7))  # 很小的块，测试被切开的词法单元
+>>> with open('data/osconfeed.json', 'r', encoding='utf-8') as f:
+...     feed = json.loads(f.read())
+>>> streamed == [(c, r) for c, records in feed['Schedule'].items() for r in records]
+True
+>>> import io
+>>> list(parse_events(io.StringIO('{"a": [1, -2.5e3, true, null], "b\\\\u00e9": {}}')))[1:7]
+[('map_key', 'a'), ('start_array', None), ('number', 1), ('number', -2500.0), ('boolean', True), ('null', None)]
+>>> list(parse_events(io.StringIO('[12.5, 3e4, -0.25E-2, 7]'), chunk_size=1))[1:5]  # 数字被切在两块之间
+[('number', 12.5), ('number', 30000.0), ('number', -0.0025), ('number', 7)]
+>>> len({tuple(parse_events(io.StringIO('[12.5, 3e4, -0.25E-2, 7]'), chunk_size=n)) for n in (1, 2, 3, 4, 5, 64)})
+1
+"""
+import re
+from json.decoder import scanstring
+
+WHITESPACE = re.compile(r'[ \t\n\r]*')
+NUMBER = re.compile(r'-?(?:0|[1-9]\d*)(\.\d+)?([eE][-+]?\d+)?')
+NUMBER_CHARS = re.compile(r'[-+.eE0-9]*')
+LITERALS = {'t': ('true', True), 'f': ('false', False), 'n': ('null', None)}
+
+
+def tokens(f, chunk_size=65536):
+    """产出(kind, value)：kind是'{}[]:,'中的一个字符(value为None)，或者string、number、boolean、null"""
+    buf = ''
+    pos = 0
+    eof = False
+    while True:
+        pos = WHITESPACE.match(buf, pos).end()
+        incomplete = pos == len(buf)
+        if not incomplete:
+            c = buf[pos]
+            if c in '{}[]:,':
+                yield c, None
+                pos += 1
+                continue
+            elif c == '"':
+                try:
+                    value, end = scanstring(buf, pos + 1)
+                except ValueError:
+                    if eof:
+                        raise
+                    incomplete = True
+                else:
+                    yield 'string', value
+                    pos = end
+                    continue
+            elif c in '-0123456789':
+                # 数字没有结束符：'12'后面可能还有下一块里的'.5'或者'e4'，能组成数字的字符一直到缓冲区末尾就再读一块
+                end = NUMBER_CHARS.match(buf, pos).end()
+                if end < len(buf) or eof:
+                    m = NUMBER.fullmatch(buf, pos, end)
+                    if m is None:
+                        raise ValueError('invalid number at {!r}'.format(buf[pos:pos + 20]))
+                    yield 'number', float(m.group()) if m.group(1) or m.group(2) else int(m.group())
+                    pos = end
+                    continue
+                incomplete = True
+            elif c in LITERALS:
+                word, value = LITERALS[c]
+                if buf.startswith(word, pos):
+                    yield ('null' if value is None else 'boolean'), value
+                    pos += len(word)
+                    continue
+                if eof or len(buf) - pos >= len(word):
+                    raise ValueError('invalid literal at {!r}'.format(buf[pos:pos + 20]))
+                incomplete = True
+            else:
+                raise ValueError('unexpected character {!r}'.format(c))
+        if eof:
+            return
+        # 缓冲区用完了，或者最后一个词法单元还不完整：丢掉已经处理的部分，再读一块
+        more = f.read(chunk_size)
+        eof = not more
+        buf = buf[pos:] + more
+        pos = 0
+
+
+def parse_events(f, chunk_size=65536):
+    stack = []  # 外层的容器：'map'或者'array'
+    key_expected = False
+    for kind, value in tokens(f, chunk_size):
+        if kind == '{':
+            stack.append('map')
+            key_expected = True
+            yield 'start_map', None
+        elif kind == '[':
+            stack.append('array')
+            yield 'start_array', None
+        elif kind in '}]':
+            if not stack or stack.pop() != ('map' if kind == '}' else 'array'):
+                raise ValueError('unbalanced {!r}'.format(kind))
+            key_expected = False
+            yield ('end_map' if kind == '}' else 'end_array'), None
+        elif kind == ',':
+            key_expected = stack[-1] == 'map'
+        elif kind == ':':
+            pass
+        elif key_expected:
+            if kind != 'string':
+                raise ValueError('object keys must be strings, got {!r}'.format(value))
+            key_expected = False
+            yield 'map_key', value
+        else:
+            yield kind, value
+
+
+def build(start, events):
+    """start是刚读到的start_map或者start_array，从events中继续组装这个对象或数组，消耗到与之配对的结束事件为止"""
+    stack = [{} if start == 'start_map' else []]
+    keys = [None]
+    for event, value in events:
+        if event == 'map_key':
+            keys[-1] = value
+            continue
+        if event in ('end_map', 'end_array'):
+            done = stack.pop()
+            keys.pop()
+            if not stack:
+                return done
+            continue
+        if event == 'start_map':
+            value = {}
+        elif event == 'start_array':
+            value = []
+        if isinstance(stack[-1], dict):
+            stack[-1][keys[-1]] = value
+        else:
+            stack[-1].append(value)
+        if event in ('start_map', 'start_array'):
+            stack.append(value)
+            keys.append(None)
+    raise ValueError('unexpected end of JSON data')
+
+
+def schedule_records(f, chunk_size=65536):
+    """逐条产出(collection, record)，比如('speakers', {'serial': 157509, 'name': 'Robert Lefkowitz', ...})"""
+    events = parse_events(f, chunk_size)
+    path = []  # 当前位置：对象中是当前的键，数组中是'item'
+    for event, value in events:
+        if event == 'start_map' and len(path) == 3 and path[0] == 'Schedule' and path[2] == 'item':
+            yield path[1], build(event, events)
+        elif event == 'start_map':
+            path.append(None)
+        elif event == 'start_array':
+            path.append('item')
+        elif event == 'map_key':
+            path[-1] = value
+        elif event in ('end_map', 'end_array'):
+            path.pop()
+
+
+if __name__ == '__main__':
+    import doctest
+
+    doctest.testmod()
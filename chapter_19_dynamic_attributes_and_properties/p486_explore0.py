@@ -17,27 +17,104 @@ class FrozenJSON(object):
     357
     >>> fj.Schedule.speakers[0].name
     'Faisal Abid'
+
+    子节点只在第一次访问时包装，之后返回同一个对象：
+
+    >>> fj.Schedule is fj.Schedule
+    True
+    >>> fj.Schedule.speakers[0] is fj.Schedule.speakers[0]
+    True
+    >>> [event.serial for event in fj.Schedule.events[:2]]
+    [33451, 33457]
+
+    JSON数组不再是list，而是FrozenList(一个只读的abc.Sequence)。它与内容相同的list相等，但不能用+拼接，
+    也不能直接交给json.dumps，需要list时用list()转换：
+
+    >>> fj.Schedule.events[40].speakers
+    FrozenList(2 items)
+    >>> fj.Schedule.events[40].speakers == [3471, 5199]
+    True
+    >>> list(fj.Schedule.events[40].speakers) + [1]
+    [3471, 5199, 1]
     """
+    __slots__ = ('__data', '__children')
 
     def __init__(self, mapping):
         self.__data = dict(mapping)
+        self.__children = {}  # 键 -> 包装好的子节点
 
     def __getattr__(self, name):
+        try:
+            return self.__children[name]
+        except KeyError:
+            pass
         if hasattr(self.__data, name):  # 如果name是实例属性__name的属性，返回那个属性，如：调用keys等方法
             return getattr(self.__data, name)
-        else:  # 从self.__data中获取name键对应的元素
-            return FrozenJSON.build(self.__data[name])
+        else:  # 从self.__data中获取name键对应的元素，包装一次后缓存起来
+            child = self.__children[name] = FrozenJSON.build(self.__data[name])
+            return child
 
     @classmethod
     def build(cls, obj):
         if isinstance(obj, abc.Mapping):
             return cls(obj)
         elif isinstance(obj, abc.MutableSequence):
-            return [cls.build(i) for i in obj]
+            return FrozenList(obj, cls.build)
         else:
             return obj
 
 
+class FrozenList(abc.Sequence):
+    """JSON数组的只读视图：第i个元素在第一次被访问时才用build包装，之后直接返回包装好的对象
+
+    原来build把整个列表一次全部包装好，而且每次访问属性都重新包装一遍，fj.Schedule.speakers[0]要创建357个FrozenJSON。
+
+    >>> items = FrozenList([{'name': 'a'}, 1, [2, 3]], FrozenJSON.build)
+    >>> len(items), items[1], list(items[2])
+    (3, 1, [2, 3])
+    >>> items[0] is items[-3]
+    True
+    >>> [item.name for item in items[:1]]
+    ['a']
+    >>> items == [{'name': 'a'}, 1, [2, 3]], items == FrozenList([{'name': 'a'}, 1, [2, 3]], FrozenJSON.build)
+    (True, True)
+    >>> items != [1]
+    True
+    """
+    __slots__ = ('_items', '_build', '_wrapped')
+
+    _MISSING = object()
+
+    def __init__(self, items, build):
+        self._items = items
+        self._build = build
+        self._wrapped = [self._MISSING] * len(items)
+
+    def __len__(self):
+        return len(self._items)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        item = self._wrapped[index]
+        if item is self._MISSING:
+            item = self._wrapped[index] = self._build(self._items[index])
+        return item
+
+    def __eq__(self, other):
+        """与list比较的是包装前的数据，所以元素是dict时也能与原来的列表相等"""
+        if isinstance(other, FrozenList):
+            return self._items == other._items
+        if isinstance(other, list):
+            return self._items == other
+        return NotImplemented
+
+    __hash__ = None
+
+    def __repr__(self):
+        return 'FrozenList({} items)'.format(len(self))
+
+
 """FrozenJSON类有一个缺陷：没有对名称为Python关键字的属性做特殊处理。比如name键是：class时。
 1.使用keyword.iskeyword(s)判断是否是关键字；
 2.使用字符串的isidentifier()方法判断是否是有效的Python标识符。解决：{'2be': 'or not'}
@@ -2,6 +2,8 @@
 import json
 import warnings
 
+from json_stream import schedule_records
+
 """
 
 """
@@ -21,11 +23,11 @@ class Record:
 
 
 def load_db(db):
-    raw_data = load()  # <3>
+    """用json_stream逐条读取记录并写进db，不把整个数据源读进内存"""
     warnings.warn('loading ' + DB_NAME)
-    for collection, rec_list in raw_data['Schedule'].items():  # <4>
-        record_type = collection[:-1]  # <5>
-        for record in rec_list:
+    with open('data/osconfeed.json', 'r', encoding='utf-8') as f:
+        for collection, record in schedule_records(f):  # <4>
+            record_type = collection[:-1]  # <5>
             key = '{}.{}'.format(record_type, record['serial'])  # <6>
             record['serial'] = key  # <7>
             db[key] = Record(**record)  # <8>
@@ -1,8 +1,9 @@
 # -*- coding:utf-8 -*-
-import json
 import warnings
 import inspect
 
+from json_stream import schedule_records
+
 
 class Record:
     def __init__(self, **kwargs):
@@ -78,21 +79,25 @@ CONFERENCE = 'conference.115'
 
 
 def load_db(db):
+    """用json_stream逐条读取记录并写进db，不把整个数据源读进内存"""
+    warnings.warn('loading ' + DB_NAME)
+    factories = {}
     with open('data/osconfeed.json', 'r', encoding='utf-8') as f:
-        raw_data = json.loads(f.read())
-        warnings.warn('loading ' + DB_NAME)
-        for collection, rec_list in raw_data['Schedule'].items():
+        for collection, record in schedule_records(f):
             record_type = collection[:-1]
-            cls_name = record_type.capitalize()
-            cls = globals().get(cls_name, DBRecord)
-            if inspect.isclass(cls) and issubclass(cls, DBRecord):
-                factory = cls
-            else:
-                factory = DBRecord
-            for record in rec_list:
-                key = '{}.{}'.format(record_type, record['serial'])
-                record['serial'] = key
-                db[key] = factory(**record)
+            factory = factories.get(record_type)
+            if factory is None:
+                cls_name = record_type.capitalize()
+                cls = globals().get(cls_name, DBRecord)
+                if inspect.isclass(cls) and issubclass(cls, DBRecord):
+                    factory = cls
+                else:
+                    factory = DBRecord
+                factories[record_type] = factory
+            key = '{}.{}'.format(record_type, record['serial'])
+            record['serial'] = key
+            db[key] = factory(**record)
+
 
 if __name__ == '__main__':
     import shelve
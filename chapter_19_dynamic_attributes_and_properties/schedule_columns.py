@@ -0,0 +1,387 @@
+# -*- coding:utf-8 -*-
+"""把Schedule中的记录集合转换成按列存储的表
+
+统计Schedule.events或者Schedule.speakers时，原来要逐个遍历几千个dict或者Record，每条记录都是一个完整的对象。
+ColumnarTable把一个集合按字段拆成列：
+
+* IntColumn：整数(比如serial、venue_serial)存进array('q')，缺失值用MISSING表示。
+* StrColumn：字符串先放进这一列自己的字符串表，相同的字符串只保存一份，列中存的是array('q')类型的编号，缺失为-1。
+* ListColumn：列表(比如events的speakers、categories)拉平成一个IntColumn或者StrColumn，再用offsets记录每一行的起止位置。
+* ObjectColumn：类型混杂的字段退回普通的list，比如events的serial大多是整数，但也有'slot_40071'这样的字符串。
+
+列的类型由第一个非None的值决定，后面出现不符合的值时整列转换成ObjectColumn。
+
+查询返回掩码(mask)，可以用mask_and组合，再交给count、take、group_count。安装了NumPy时列通过np.frombuffer
+直接看作int64数组(不拷贝)，比较、计数和分组都是向量化的；没有NumPy时用array和纯Python循环，结果完全一样。
+一行只占每列8个字节，几百万行的数据源用json_stream逐条读进来，不需要先把整个JSON解析成对象树。
+
+>>> with open('data/osconfeed.json', 'r', encoding='utf-8') as f:
+...     tables = load_tables(f)
+>>> events, speakers = tables['events'], tables['speakers']
+>>> len(events), len(speakers)
+(494, 357)
+>>> events.column_type('venue_serial'), events.column_type('speakers'), events.column_type('serial')
+('int', 'list', 'object')
+>>> list(events.group_count('venue_serial').items())[:3]  # 每个场地的活动数
+[(1456, 23), (1458, 23), (1457, 22)]
+>>> list(events.group_count('speakers').items())[:3]  # 每个演讲者的活动数
+[(76338, 6), (3476, 5), (4710, 4)]
+>>> speakers.count(speakers.has('twitter'))  # 有twitter账号的演讲者
+262
+>>> tutorials = mask_and(events.eq('venue_serial', 1458), events.eq('event_type', 'tutorial'))
+>>> events.take('name', tutorials)[:2]
+['Playing Chess with Companies', 'Introduction to Ceph']
+>>> events.count(events.eq('speakers', 3471)), events.count(events.eq('event_type', 'no such type'))
+(1, 0)
+>>> python_only = from_records('events', events.rows(), use_numpy=False)
+>>> python_only.group_count('speakers', tutorials) == events.group_count('speakers', tutorials)
+True
+
+下面的查询覆盖了NumPy的各条路径(ListColumn的_list_rows，StrColumn的bincount，IntColumn的unique)，
+安装了NumPy时与纯Python的结果对比，没有NumPy时两边都是纯Python：
+
+>>> def queries(use_numpy):
+...     t = from_records('events', events.rows(), use_numpy)
+...     tutorials = mask_and(t.eq('venue_serial', 1458), t.eq('event_type', 'tutorial'))
+...     return (t.numpy, t.group_count('speakers'), t.group_count('speakers', tutorials),
+...             t.group_count('event_type', t.has('speakers')), t.group_count('venue_serial', t.eq('speakers', 3471)),
+...             t.count(t.has('categories')), t.take('name', tutorials), t.count(t.eq('speakers', 3471)))
+>>> vectorized, python_only = queries(np is not None), queries(False)
+>>> vectorized[0] == (np is not None), vectorized[1:] == python_only[1:]
+(True, True)
+"""
+import collections
+from array import array
+
+from json_stream import schedule_records
+
+try:
+    import numpy as np
+except ImportError:  # 没有NumPy时用array和纯Python循环
+    np = None
+
+MISSING = -2 ** 63  # IntColumn中的缺失值
+
+
+class IntColumn(object):
+    kind = 'int'
+    __slots__ = ('data',)
+
+    def __init__(self):
+        self.data = array('q')
+
+    def __len__(self):
+        return len(self.data)
+
+    @staticmethod
+    def accepts(value):
+        return value is None or (type(value) is int and MISSING < value < 2 ** 63)
+
+    def append(self, value):
+        self.data.append(MISSING if value is None else value)
+
+    def encode(self, value):
+        """value在data中的表示，不可能出现在这一列中时返回None"""
+        return value if type(value) is int and value != MISSING else None
+
+    def decode(self, raw):
+        return None if raw == MISSING else raw
+
+    def blank(self):
+        """缺失值以及空值(对字符串来说是'')的表示"""
+        return (MISSING,)
+
+
+class StrColumn(object):
+    kind = 'str'
+    __slots__ = ('data', 'strings', 'codes')
+
+    def __init__(self):
+        self.data = array('q')
+        self.strings = []  # 编号 -> 字符串
+        self.codes = {}  # 字符串 -> 编号
+
+    def __len__(self):
+        return len(self.data)
+
+    @staticmethod
+    def accepts(value):
+        return value is None or type(value) is str
+
+    def append(self, value):
+        if value is None:
+            self.data.append(-1)
+            return
+        code = self.codes.get(value)
+        if code is None:
+            code = self.codes[value] = len(self.strings)
+            self.strings.append(value)
+        self.data.append(code)
+
+    def encode(self, value):
+        return self.codes.get(value) if type(value) is str else None
+
+    def decode(self, raw):
+        return None if raw < 0 else self.strings[raw]
+
+    def blank(self):
+        empty = self.codes.get('')
+        return (-1,) if empty is None else (-1, empty)
+
+
+class ListColumn(object):
+    """第i行是values中[offsets[i], offsets[i + 1])这一段，values在第一个非空列表出现时才确定类型"""
+    kind = 'list'
+    __slots__ = ('offsets', 'values')
+
+    def __init__(self):
+        self.offsets = array('q', [0])
+        self.values = None
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def accepts(self, value):
+        if value is None:
+            return True
+        if type(value) is not list:
+            return False
+        if self.values is None:
+            return all(IntColumn.accepts(item) for item in value) or all(StrColumn.accepts(item) for item in value)
+        return all(self.values.accepts(item) for item in value)
+
+    def append(self, value):
+        if value:
+            if self.values is None:
+                self.values = IntColumn() if all(IntColumn.accepts(item) for item in value) else StrColumn()
+            for item in value:
+                self.values.append(item)
+        self.offsets.append(self.offsets[-1] + len(value or ()))
+
+    def __getitem__(self, i):
+        start, end = self.offsets[i], self.offsets[i + 1]
+        if start == end:
+            return []
+        return [self.values.decode(raw) for raw in self.values.data[start:end]]
+
+
+class ObjectColumn(object):
+    kind = 'object'
+    __slots__ = ('data',)
+
+    def __init__(self, values=()):
+        self.data = list(values)
+
+    def __len__(self):
+        return len(self.data)
+
+    @staticmethod
+    def accepts(value):
+        return True
+
+    def append(self, value):
+        self.data.append(value)
+
+
+def new_column(value):
+    """按第一个非None的值选择列的类型"""
+    for cls in (IntColumn, StrColumn):
+        if cls.accepts(value):
+            return cls()
+    if type(value) is list:
+        column = ListColumn()
+        if column.accepts(value):
+            return column
+    return ObjectColumn()
+
+
+def cell(column, i):
+    if isinstance(column, ListColumn):
+        return column[i]
+    if isinstance(column, ObjectColumn):
+        return column.data[i]
+    return column.decode(column.data[i])
+
+
+def mask_and(*masks):
+    if np is not None and all(isinstance(m, np.ndarray) for m in masks):
+        return np.logical_and.reduce(masks)
+    return bytearray(all(bits) for bits in zip(*masks))
+
+
+def ordered(counts):
+    """按出现次数从多到少排序，次数相同的按值排序，NumPy和纯Python两种实现的结果顺序一致"""
+    try:
+        items = sorted(counts.items())
+    except TypeError:  # 值的类型混杂，无法比较
+        items = list(counts.items())
+    items.sort(key=lambda item: -item[1])
+    return collections.OrderedDict(items)
+
+
+class ColumnarTable(object):
+    """一个记录集合(比如events)的按列存储。use_numpy为None时有NumPy就用，为True而没有安装NumPy时抛出ImportError"""
+
+    def __init__(self, name, use_numpy=None):
+        if use_numpy and np is None:
+            raise ImportError('ColumnarTable(use_numpy=True) needs NumPy, which is not installed')
+        self.name = name
+        self.numpy = np is not None if use_numpy is None else use_numpy
+        self.columns = collections.OrderedDict()
+        self.length = 0
+
+    def __len__(self):
+        return self.length
+
+    def __repr__(self):
+        return '<ColumnarTable {} rows={} columns={}>'.format(self.name, self.length, list(self.columns))
+
+    def append(self, record):
+        for field, column in self.columns.items():
+            value = record.get(field)
+            if not column.accepts(value):
+                column = self.columns[field] = ObjectColumn(cell(column, i) for i in range(self.length))
+            column.append(value)
+        for field, value in record.items():
+            if field not in self.columns and value is not None:
+                column = self.columns[field] = new_column(value)
+                for _ in range(self.length):  # 之前的记录中没有这个字段
+                    column.append(None)
+                column.append(value)
+        self.length += 1
+
+    def column_type(self, field):
+        return self.columns[field].kind
+
+    def rows(self):
+        """逐行还原成dict，缺失的字段为None"""
+        for i in range(self.length):
+            yield dict((field, cell(column, i)) for field, column in self.columns.items())
+
+    def raw(self, data):
+        """把array看作NumPy数组，不拷贝；结果不要长期保存，否则array无法再append"""
+        return np.frombuffer(data, dtype=np.int64) if self.numpy else data
+
+    def _list_rows(self, column):
+        """ListColumn中每个值所在的行号"""
+        offsets = np.frombuffer(column.offsets, dtype=np.int64)
+        return np.repeat(np.arange(self.length), np.diff(offsets))
+
+    def _mask(self, bits):
+        if self.numpy:
+            return np.fromiter(bits, dtype=bool, count=self.length)
+        return bytearray(bits)
+
+    def eq(self, field, value):
+        """field等于value的行；ListColumn是列表中包含value的行"""
+        column = self.columns[field]
+        if isinstance(column, ObjectColumn):
+            return self._mask(v == value for v in column.data)
+        if isinstance(column, ListColumn):
+            raw = column.values.encode(value) if column.values is not None else None
+            if raw is None:
+                return self._mask(False for _ in range(self.length))
+            if self.numpy:
+                mask = np.zeros(self.length, dtype=bool)
+                mask[self._list_rows(column)[self.raw(column.values.data) == raw]] = True
+                return mask
+            data, offsets = column.values.data, column.offsets
+            return bytearray(raw in data[offsets[i]:offsets[i + 1]] for i in range(self.length))
+        raw = column.encode(value)
+        if raw is None:
+            return self._mask(False for _ in range(self.length))
+        if self.numpy:
+            return self.raw(column.data) == raw
+        return bytearray(x == raw for x in column.data)
+
+    def has(self, field):
+        """field有值的行：不是None、不是空字符串、不是空列表"""
+        column = self.columns[field]
+        if isinstance(column, ObjectColumn):
+            return self._mask(v is not None and v != '' and v != [] for v in column.data)
+        if isinstance(column, ListColumn):
+            if self.numpy:
+                return np.diff(np.frombuffer(column.offsets, dtype=np.int64)) > 0
+            offsets = column.offsets
+            return bytearray(offsets[i + 1] > offsets[i] for i in range(self.length))
+        blank = column.blank()
+        if self.numpy:
+            return ~np.isin(self.raw(column.data), blank)
+        return bytearray(x not in blank for x in column.data)
+
+    def count(self, mask):
+        if self.numpy and isinstance(mask, np.ndarray):
+            return int(np.count_nonzero(mask))
+        return bytearray(mask).count(1)
+
+    def take(self, field, mask=None):
+        """mask选中的行中field的值"""
+        column = self.columns[field]
+        if mask is None:
+            return [cell(column, i) for i in range(self.length)]
+        if self.numpy and isinstance(mask, np.ndarray):
+            rows = np.flatnonzero(mask).tolist()
+        else:
+            rows = [i for i, bit in enumerate(mask) if bit]
+        return [cell(column, i) for i in rows]
+
+    def group_count(self, field, mask=None):
+        """field的每个值出现在多少行中(只统计mask选中的行)，按次数从多到少排序；ListColumn统计列表中的每一项"""
+        column = self.columns[field]
+        if isinstance(column, ObjectColumn):
+            counts = collections.Counter(self.take(field, mask))
+            counts.pop(None, None)
+            return ordered(counts)
+        if isinstance(column, ListColumn):
+            values = column.values
+            if values is None:
+                return collections.OrderedDict()
+        else:
+            values = column
+        if self.numpy:
+            data = self.raw(values.data)
+            if mask is not None:
+                if isinstance(column, ListColumn):
+                    mask = np.asarray(mask, dtype=bool)[self._list_rows(column)]
+                data = data[np.asarray(mask, dtype=bool)]
+            if isinstance(values, StrColumn):
+                bins = np.bincount(data[data >= 0], minlength=len(values.strings))
+                counts = dict((values.strings[code], int(n)) for code, n in enumerate(bins) if n)
+            else:
+                keys, bins = np.unique(data[data != MISSING], return_counts=True)
+                counts = dict((int(key), int(n)) for key, n in zip(keys, bins))
+            return ordered(counts)
+        if isinstance(column, ListColumn):
+            offsets = column.offsets
+            rows = range(self.length) if mask is None else [i for i, bit in enumerate(mask) if bit]
+            raws = (raw for i in rows for raw in values.data[offsets[i]:offsets[i + 1]])
+        elif mask is None:
+            raws = values.data
+        else:
+            raws = (raw for raw, bit in zip(values.data, mask) if bit)
+        counts = collections.Counter(raws)
+        return ordered(dict((values.decode(raw), n) for raw, n in counts.items() if values.decode(raw) is not None))
+
+
+def from_records(name, records, use_numpy=None):
+    table = ColumnarTable(name, use_numpy)
+    for record in records:
+        table.append(record)
+    return table
+
+
+def load_tables(f, use_numpy=None, chunk_size=65536):
+    """用json_stream逐条读取f中的记录，返回{集合名: ColumnarTable}"""
+    tables = {}
+    for collection, record in schedule_records(f, chunk_size):
+        table = tables.get(collection)
+        if table is None:
+            table = tables[collection] = ColumnarTable(collection, use_numpy)
+        table.append(record)
+    return tables
+
+
+if __name__ == '__main__':
+    import doctest
+
+    doctest.testmod()
@@ -51,13 +51,43 @@ error（EWOULDBLOCK）。进程在返回之后，可以干点别的事情，然
 recvform系统调用。这个过程通常被称之为轮询。轮询检查内核数据，直到数据准备好，再拷贝数据到进程，进行数据处理。需要
 注意，拷贝数据整个过程，进程仍然是属于阻塞的状态。
 
+### 非阻塞的connect
+原来的connect先阻塞地完成TCP三次握手再setblocking(0)，连接1000个服务器就要依次等待1000次握手。
+现在connect先setblocking(0)，再用connect_ex发起连接，内核返回EINPROGRESS后立即去连接下一个服务器。
+get_poetry把还在连接中的socket交给select的写集合：socket可写就说明握手结束了，再用getsockopt(SO_ERROR)
+判断连接是否成功。超过--connect-timeout还没有完成握手的连接被放弃。这样1000个连接只需要大约一次往返的时间。
+
+### 压缩传输
+使用--zlib时客户端连上后先发送一行`zlib\r\n`(服务器需要使用--compress)，服务器回复zlib压缩后的诗，
+ZlibReceiveBuffer在每次读到数据时增量解压，最后报告网络上实际收到的字节数。
+
+### 流式处理
+使用--output-dir时诗歌不再保存在内存中：每收到一块数据就交给p1_pipeline的管道，分行、解码后
+逐行写到output-dir/poem-N.txt，文件内容与服务器上的诗完全一样，内存占用与诗的大小无关，第一行诗收到就写出来了。最后打印管道每个阶段的计数。
+
+### 断点续传
+使用--resume N时(服务器需要使用--ranges)，每个请求都带上range=已经收到的字节数，RangeReceiver读掉服务器的range回复头
+并记录收到的字节数。连接失败、超时或者中途断开后最多重新连接N次，只下载还缺少的部分；服务器上的诗变了就放弃这个任务。
+
+### 指标
+使用--metrics-port/--metrics-file时导出每个任务收到的字节数、首字节时间、传输时间和各种错误(见p1_metrics.py)。
+一个任务是一个Transfer，续传时重新连接也算在同一个任务里，任务最终结束(完成或者放弃)时才结束计时。
+
 """
+import os
 import socket
 import select
 import errno
 import optparse
+import time
+import zlib
 from datetime import datetime
 
+from p1_buffer_pool import BufferPool, ReceiveBuffer, ZlibReceiveBuffer
+from p1_metrics import Metrics, add_metrics_options, start_exporters
+from p1_pipeline import StreamReceiver, format_stats, poem_pipeline
+from p1_request import RangeError, RangeReceiver
+
 
 def parse_args():
     usage = """usage: %prog [options] [hostname]:port ...
@@ -72,7 +102,17 @@ def parse_args():
     for that to work.
     """
     parser = optparse.OptionParser(usage)
-    _, address_list = parser.parse_args()
+    parser.add_option('--connect-timeout', type='float', default=10,
+                      help='Seconds to wait for each connection to be established. Default is 10.')
+    parser.add_option('--zlib', action='store_true', default=False,
+                      help='Ask servers started with --compress for zlib-compressed poems.')
+    parser.add_option('--output-dir',
+                      help='Stream every poem line by line into OUTPUT_DIR/poem-N.txt instead of keeping it in memory.')
+    parser.add_option('--resume', type='int', default=0, metavar='RETRIES',
+                      help='Reconnect up to RETRIES times after a broken download and fetch only the missing bytes '
+                           '(servers must run with --ranges). Default is 0.')
+    add_metrics_options(parser)
+    options, address_list = parser.parse_args()
     if not address_list:
         print(parser.format_help())
         parser.exit()
@@ -86,21 +126,127 @@ def parse_args():
         if not port.isdigit():
             parser.error('Ports must be integers.')
         return host, int(port)
-    return map(parse_address, address_list)  # map函数返回一个生成器
+    return options, map(parse_address, address_list)  # map函数返回一个生成器
+
+
+def receive_buffer(pool, compress):
+    return ZlibReceiveBuffer(pool) if compress else ReceiveBuffer(pool)
+
+
+def stream_receivers(output_dir, count, pool, compress):
+    """为每个下载任务创建一个StreamReceiver，第i个任务的诗写到output_dir/poem-i.txt"""
+    os.makedirs(output_dir, exist_ok=True)
+    return [StreamReceiver(poem_pipeline(os.path.join(output_dir, 'poem-{}.txt'.format(i)), compress), pool)
+            for i in range(1, count + 1)]
+
+
+def error_kind(e):
+    """接收数据时的异常对应的错误种类(p1_metrics中errors的kind)"""
+    if isinstance(e, zlib.error):
+        return 'zlib'
+    if isinstance(e, RangeError):
+        return 'range'
+    return 'lost'
+
 
+def get_poetry(sockets, pool=None, connect_timeout=None, compress=False, receivers=None, addresses=None, resume=0,
+               metrics=None, errors=None):
+    """receivers可以为每个socket指定接收数据的对象(比如StreamReceiver)，默认用ReceiveBuffer保存整首诗
 
-def get_poetry(sockets):
+    resume大于0时每个任务在连接失败或者中途断开后最多重新连接resume次，只下载还缺少的部分(服务器需要使用--ranges)。
+    addresses是每个socket连接的地址，没有给出时用连接成功后的getpeername()，这样连接失败的任务就无法重试了。
+    metrics是p1_metrics.Metrics，每个任务对应其中的一个Transfer。
+    errors是一个dict，失败的任务(连接失败、超时、连接被重置、数据损坏、续传不完整)在其中记下调用者传入的socket -> 错误种类，
+    这些任务返回的是已经收到的部分，不能当作完整的诗。
+    """
     sockets = list(sockets)
-    poems = dict.fromkeys(sockets, b'')
+    pool = pool or BufferPool()
+    receivers = receivers or [receive_buffer(pool, compress) for _ in sockets]
+    if resume:
+        receivers = [RangeReceiver(receiver) for receiver in receivers]
+    poems = dict(zip(sockets, receivers))
     sock2task = dict([(s, i) for i, s in enumerate(sockets, start=1)])
+    origins = dict(zip(sockets, sockets))  # 重新连接的socket -> 调用者传入的socket
+    peers = dict(zip(sockets, addresses)) if addresses is not None else {}
+    metrics = metrics or Metrics('p1_async_client', 'client')
+    transfers = dict((i, metrics.open()) for i in sock2task.values())
+    errors = {} if errors is None else errors
+
+    def fail(s, kind):
+        """记一次错误，任务算作失败；续传最终完成的任务在最后会从errors中去掉"""
+        transfers[sock2task[s]].error(kind)
+        errors[origins[s]] = kind
+    # 还在连接中的socket -> 连接的截止时间
+    deadline = time.monotonic() + connect_timeout if connect_timeout is not None else None
+    connecting = dict.fromkeys(sockets, deadline)
+    remaining = []
+
+    def reconnect(s):
+        """s已经关闭，需要并且可以续传时连接同一个服务器，新的socket接替s；不再重新连接时任务结束"""
+        receiver = poems[s]
+        transfer = transfers[sock2task[s]]
+        if not resume or s not in peers or not receiver.can_resume(resume):
+            transfer.close()
+            return
+        try:
+            new = connect(peers[s])
+        except socket.error as e:
+            print('Task {}: failed to reconnect: {}'.format(sock2task[s], e))
+            fail(s, 'connect')
+            transfer.close()
+            return
+        for d in (poems, sock2task, origins, peers):
+            d[new] = d.pop(s)
+        connecting[new] = time.monotonic() + connect_timeout if connect_timeout is not None else None
+        print('Task {}: resuming from byte {} (retry {})'.format(sock2task[new], receiver.received, receiver.retries))
+
+    while connecting or remaining:
+        timeout = None
+        if connect_timeout is not None and connecting:
+            timeout = max(0, min(connecting.values()) - time.monotonic())
+        rlist, wlist, _ = select.select(remaining, list(connecting), [], timeout)
+        for s in wlist:
+            del connecting[s]
+            err = s.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if err:
+                print('Task {}: failed to connect: {}'.format(sock2task[s], os.strerror(err)))
+                fail(s, 'connect')
+                s.close()
+                reconnect(s)
+            else:
+                # 刚建立的连接发送缓冲区是空的，一行请求一定能发出去
+                if resume:
+                    peers.setdefault(s, s.getpeername())
+                    s.send(poems[s].request(compress=compress))
+                elif compress:
+                    s.send(b'zlib\r\n')
+                remaining.append(s)
+        if connect_timeout is not None:
+            now = time.monotonic()
+            for s in [s for s, d in connecting.items() if d <= now]:
+                del connecting[s]
+                print('Task {}: connection timed out'.format(sock2task[s]))
+                fail(s, 'timeout')
+                s.close()
+                reconnect(s)
 
-    while sockets:
-        rlist, _, _ = select.select(sockets, [], [])
         for s in rlist:
-            data = b''
+            received = 0
+            done = False  # 连接已经结束(关闭或者出错)；只读到range回复头时received为0但连接还在
+            transfer = transfers[sock2task[s]]
             while True:
                 try:
-                    buff = s.recv(1024)
+                    n = poems[s].recv_into(s)
+                except zlib.error as e:
+                    print('Task {}: corrupt compressed poetry: {}'.format(sock2task[s], e))
+                    fail(s, error_kind(e))
+                    done = True
+                    break
+                except RangeError as e:
+                    print('Task {}: cannot resume: {}'.format(sock2task[s], e))
+                    fail(s, error_kind(e))
+                    done = True
+                    break
                 except socket.error as e:
                     if e.args[0] == errno.EWOULDBLOCK:
                         # this error code means we would have
@@ -108,22 +254,35 @@ def get_poetry(sockets):
                         # instead we skip to the next socket
                         # 这个错误代码表示如果套接字阻塞我们将阻塞，相反，我们跳到下一个套接字
                         break
-                    raise
+                    # 连接被重置等错误只影响这一个任务
+                    print('Task {}: lost connection: {}'.format(sock2task[s], e))
+                    fail(s, error_kind(e))
+                    done = True
+                    break
                 else:
-                    if not buff:
+                    if not n:
+                        done = True
                         break
                     else:
-                        data += buff
+                        received += n
+                        transfer.data(n)
 
-            if not data:
-                sockets.remove(s)
+            if done:
+                remaining.remove(s)
                 s.close()
-            else:
+                reconnect(s)
+            elif received:
                 addr_fmt = format_address(s.getpeername())
-                msg = 'Task {}: got {} bytes of poetry from {}'.format(sock2task[s], len(data), addr_fmt)
+                msg = 'Task {}: got {} bytes of poetry from {}'.format(sock2task[s], received, addr_fmt)
                 print(msg)
-            poems[s] += data
-    return poems
+    for s, receiver in poems.items():
+        if resume and not receiver.complete:
+            print('Task {}: incomplete, got {} of {} bytes'.format(
+                sock2task[s], receiver.received, '?' if receiver.total is None else receiver.total))
+            fail(s, 'incomplete')
+        elif resume:
+            errors.pop(origins[s], None)  # 中途出过错，但续传完成了
+    return dict((origins[s], buf.detach()) for s, buf in poems.items())  # bytes，arena都还给池子
 
 
 def format_address(address):
@@ -132,22 +291,54 @@ def format_address(address):
 
 
 def connect(address):
+    """发起非阻塞的连接并立即返回，连接是否成功由get_poetry判断"""
     sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    sock.connect(address)
     sock.setblocking(0)
+    err = sock.connect_ex(address)
+    if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+        sock.close()
+        raise socket.error(err, os.strerror(err))
     return sock
 
 
+def format_failure(kind):
+    return '' if kind is None else ' (failed: {})'.format(kind)
+
+
+def format_failures(errors):
+    return ', {} failed'.format(len(errors)) if errors else ''
+
+
+def format_compression(poetry_bytes, wire_bytes):
+    ratio = 100.0 * wire_bytes / poetry_bytes if poetry_bytes else 0
+    return '{} bytes of poetry in {} bytes on the wire ({:.1f}%)'.format(poetry_bytes, wire_bytes, ratio)
+
+
 def main():
-    address_list = parse_args()
+    options, address_list = parse_args()
+    address_list = list(address_list)
+    metrics = start_exporters(options, Metrics('p1_async_client', 'client'))
     start = datetime.now()
-    sockets = map(connect, address_list)
-    poems = get_poetry(sockets)
+    sockets = list(map(connect, address_list))
+    pool = BufferPool()
+    receivers = None
+    if options.output_dir:
+        receivers = stream_receivers(options.output_dir, len(sockets), pool, options.zlib)
+    errors = {}
+    poems = get_poetry(sockets, pool, options.connect_timeout, options.zlib, receivers,
+                       address_list, options.resume, metrics, errors)
     elapsed = datetime.now() - start
     for i, sock in enumerate(sockets, start=1):
-        print('Task {}:{} bytes of poetry'.format(i, len(poems[sock])))
-
-    print('Got {} poems in {}'.format(len(list(address_list)), elapsed))
+        print('Task {}:{} bytes of poetry'.format(i, len(poems[sock])) + format_failure(errors.get(sock)))
+
+    print('Got {} poems in {}'.format(len(address_list) - len(errors), elapsed) + format_failures(errors))
+    print(pool.report())
+    if receivers:
+        for receiver in receivers:
+            receiver.release()  # 没连上的任务也要关闭管道和文件
+        print(format_stats(r.pipeline for r in receivers))
+    elif options.zlib:
+        print(format_compression(sum(len(poem) for poem in poems.values()), pool.bytes_received))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,164 @@
+# -*- coding:utf-8 -*-
+"""asyncio版的Get Poetry Now!客户端
+
+与p1_async_client.py一样是单线程的异步客户端，只不过事件循环由asyncio提供，每个下载任务写成一个协程：
+
+1.asyncio.open_connection返回(StreamReader, StreamWriter)，await reader.read()在没有数据时把控制权交还给事件循环。
+
+2.所有任务一开始就创建，但每个任务要先拿到asyncio.Semaphore才会建立连接，同时打开的连接数不超过--concurrency，
+因此即使给出上万个地址，也不会一下子发起上万个连接。
+
+3.连接和每次读取都用asyncio.wait_for加上--timeout超时，慢的或者不响应的服务器不会永远占着一个名额。
+
+4.使用--output-dir时与p1_async_client.py一样，每次读到的数据直接送进p1_pipeline的管道写到output-dir/poem-N.txt，
+不在内存中保存诗歌。
+
+`python p1_asyncio_client.py --concurrency 100 8000 8001 8002`
+"""
+import asyncio
+import optparse
+import os
+import time
+
+from p1_pipeline import format_stats, poem_pipeline
+
+
+def parse_args():
+    usage = """usage: %prog [options] [hostname]:port ...
+    This is the Get Poetry Now! client, asyncio edition.
+    Run it like this:
+      python get-poetry.py port1 port2 port3 ...
+    to grab poetry from servers on ports port1, port2 and port3,
+    with at most --concurrency connections open at the same time.
+    """
+    parser = optparse.OptionParser(usage)
+    parser.add_option('-c', '--concurrency', type='int', default=100,
+                      help='The maximum number of open connections. Default is 100.')
+    parser.add_option('-t', '--timeout', type='float', default=10,
+                      help='Seconds to wait for a connection or for the next chunk. Default is 10.')
+    parser.add_option('--output-dir',
+                      help='Stream every poem line by line into OUTPUT_DIR/poem-N.txt instead of keeping it in memory.')
+    options, address_list = parser.parse_args()
+    if not address_list:
+        print(parser.format_help())
+        parser.exit()
+
+    def parse_address(addr):
+        if ':' not in addr:
+            host = '127.0.0.1'
+            port = addr
+        else:
+            host, port = addr.split(':', 1)
+        if not port.isdigit():
+            parser.error('Ports must be integers.')
+        return host, int(port)
+
+    return options, list(map(parse_address, address_list))
+
+
+def format_address(address):
+    host, port = address
+    return '{}:{}'.format(host or '127.0.0.1', port)
+
+
+class TaskResult(object):
+
+    def __init__(self, task_num, address):
+        self.task_num = task_num
+        self.address = address
+        self.poem = b''
+        self.size = 0  # 收到的字节数，流式处理时poem是空的
+        self.error = None
+        self.ttfb = None  # time to first byte，从开始连接算起
+        self.latency = None
+
+    @property
+    def throughput(self):
+        if not self.latency:
+            return 0.0
+        return self.size / self.latency
+
+
+async def get_poetry(task_num, address, semaphore, timeout, pipeline=None):
+    """pipeline是p1_pipeline.Pipeline时收到的数据送进管道而不保存"""
+    result = TaskResult(task_num, address)
+    async with semaphore:
+        start = time.perf_counter()
+        try:
+            reader, writer = await asyncio.wait_for(asyncio.open_connection(*address), timeout)
+        except (OSError, asyncio.TimeoutError) as e:
+            result.error = e
+            return result
+        chunks = []
+        try:
+            while True:
+                data = await asyncio.wait_for(reader.read(65536), timeout)
+                if not data:
+                    break
+                if result.ttfb is None:
+                    result.ttfb = time.perf_counter() - start
+                result.size += len(data)
+                if pipeline is not None:
+                    pipeline.send(data)
+                else:
+                    chunks.append(data)
+        except (OSError, asyncio.TimeoutError) as e:
+            result.error = e
+        finally:
+            writer.close()
+        result.latency = time.perf_counter() - start
+        result.poem = b''.join(chunks)
+    return result
+
+
+async def get_poetry_all(address_list, concurrency, timeout, pipelines=None):
+    semaphore = asyncio.Semaphore(concurrency)
+    pipelines = pipelines or [None] * len(address_list)
+    tasks = [get_poetry(i, address, semaphore, timeout, pipeline)
+             for i, (address, pipeline) in enumerate(zip(address_list, pipelines), start=1)]
+    return await asyncio.gather(*tasks)
+
+
+def format_ms(seconds):
+    return '-' if seconds is None else '{:.1f}ms'.format(seconds * 1000)
+
+
+def main():
+    options, address_list = parse_args()
+    start = time.perf_counter()
+    pipelines = None
+    if options.output_dir:
+        os.makedirs(options.output_dir, exist_ok=True)
+        pipelines = [poem_pipeline(os.path.join(options.output_dir, 'poem-{}.txt'.format(i)))
+                     for i in range(1, len(address_list) + 1)]
+    results = asyncio.run(get_poetry_all(address_list, options.concurrency, options.timeout, pipelines))
+    elapsed = time.perf_counter() - start
+    if pipelines:
+        for pipeline in pipelines:
+            pipeline.close()
+
+    verbose = len(results) <= 100
+    for r in results:
+        if r.error is not None:
+            print('Task {}: failed to get poetry from {}: {!r}'.format(r.task_num, format_address(r.address), r.error))
+        elif verbose:
+            msg = 'Task {}: {} bytes of poetry from {}, first byte {}, total {}, {:.1f} KB/s'
+            print(msg.format(r.task_num, r.size, format_address(r.address),
+                             format_ms(r.ttfb), format_ms(r.latency), r.throughput / 1024))
+
+    done = [r for r in results if r.error is None]
+    total_bytes = sum(r.size for r in done)
+    print('Got {} poems ({} failed) in {:.3f}s, {:.1f} KB/s'.format(
+        len(done), len(results) - len(done), elapsed, total_bytes / 1024 / elapsed))
+    ttfbs = sorted(r.ttfb for r in done if r.ttfb is not None)
+    latencies = sorted(r.latency for r in done)
+    if latencies:
+        print('First byte: median {}, max {}; total: median {}, max {}'.format(
+            format_ms(ttfbs[len(ttfbs) // 2] if ttfbs else None), format_ms(ttfbs[-1] if ttfbs else None),
+            format_ms(latencies[len(latencies) // 2]), format_ms(latencies[-1])))
+    if pipelines:
+        print(format_stats(pipelines))
+
+
+if __name__ == '__main__':
+    main()
@@ -9,12 +9,19 @@ poetry [ˈpəʊətri] n.诗，诗歌;诗意，诗情;作诗;诗歌艺术
 `E:\workbench\fluent-python-examples\twisted_learn>python p1_blocking_client.py 8000 8001 8002`
 由于这个客户端采用的是阻塞模式，因此它会一首一首的下载，即只有在完成一首时才会开始下载另外一首
 
+使用--output-dir时与p1_async_client.py一样，收到的数据直接流过p1_pipeline的管道写到output-dir/poem-N.txt，
+不在内存中保存诗歌。
+
 """
 import socket
 import optparse
 from datetime import timedelta
 from datetime import datetime
 
+from p1_async_client import stream_receivers
+from p1_buffer_pool import BufferPool, ReceiveBuffer
+from p1_pipeline import format_stats
+
 
 def parse_args():
     usage = """usage: %prog [options] [hostname]:port ...
@@ -29,7 +36,9 @@ def parse_args():
     for that to work.
     """
     parser = optparse.OptionParser(usage)
-    _, address_list = parser.parse_args()
+    parser.add_option('--output-dir',
+                      help='Stream every poem line by line into OUTPUT_DIR/poem-N.txt instead of keeping it in memory.')
+    options, address_list = parser.parse_args()
     if not address_list:
         print(parser.format_help())
         parser.exit()
@@ -44,20 +53,20 @@ def parse_args():
             parser.error('Ports must be integers.')
         return host, int(port)
 
-    return map(parse_address, address_list)
+    return options, list(map(parse_address, address_list))
 
 
-def get_poetry(address):
+def get_poetry(address, pool=None, receiver=None):
+    """receiver可以是p1_pipeline.StreamReceiver，这时诗歌流过管道而不保存，返回b''"""
     sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     sock.connect(address)
-    poem = b''
-    while True:
-        buff = sock.recv(1024)
-        if not buff:
-            sock.close()
-            break
-        poem += buff
-    return poem
+    poem = receiver if receiver is not None else ReceiveBuffer(pool or BufferPool())
+    try:
+        while poem.recv_into(sock):
+            pass
+    finally:
+        sock.close()
+    return poem.detach()  # 返回bytes，arena还给池子给下一首诗用
 
 
 def format_address(address):
@@ -66,19 +75,36 @@ def format_address(address):
 
 
 def main():
-    address_list = parse_args()
+    options, address_list = parse_args()
     total_elapsed = timedelta()
-    for i, address in enumerate(address_list, start=1):
+    pool = BufferPool()
+    receivers = [None] * len(address_list)
+    if options.output_dir:
+        receivers = stream_receivers(options.output_dir, len(address_list), pool, False)
+    failed = 0
+    for i, (address, receiver) in enumerate(zip(address_list, receivers), start=1):
         addr_fmt = format_address(address)
         print('Task {}: got poetry from:{}'.format(i, addr_fmt))
         start = datetime.now()
-        poem = get_poetry(address)
+        try:
+            poem = get_poetry(address, pool, receiver)
+        except socket.error as e:
+            # 连接失败或者被重置只影响这一首诗，收到的部分不算
+            total_elapsed += datetime.now() - start
+            failed += 1
+            print('Task {}: failed to get poetry from {}: {}'.format(i, addr_fmt, e))
+            continue
         elapsed = datetime.now() - start
-        msg = 'Task {}: got {} bytes of poetry from {} in {}'.format(i, len(poem), addr_fmt, elapsed)
+        size = len(receiver) if receiver is not None else len(poem)
+        msg = 'Task {}: got {} bytes of poetry from {} in {}'.format(i, size, addr_fmt, elapsed)
         print(msg)
         total_elapsed += elapsed
-    print('Got {} poems in {}'.format(i, total_elapsed))
-
+    print('Got {} poems in {}'.format(i - failed, total_elapsed) + (', {} failed'.format(failed) if failed else ''))
+    print(pool.report())
+    if options.output_dir:
+        for receiver in receivers:
+            receiver.release()
+        print(format_stats(r.pipeline for r in receivers))
 
 
 if __name__ == '__main__':
@@ -19,13 +19,65 @@ socket.sendall(string[, flags])
 
 # TODO 无法接收客户端发送的数据
 
-# TODO 服务器在服务一个客户端时其它连接进来的客户端只能处于等待状态而得不到服务
+服务器在服务一个客户端时其它连接进来的客户端只能处于等待状态而得不到服务。使用--workers N可以同时服务N个客户端：
+
+* --mode thread：主线程负责accept，把连接放进容量为--queue-size的有界队列，N个工作线程从队列中取出连接发送诗歌。
+队列满时主线程停止accept，新连接就留在内核中长度为--backlog的监听队列里。
+
+* --mode process：预先fork出N个工作进程，每个进程都在同一个监听socket上阻塞地accept，由内核把连接分给空闲的进程，
+此时有界队列就是内核的监听队列(--backlog)。
+
+`python p1_blocking_server.py --workers 8 --mode thread poetry/ecstasy.txt`
+
+send_poetry每次把buffer_size字节从文件读进Python，再用sendall写回内核，数据在内核与用户空间之间来回拷贝了两次。
+使用--sendfile时由socket.sendfile(底层是os.sendfile)让内核直接把页缓存中的文件内容发到socket上，
+数据不经过用户空间；平台不支持sendfile时socket.sendfile会自动退回到read+send的方式。
+
+使用--compress时服务器在发送前先读客户端发来的一行请求：`zlib\r\n`表示客户端要zlib压缩后的诗，
+其它内容(比如一个空行)表示不压缩。压缩是客户端选择的：--request-window秒(默认0.2)内没有收到请求行就当作普通客户端，
+直接发送未压缩的诗，原来的客户端不需要任何改动。代价是每个不发请求行的客户端都要先等这一段时间，
+请求行来得太晚的zlib客户端会收到未压缩的诗；所有客户端都发送请求行时使用--require-request，
+服务器一直等到请求行(最多REQUEST_TIMEOUT秒，不发请求的连接被关闭)，不再退回到未压缩的诗。压缩后的副本由CompressedPoem保存，只在文件的mtime、大小或inode变化时重新压缩一次，
+每个请求只多一次os.stat。文本的压缩率很高，慢速网络上诗歌能传得快很多。
+
+使用--ranges时服务器同样先读一行请求，请求中的range=START[:LENGTH]表示只发送这一段(格式见p1_request.py)，
+正文之前先回复一行`range START LENGTH TOTAL VERSION`。连接中途断开的客户端重新连接后只需要下载缺少的部分。
+两个选项都会让服务器读请求行，请求行中的zlib和range可以同时使用。
+
+使用--metrics-port/--metrics-file时导出每个连接发出的字节数、首字节时间、传输时间和发送错误(见p1_metrics.py)。
+MeasuredSocket包装客户端socket，统计sendall和sendfile交给内核的字节数(包括range回复头)，close时结束这个连接的计时。
+--mode process时每个工作进程单独导出，第i个进程使用端口--metrics-port加i。
+
+send_poetry每个buffer_size字节的块调用一次sendall，range回复头也单独sendall一次，一首诗要几百上千次系统调用。
+使用--sendmsg N时改用scatter_gather：一次读出N块，连同还没发送的回复头一起交给一次socket.sendmsg(即writev)，
+内核把这些分散的缓冲区依次拷进发送缓冲区，系统调用次数大约变成原来的1/N。有--delay时每批之后按这一批中正文的块数
+sleep(回复头不算一块)，平均速率不变，只是节奏变粗了。
+
+--tcp选择连接上的TCP选项：
+* nodelay：设置TCP_NODELAY，关掉Nagle算法，小块数据立即发出，延迟低但会产生很多小包。
+* cork：设置TCP_CORK(只有Linux有)，内核攒满一个MSS才发包，回复头和正文合在同一个包里；关闭socket时剩下的数据会被发出。
+
+使用--report时每个连接结束时打印发送的字节数、send类调用(sendall/sendmsg/sendfile)的次数和吞吐量，用来比较这些选项：
+
+    python p1_blocking_server.py -d 0 -b 4096 --report big.txt             # Sent 3239682 bytes in 791 send calls ...
+    python p1_blocking_server.py -d 0 -b 4096 --report --sendmsg 16 big.txt  # Sent 3239682 bytes in 50 send calls ...
+
+一次sendall在内核缓冲区满时可能对应多次send系统调用，这里统计的是Python层面的调用次数。
 """
+import collections
+import itertools
 import os
+import queue
 import socket
+import threading
 import time
+import traceback
 import optparse
 import signal
+import zlib
+
+from p1_metrics import Metrics, add_metrics_options, start_exporters
+from p1_request import clamp_range, format_range_header, parse_request, version_of
 
 
 def do_exit(signum, frame):
@@ -62,17 +114,78 @@ def parse_args():
                       type='int',
                       help='The number of bytes to send at a time.',
                       default=100)
+    parser.add_option('--sendfile',
+                      action='store_true',
+                      help='Send the poem with sendfile() instead of reading it into Python.',
+                      default=False)
+    parser.add_option('-w', '--workers',
+                      type='int',
+                      help='The number of clients served concurrently. Default is 1.',
+                      default=1)
+    parser.add_option('-m', '--mode',
+                      type='choice',
+                      choices=['thread', 'process'],
+                      help='Serve clients with a thread pool or pre-forked processes. Default is thread.',
+                      default='thread')
+    parser.add_option('--queue-size',
+                      type='int',
+                      help='Accepted connections waiting for a worker thread. Default is 2 * workers.')
+    parser.add_option('--backlog',
+                      type='int',
+                      help='The listen() backlog. Default is 5.',
+                      default=5)
+    parser.add_option('--compress',
+                      action='store_true',
+                      help='Read a request line first and send a precompressed copy to clients asking for zlib.',
+                      default=False)
+    parser.add_option('--ranges',
+                      action='store_true',
+                      help='Read a request line first and honour range=START[:LENGTH] so clients can resume.',
+                      default=False)
+    parser.add_option('--request-window',
+                      type='float',
+                      help='Seconds --compress/--ranges wait for a request line before sending the plain poem. '
+                           'Default is 0.2.',
+                      default=0.2)
+    parser.add_option('--require-request',
+                      action='store_true',
+                      help='Make --compress/--ranges wait for every request line instead of falling back to the '
+                           'plain poem after --request-window; clients that send none are dropped.',
+                      default=False)
+    parser.add_option('--sendmsg',
+                      type='int', metavar='CHUNKS',
+                      help='Coalesce CHUNKS buffer-size chunks and the range header into one sendmsg() call. '
+                           'Default is 0 (one sendall() per chunk).',
+                      default=0)
+    parser.add_option('--report',
+                      action='store_true',
+                      help='Print bytes, send calls and throughput for every connection.',
+                      default=False)
+    parser.add_option('--tcp',
+                      type='choice',
+                      choices=['default', 'nodelay', 'cork'],
+                      help='Set TCP_NODELAY or TCP_CORK on client connections. Default is default.',
+                      default='default')
+    add_metrics_options(parser)
 
     options, args = parser.parse_args()
     if len(args) != 1:
         parser.error('Provide exactly one poetry file.')
+    if options.workers < 1:
+        parser.error('--workers must be at least 1.')
+    if options.sendmsg and options.sendfile:
+        parser.error('--sendmsg and --sendfile are mutually exclusive.')
+    if options.sendmsg and not hasattr(socket.socket, 'sendmsg'):
+        parser.error('sendmsg() is not available on this platform.')
+    if options.tcp == 'cork' and not hasattr(socket, 'TCP_CORK'):
+        parser.error('TCP_CORK is only available on Linux.')
     poetry_file = args[0]
     if not os.path.exists(poetry_file):
         parser.error('No such file:{}'.format(poetry_file))
     return options, poetry_file
 
 
-def send_poetry(client_socket, poetry_file, buffer_size, delay):
+def send_poetry(client_socket, poetry_file, buffer_size, delay, offset=0, length=None, header=b''):
     # receive_buffer = []
     # while True:
     #     data = client_socket.recv(buffer_size)
@@ -82,9 +195,15 @@ def send_poetry(client_socket, poetry_file, buffer_size, delay):
     # print('Got data from client:{}'.format(b''.join(receive_buffer)))
 
     f = open(poetry_file, 'rb')
+    f.seek(offset)
+    remaining = float('inf') if length is None else length
+    if header and not send_range_header(client_socket, header):
+        f.close()
+        return
     while True:
         # 每次服务器都会发送过一行的内容过来。一旦诗歌传送完毕，服务器就会关闭这条连接
-        buff = f.read(buffer_size)
+        buff = f.read(min(buffer_size, remaining))
+        remaining -= len(buff)
         if not buff:
             client_socket.close()
             f.close()
@@ -98,11 +217,297 @@ def send_poetry(client_socket, poetry_file, buffer_size, delay):
         time.sleep(delay)
 
 
-def serve(listen_socket, poetry_file, buffer_size, delay):
+def sendfile_poetry(client_socket, poetry_file, buffer_size, delay, offset=0, length=None, header=b''):
+    f = open(poetry_file, 'rb')
+    try:
+        if header:
+            client_socket.sendall(header)
+        if not delay:
+            client_socket.sendfile(f, offset, length)
+            return
+        end = float('inf') if length is None else offset + length
+        while offset < end:
+            sent = client_socket.sendfile(f, offset, min(buffer_size, end - offset))
+            if not sent:
+                return
+            offset += sent
+            time.sleep(delay)
+    except socket.error:
+        return
+    finally:
+        client_socket.close()
+        f.close()
+
+
+IOV_MAX = 1024  # 一次sendmsg最多的缓冲区个数，Linux上是1024
+
+
+def send_buffers(client_socket, buffers):
+    """用尽量少的sendmsg把buffers全部发出去，返回调用次数；发送缓冲区满时sendmsg只发出一部分，剩下的接着发"""
+    views = collections.deque(memoryview(b) for b in buffers if len(b))
+    calls = 0
+    while views:
+        sent = client_socket.sendmsg(list(itertools.islice(views, IOV_MAX)))
+        calls += 1
+        while sent:
+            if sent >= len(views[0]):
+                sent -= len(views.popleft())
+            else:
+                views[0] = views[0][sent:]
+                sent = 0
+    return calls
+
+
+def scatter_gather(batch):
+    """返回一个与send_poetry接口相同的函数：每次读出batch块，与回复头一起用一次sendmsg发送"""
+    def send_batched(client_socket, poetry_file, buffer_size, delay, offset=0, length=None, header=b''):
+        f = open(poetry_file, 'rb')
+        f.seek(offset)
+        remaining = float('inf') if length is None else length
+        pending = [header] if header else []
+        chunks = 0  # pending中正文的块数，回复头不算，所以有没有range回复的节奏一样
+        try:
+            while True:
+                while chunks < batch and remaining > 0:
+                    buff = f.read(min(buffer_size, remaining))
+                    if not buff:
+                        remaining = 0
+                        break
+                    remaining -= len(buff)
+                    pending.append(buff)
+                    chunks += 1
+                if not pending:
+                    return
+                send_buffers(client_socket, pending)
+                pending = []
+                time.sleep(delay * chunks)
+                chunks = 0
+        except socket.error:
+            return
+        finally:
+            client_socket.close()
+            f.close()
+    return send_batched
+
+
+def set_tcp_mode(send, mode):
+    """包装send，发送前在客户端socket上设置TCP_NODELAY或者TCP_CORK"""
+    option = {'nodelay': socket.TCP_NODELAY, 'cork': getattr(socket, 'TCP_CORK', None)}[mode]
+
+    def send_tuned(client_socket, poetry_file, buffer_size, delay):
+        try:
+            client_socket.setsockopt(socket.IPPROTO_TCP, option, 1)
+        except socket.error:
+            pass  # 连接已经断开了，交给send处理
+        send(client_socket, poetry_file, buffer_size, delay)
+    return send_tuned
+
+
+class CompressedPoem(object):
+    """诗歌文件的zlib压缩副本，文件变化时重新压缩；多个工作线程共用一个实例"""
+
+    def __init__(self, path, level=9):
+        self.path = path
+        self.level = level
+        self.signature = None
+        self.data = b''
+        self.version = None
+        self.lock = threading.Lock()
+
+    def get(self):
+        """返回(压缩后的数据, 版本标记)"""
+        st = os.stat(self.path)
+        signature = (st.st_mtime_ns, st.st_size, st.st_ino)
+        with self.lock:
+            if signature != self.signature:
+                with open(self.path, 'rb') as f:
+                    self.data = zlib.compress(f.read(), self.level)
+                self.signature = signature
+                self.version = 'z' + version_of(st)
+            return self.data, self.version
+
+
+REQUEST_TIMEOUT = 5  # --require-request时最多等待请求行的秒数
+
+
+def read_request(client_socket, timeout=0.2, max_length=1024, required=False):
+    """读客户端发来的一行请求，返回去掉首尾空白的bytes；timeout秒内没有收到一整行时返回b''(当作没有选项的请求)，
+    required为True时和连接断开一样返回None"""
+    client_socket.settimeout(timeout)
+    request = b''
+    try:
+        while b'\n' not in request and len(request) < max_length:
+            data = client_socket.recv(max_length)
+            if not data:
+                return None
+            request += data
+    except socket.timeout:
+        return None if required else b''  # 不发请求的客户端
+    except socket.error:
+        return None
+    finally:
+        client_socket.settimeout(None)
+    return request.split(b'\n', 1)[0].strip()
+
+
+def send_compressed(client_socket, data, buffer_size, delay):
+    view = memoryview(data)
+    try:
+        for offset in range(0, len(view), buffer_size):
+            client_socket.sendall(view[offset:offset + buffer_size])
+            time.sleep(delay)
+    except socket.error:
+        pass
+    finally:
+        client_socket.close()
+
+
+def send_range_header(client_socket, header):
+    try:
+        client_socket.sendall(header)
+        return True
+    except socket.error:
+        client_socket.close()
+        return False
+
+
+def negotiate(send, compressed, window=0.2, required=False):
+    """包装send：先读请求行，客户端要zlib时发送compressed中的压缩副本，否则交给send；请求中有range时只发送这一段。
+    window秒内没有请求行就直接交给send；required为True时最多等REQUEST_TIMEOUT秒，没有请求行就关闭连接"""
+    def send_negotiated(client_socket, poetry_file, buffer_size, delay):
+        line = read_request(client_socket, REQUEST_TIMEOUT if required else window, required=required)
+        if line is None:
+            client_socket.close()
+            return
+        request = parse_request(line)
+        if request.compress:
+            data, version = compressed.get()
+            offset, length = clamp_range(request.offset or 0, request.length, len(data))
+            header = format_range_header(offset, length, len(data), version)
+            if request.offset is not None and not send_range_header(client_socket, header):
+                return
+            send_compressed(client_socket, memoryview(data)[offset:offset + length], buffer_size, delay)
+        elif request.offset is not None:
+            st = os.stat(poetry_file)
+            offset, length = clamp_range(request.offset, request.length, st.st_size)
+            # 回复头交给send，scatter_gather可以把它和正文放进同一次sendmsg
+            send(client_socket, poetry_file, buffer_size, delay, offset, length,
+                 format_range_header(offset, length, st.st_size, version_of(st)))
+        else:
+            send(client_socket, poetry_file, buffer_size, delay)
+    return send_negotiated
+
+
+class MeasuredSocket(object):
+    """代理客户端socket，把发送的字节数和错误记到transfer上，统计send类调用的次数，其它方法原样转发"""
+
+    def __init__(self, sock, transfer, report=False):
+        self.sock = sock
+        self.transfer = transfer
+        self.report_on_close = report
+        self.calls = 0
+        self.started = time.perf_counter()
+
+    def __getattr__(self, name):
+        return getattr(self.sock, name)
+
+    def sendall(self, data, *args):
+        self.calls += 1
+        try:
+            self.sock.sendall(data, *args)
+        except socket.error:
+            self.transfer.error('lost')
+            raise
+        self.transfer.data(len(data))
+
+    def sendmsg(self, buffers, *args):
+        self.calls += 1
+        try:
+            sent = self.sock.sendmsg(buffers, *args)
+        except socket.error:
+            self.transfer.error('lost')
+            raise
+        self.transfer.data(sent)
+        return sent
+
+    def sendfile(self, file, offset=0, count=None):
+        self.calls += 1
+        try:
+            sent = self.sock.sendfile(file, offset, count)
+        except socket.error:
+            self.transfer.error('lost')
+            raise
+        self.transfer.data(sent)
+        return sent
+
+    def close(self):
+        self.sock.close()
+        if not self.transfer.closed:
+            self.transfer.close()
+            if self.report_on_close:
+                self.report()
+
+    def report(self):
+        elapsed = time.perf_counter() - self.started
+        sent = self.transfer.bytes
+        print('Sent {} bytes in {} send calls ({:.0f} bytes/call) in {:.3f}s, {:.1f} MB/s'.format(
+            sent, self.calls, sent / self.calls if self.calls else 0, elapsed,
+            sent / elapsed / 1e6 if elapsed else 0))
+
+
+def measured(send, metrics, report=False):
+    """包装send，每个客户端连接对应metrics中的一个Transfer；report为True时每个连接结束时打印统计"""
+    def send_measured(client_socket, poetry_file, buffer_size, delay):
+        sock = MeasuredSocket(client_socket, metrics.open(), report)
+        try:
+            send(sock, poetry_file, buffer_size, delay)
+        finally:
+            sock.close()  # 各种send函数在出错时已经关闭了socket，这里只是保证结束计时
+    return send_measured
+
+
+def serve(listen_socket, poetry_file, buffer_size, delay, send=send_poetry):
     while True:
         client_sock, addr = listen_socket.accept()
         print('Somebody at {} wants poetry!'.format(addr))
-        send_poetry(client_sock, poetry_file, buffer_size, delay)
+        send(client_sock, poetry_file, buffer_size, delay)
+
+
+def serve_threads(listen_socket, poetry_file, buffer_size, delay, workers, queue_size, send=send_poetry):
+    clients = queue.Queue(maxsize=queue_size)
+
+    def worker():
+        while True:
+            client_sock, addr = clients.get()
+            try:
+                send(client_sock, poetry_file, buffer_size, delay)
+            except Exception:
+                # 线程死掉时不会有任何提示，主线程却还在把连接放进队列：记下错误，关掉这个连接，接着服务下一个客户端
+                print('Failed to serve {}:'.format(addr))
+                traceback.print_exc()
+                client_sock.close()
+
+    for _ in range(workers):
+        threading.Thread(target=worker, daemon=True).start()
+
+    while True:
+        client_sock, addr = listen_socket.accept()
+        print('Somebody at {} wants poetry!'.format(addr))
+        clients.put((client_sock, addr))  # 队列满时阻塞，不再accept新连接
+
+
+def serve_processes(listen_socket, poetry_file, buffer_size, delay, workers, send=send_poetry, init_worker=None):
+    """init_worker(i)在第i个(从1开始)工作进程fork之后调用"""
+    children = []
+    for i in range(1, workers + 1):
+        pid = os.fork()
+        if pid == 0:
+            if init_worker is not None:
+                init_worker(i)
+            serve(listen_socket, poetry_file, buffer_size, delay, send)
+        children.append(pid)
+    for pid in children:
+        os.waitpid(pid, 0)
 
 
 def main():
@@ -111,10 +516,31 @@ def main():
     sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
     sock.bind((options.host, options.port or 8000))
-    sock.listen(5)
+    sock.listen(options.backlog)
 
     print('Serving {} on port {}.'.format(poetry_file, sock.getsockname()[1]))
-    serve(sock, poetry_file, options.buffer_size, options.delay)
+    if options.sendfile:
+        send = sendfile_poetry
+    elif options.sendmsg:
+        send = scatter_gather(options.sendmsg)
+    else:
+        send = send_poetry
+    if options.compress or options.ranges:
+        send = negotiate(send, CompressedPoem(poetry_file), options.request_window, options.require_request)
+    if options.tcp != 'default':
+        send = set_tcp_mode(send, options.tcp)
+    metrics = Metrics('p1_blocking_server', 'server')
+    send = measured(send, metrics, options.report)
+    if options.workers == 1 or options.mode == 'thread':
+        start_exporters(options, metrics)
+    if options.workers == 1:
+        serve(sock, poetry_file, options.buffer_size, options.delay, send)
+    elif options.mode == 'thread':
+        queue_size = options.queue_size or 2 * options.workers
+        serve_threads(sock, poetry_file, options.buffer_size, options.delay, options.workers, queue_size, send)
+    else:
+        serve_processes(sock, poetry_file, options.buffer_size, options.delay, options.workers, send,
+                        init_worker=lambda i: start_exporters(options, metrics, i))
 
 
 if __name__ == '__main__':
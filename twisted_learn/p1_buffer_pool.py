@@ -0,0 +1,182 @@
+# -*- coding:utf-8 -*-
+"""接收缓冲区池
+
+客户端原来的写法是：
+
+    buff = sock.recv(1024)
+    data += buff
+
+每次recv都会新建一个bytes对象，而`data += buff`又会把已经收到的全部内容拷贝一遍，收一首大小为n的诗总共要拷贝O(n^2)字节。
+
+这里的做法是：
+
+1.BufferPool预先分配固定大小的bytearray(arena)，按容量分级放在空闲链表中重复使用。
+
+2.ReceiveBuffer通过sock.recv_into把数据直接写进arena的空闲部分，切片用的是memoryview，切片本身不拷贝数据。
+
+3.arena用满时换一个两倍大的arena，只在这时把已有内容拷贝一次，总拷贝量是O(n)；换下来的arena还给池子给别的连接用。
+收完后getvalue()返回memoryview，不拷贝，但arena还被这首诗占着；detach()拷贝出bytes并把arena还给池子，
+客户端的get_poetry用它返回与原来一样的bytes。
+
+4.ZlibReceiveBuffer接收zlib压缩的诗歌：压缩数据先收进从池子借来的临时arena，立即用decompressobj增量解压，
+解压结果写进最终的arena，不需要等整首诗收完再解压。
+
+>>> import socket
+>>> pool = BufferPool(arena_size=8)
+>>> a, b = socket.socketpair()
+>>> buf = ReceiveBuffer(pool, min_recv=4)
+>>> b.sendall(b'Ecstasy, John Donne'); b.close()
+>>> while buf.recv_into(a):
+...     pass
+>>> bytes(buf.getvalue())
+b'Ecstasy, John Donne'
+>>> pool.allocations, pool.bytes_received, pool.bytes_copied
+(3, 19, 24)
+>>> buf.detach()
+b'Ecstasy, John Donne'
+>>> sorted(pool._free)
+[8, 16, 32]
+>>> a.close()
+
+>>> import zlib
+>>> a, b = socket.socketpair()
+>>> buf = ZlibReceiveBuffer(pool, recv_size=8)
+>>> b.sendall(zlib.compress(b'Ecstasy ' * 100)); b.close()
+>>> while buf.recv_into(a):
+...     pass
+>>> len(buf), buf.wire_bytes, buf.complete
+(800, 24, True)
+>>> a.close()
+"""
+import zlib
+
+
+class BufferPool(object):
+
+    def __init__(self, arena_size=4096):
+        self.arena_size = arena_size
+        self._free = {}  # 容量 -> 空闲的bytearray列表
+        self.allocations = 0
+        self.bytes_copied = 0
+        self.bytes_received = 0
+
+    def _capacity(self, size):
+        capacity = self.arena_size
+        while capacity < size:
+            capacity *= 2
+        return capacity
+
+    def acquire(self, size=0):
+        """返回一个容量不小于size的bytearray，优先复用空闲的arena"""
+        capacity = self._capacity(size)
+        free = self._free.get(capacity)
+        if free:
+            return free.pop()
+        self.allocations += 1
+        return bytearray(capacity)
+
+    def release(self, arena):
+        self._free.setdefault(len(arena), []).append(arena)
+
+    def report(self):
+        mb = self.bytes_received / float(1 << 20)
+        msg = 'Received {:.3f} MB: {} allocations, {} bytes copied'.format(
+            mb, self.allocations, self.bytes_copied)
+        if mb:
+            msg += ' ({:.1f} allocations/MB, {:.0f} bytes copied/MB)'.format(
+                self.allocations / mb, self.bytes_copied / mb)
+        return msg
+
+
+class ReceiveBuffer(object):
+    """一首诗的接收缓冲区，数据始终直接落在最终的arena中"""
+
+    def __init__(self, pool, size_hint=0, min_recv=1024):
+        self.pool = pool
+        self.min_recv = min_recv
+        self._arena = pool.acquire(max(size_hint, min_recv))
+        self._view = memoryview(self._arena)
+        self.length = 0
+
+    def __len__(self):
+        return self.length
+
+    def _grow(self):
+        arena = self.pool.acquire(2 * len(self._arena))
+        arena[:self.length] = self._view[:self.length]
+        self.pool.bytes_copied += self.length
+        self._view.release()
+        self.pool.release(self._arena)
+        self._arena = arena
+        self._view = memoryview(arena)
+
+    def recv_into(self, sock):
+        """从sock读一次，返回读到的字节数，0表示对方已关闭连接。非阻塞socket没有数据时抛出BlockingIOError"""
+        if len(self._arena) - self.length < self.min_recv:
+            self._grow()
+        n = sock.recv_into(self._view[self.length:])
+        self.length += n
+        self.pool.bytes_received += n
+        return n
+
+    def write(self, data):
+        """把已经在内存中的数据追加到缓冲区"""
+        while len(self._arena) - self.length < len(data):
+            self._grow()
+        self._view[self.length:self.length + len(data)] = data
+        self.length += len(data)
+
+    def getvalue(self):
+        """返回已收到内容的memoryview，不拷贝；需要bytes时再调用bytes()"""
+        return self._view[:self.length]
+
+    def detach(self):
+        """拷贝出收到的内容(bytes)，同时把arena还给池子，之后这个缓冲区不能再用"""
+        data = bytes(self.getvalue())
+        self.release()
+        return data
+
+    def release(self):
+        """不再需要这首诗时把arena还给池子，可以重复调用"""
+        if self._arena is None:
+            return
+        self._view.release()
+        self.pool.release(self._arena)
+        self._arena = self._view = None
+        self.length = 0
+
+
+class ZlibReceiveBuffer(ReceiveBuffer):
+    """边收边解压，getvalue()返回解压后的内容，wire_bytes是网络上实际收到的字节数"""
+
+    def __init__(self, pool, size_hint=0, min_recv=1024, recv_size=65536):
+        super().__init__(pool, size_hint, min_recv)
+        self.recv_size = recv_size
+        self.wire_bytes = 0
+        self._decompressor = zlib.decompressobj()
+
+    @property
+    def complete(self):
+        """是否收到了完整的zlib流；连接提前断开时为False"""
+        return self._decompressor.eof
+
+    def recv_into(self, sock):
+        """返回的是收到的压缩字节数，0表示对方已关闭连接；数据不是合法的zlib流时抛出zlib.error"""
+        scratch = self.pool.acquire(self.recv_size)
+        try:
+            n = sock.recv_into(scratch)
+            if n:
+                self.write(self._decompressor.decompress(memoryview(scratch)[:n]))
+            else:
+                self.write(self._decompressor.flush())
+        finally:
+            self.pool.release(scratch)
+        self.wire_bytes += n
+        self.pool.bytes_received += n
+        return n
+
+
+if __name__ == '__main__':
+    import doctest
+
+    doctest.testmod()
@@ -0,0 +1,227 @@
+# -*- coding:utf-8 -*-
+"""诗歌客户端和服务器共用的连接指标
+
+原来只有print出来的`Task 1: got 3001 bytes of poetry from ...`，没法画图，也看不出吞吐量是不是变差了。
+每个程序创建一个Metrics，每个连接(客户端的一个下载任务、服务器的一个客户端)对应一个Transfer：
+
+* transfer.data(n)：收到(客户端)或者发出(服务器)n字节正文，第一次调用时记录首字节时间(TTFB，从连接开始算起)。
+* transfer.error(kind)：记一次错误，kind比如connect、timeout、lost。
+* transfer.close()：连接结束，记录传输时间。可以重复调用。
+
+Metrics统计总字节数、连接数、活动连接数、各种错误的次数，以及TTFB和传输时间的直方图，render()输出Prometheus的文本格式。
+计数在锁里更新，线程池版的服务器也可以共用一个Metrics。
+
+导出方式(add_metrics_options添加的命令行参数，start_exporters按参数启动)：
+
+* --metrics-port PORT：在127.0.0.1:PORT上用一个后台线程提供HTTP服务，GET /metrics返回当前的指标。
+* --metrics-file PATH：每--metrics-interval秒把指标写到PATH(先写临时文件再rename，读的一方不会看到写了一半的文件)，
+程序退出时再写一次，适合运行时间很短的客户端，可以交给node_exporter的textfile collector。
+
+多进程的服务器每个工作进程单独导出：第i个工作进程使用端口PORT+i和文件PATH.i。
+
+>>> metrics = Metrics('p1_async_client', 'client')
+>>> transfer = metrics.open(now=0)
+>>> transfer.data(100, now=0.004)
+>>> transfer.data(200, now=0.03)
+>>> transfer.close(now=0.03)
+>>> metrics.open(now=0).error('timeout')
+>>> text = metrics.render()
+>>> print('\\n'.join(line for line in text.splitlines() if 'bucket' not in line and not line.startswith('#')))
+poetry_bytes_total{program="p1_async_client",role="client"} 300
+poetry_connections_total{program="p1_async_client",role="client"} 2
+poetry_active_connections{program="p1_async_client",role="client"} 1
+poetry_errors_total{program="p1_async_client",role="client",kind="timeout"} 1
+poetry_ttfb_seconds_sum{program="p1_async_client",role="client"} 0.004
+poetry_ttfb_seconds_count{program="p1_async_client",role="client"} 1
+poetry_transfer_duration_seconds_sum{program="p1_async_client",role="client"} 0.03
+poetry_transfer_duration_seconds_count{program="p1_async_client",role="client"} 1
+>>> for line in [line for line in text.splitlines() if line.startswith('poetry_ttfb_seconds_bucket')][1:3]:
+...     print(line)
+poetry_ttfb_seconds_bucket{program="p1_async_client",role="client",le="0.0025"} 0
+poetry_ttfb_seconds_bucket{program="p1_async_client",role="client",le="0.005"} 1
+"""
+import atexit
+import bisect
+import collections
+import http.server
+import os
+import threading
+import time
+
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+class Histogram(object):
+    """Prometheus风格的直方图：每个桶统计不超过上界le的样本数，输出时累加"""
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # 最后一个是+Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def render(self, name, labels):
+        lines = []
+        cumulative = 0
+        for le, count in zip(self.buckets + ('+Inf',), self.counts):
+            cumulative += count
+            lines.append('{}_bucket{{{},le="{}"}} {}'.format(name, labels, le, cumulative))
+        lines.append('{}_sum{{{}}} {}'.format(name, labels, round(self.sum, 9)))
+        lines.append('{}_count{{{}}} {}'.format(name, labels, self.count))
+        return lines
+
+
+class Transfer(object):
+    """一个连接的计时和计数，由Metrics.open()创建"""
+    __slots__ = ('metrics', 'started', 'first_byte', 'bytes', 'closed')
+
+    def __init__(self, metrics, now):
+        self.metrics = metrics
+        self.started = now
+        self.first_byte = None
+        self.bytes = 0
+        self.closed = False
+
+    def data(self, n, now=None):
+        if not n:
+            return
+        self.bytes += n
+        with self.metrics.lock:
+            self.metrics.bytes += n
+            if self.first_byte is None:
+                self.first_byte = time.monotonic() if now is None else now
+                self.metrics.ttfb.observe(self.first_byte - self.started)
+
+    def error(self, kind):
+        with self.metrics.lock:
+            self.metrics.errors[kind] += 1
+
+    def close(self, now=None):
+        if self.closed:
+            return
+        self.closed = True
+        now = time.monotonic() if now is None else now
+        with self.metrics.lock:
+            self.metrics.active -= 1
+            self.metrics.duration.observe(now - self.started)
+
+
+class Metrics(object):
+
+    def __init__(self, program, role):
+        self.labels = 'program="{}",role="{}"'.format(program, role)
+        self.lock = threading.Lock()
+        self.bytes = 0
+        self.connections = 0
+        self.active = 0
+        self.errors = collections.Counter()
+        self.ttfb = Histogram()
+        self.duration = Histogram()
+
+    def open(self, now=None):
+        with self.lock:
+            self.connections += 1
+            self.active += 1
+        return Transfer(self, time.monotonic() if now is None else now)
+
+    def render(self):
+        labels = self.labels
+        with self.lock:
+            lines = [
+                '# HELP poetry_bytes_total Poetry payload bytes received by clients or sent by servers.',
+                '# TYPE poetry_bytes_total counter',
+                'poetry_bytes_total{{{}}} {}'.format(labels, self.bytes),
+                '# HELP poetry_connections_total Connections (client tasks or served clients) started.',
+                '# TYPE poetry_connections_total counter',
+                'poetry_connections_total{{{}}} {}'.format(labels, self.connections),
+                '# HELP poetry_active_connections Connections currently open.',
+                '# TYPE poetry_active_connections gauge',
+                'poetry_active_connections{{{}}} {}'.format(labels, self.active),
+                '# HELP poetry_errors_total Failed connects, timeouts, lost connections and protocol errors.',
+                '# TYPE poetry_errors_total counter',
+            ]
+            for kind, count in sorted(self.errors.items()):
+                lines.append('poetry_errors_total{{{},kind="{}"}} {}'.format(labels, kind, count))
+            lines += ['# HELP poetry_ttfb_seconds Seconds from the start of a connection to its first payload byte.',
+                      '# TYPE poetry_ttfb_seconds histogram']
+            lines += self.ttfb.render('poetry_ttfb_seconds', labels)
+            lines += ['# HELP poetry_transfer_duration_seconds Seconds from the start to the end of a connection.',
+                      '# TYPE poetry_transfer_duration_seconds histogram']
+            lines += self.duration.render('poetry_transfer_duration_seconds', labels)
+        return '\n'.join(lines) + '\n'
+
+
+def serve_http(metrics, port, host='127.0.0.1'):
+    """在后台线程中提供GET /metrics，返回HTTP服务器"""
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+            body = metrics.render().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass  # 不要让每次抓取都打印一行
+
+    server = http.server.ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def write_file(metrics, path):
+    tmp = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp, 'w') as f:
+        f.write(metrics.render())
+    os.replace(tmp, path)
+
+
+def write_periodically(metrics, path, interval):
+    """每interval秒以及程序退出时把指标写到path"""
+    stopped = threading.Event()
+
+    def run():
+        while not stopped.wait(interval):
+            write_file(metrics, path)
+
+    def final():
+        stopped.set()
+        write_file(metrics, path)
+
+    threading.Thread(target=run, daemon=True).start()
+    atexit.register(final)
+
+
+def add_metrics_options(parser):
+    parser.add_option('--metrics-port', type='int',
+                      help='Serve Prometheus metrics on http://127.0.0.1:PORT/metrics.')
+    parser.add_option('--metrics-file',
+                      help='Write Prometheus metrics to this file periodically and on exit.')
+    parser.add_option('--metrics-interval', type='float', default=10,
+                      help='Seconds between --metrics-file updates. Default is 10.')
+
+
+def start_exporters(options, metrics, worker=0):
+    """按命令行参数启动导出，worker是多进程服务器中工作进程的序号(从1开始)，返回metrics"""
+    if options.metrics_port is not None:
+        serve_http(metrics, options.metrics_port + worker)
+    if options.metrics_file:
+        path = '{}.{}'.format(options.metrics_file, worker) if worker else options.metrics_file
+        write_periodically(metrics, path, options.metrics_interval)
+    return metrics
+
+
+if __name__ == '__main__':
+    import doctest
+
+    doctest.testmod()
@@ -0,0 +1,390 @@
+# -*- coding:utf-8 -*-
+"""从多个镜像并行分段下载同一首诗
+
+其他客户端的每个地址是一首诗，一首诗只能从一个服务器整个下载下来，下载时间取决于这一个服务器(连接)的速度。
+这里的每个地址都是同一首诗的镜像(服务器需要使用--ranges，见p1_request)，诗被切成若干段，
+每个镜像同时只下载一段，下载完一段就去领下一段，快的镜像自然会领到更多的段：
+
+1.总长度要等第一个range回复头到达才知道，所以开始时第k个镜像先请求第k段(range=k*SEG:SEG)，
+超出结尾的段服务器回复长度0，这个镜像直接领下一段。
+
+2.知道总长度后分配一块完整的缓冲区，每一段的正文直接recv_into到缓冲区中它的位置，不需要再拼接。
+
+3.段是按顺序领取的，但完成的顺序不一定。contiguous记录从头开始已经连续完成的字节数，
+每往前推进一次就把新连续的部分按顺序写到--output，不用等整首诗下载完。
+
+4.没有段可领时，空闲的镜像从剩余时间最长的那一段中分走后半部分(work stealing)：按两个镜像测得的速度分割剩余的字节，
+让它们差不多同时下载完；原来的连接收到新的结尾就关闭。这样结尾不会被一个慢镜像拖住，剩余不到2 * --min-steal字节的段不再分割。
+
+5.连接失败、超时、中途断开或者超过--stall-timeout秒没有收到数据时，这一段没有收到的部分放回去给别的镜像，
+连续失败--retries次的镜像不再使用。各个镜像回复的总长度必须相同，同一个镜像的版本(VERSION)不能改变。
+
+每个镜像每次只使用一个连接，所以下载时间大约与镜像的数量成反比(每个连接的速度受限于服务器或者网络时)：
+
+    python p1_blocking_server.py --ranges -w 4 -b 8192 -d 0.01 --port 10000 poetry/ecstasy.txt
+    python p4_1_fast_poetry.py --named --ranges --port 10001 poetry
+    python p1_mirror_client.py --output ecstasy.txt 10000 10001/ecstasy
+
+>>> download = SegmentedDownload([Mirror(('127.0.0.1', 10000)), Mirror(('127.0.0.1', 10001))], None, 100)
+>>> [(s.offset, s.end) for s in (download.next_segment(), download.next_segment())]
+[(0, 100), (100, 200)]
+>>> download.set_total(150)
+>>> download.next_segment() is None
+True
+"""
+import collections
+import optparse
+import os
+import socket
+import time
+from datetime import datetime
+
+from p1_async_client import connect, format_address
+from p1_request import RangeError, format_request, parse_range_header, recv_header_line
+from p1_selector_loop import SelectorLoop
+
+
+def parse_args():
+    usage = """usage: %prog [options] [hostname]:port[/poem] ...
+    Download ONE poem from several mirrors at once. Every address must serve
+    the same poem with --ranges; add /poem for --named servers.
+      python p1_mirror_client.py --output ecstasy.txt 10000 10001/ecstasy
+    """
+    parser = optparse.OptionParser(usage)
+    parser.add_option('--segment-size', type='int', default=256 * 1024,
+                      help='Bytes requested from a mirror at a time. Default is 262144.')
+    parser.add_option('--min-steal', type='int', default=16 * 1024,
+                      help='Never split off less than this many bytes of a busy segment. Default is 16384.')
+    parser.add_option('--connect-timeout', type='float', default=10,
+                      help='Seconds to wait for each connection to be established. Default is 10.')
+    parser.add_option('--stall-timeout', type='float', default=10,
+                      help='Give a segment to another mirror after this many seconds without data. Default is 10.')
+    parser.add_option('--retries', type='int', default=3,
+                      help='Drop a mirror after this many failures in a row. Default is 3.')
+    parser.add_option('--output', help='Write the poem to OUTPUT, in order, as soon as each prefix is complete.')
+    options, addresses = parser.parse_args()
+    if not addresses:
+        print(parser.format_help())
+        parser.exit()
+
+    def parse_address(addr):
+        poem_name = None
+        if '/' in addr:
+            addr, poem_name = addr.split('/', 1)
+        if ':' not in addr:
+            host = '127.0.0.1'
+            port = addr
+        else:
+            host, port = addr.split(':', 1)
+        if not port.isdigit():
+            parser.error('Ports must be integers.')
+        return Mirror((host, int(port)), poem_name)
+
+    return options, list(map(parse_address, addresses))
+
+
+class Segment(object):
+    """[offset, end)这一段，pos是下一个要收的字节"""
+    __slots__ = ('offset', 'pos', 'end')
+
+    def __init__(self, offset, end):
+        self.offset = offset
+        self.pos = offset
+        self.end = end
+
+    @property
+    def remaining(self):
+        return self.end - self.pos
+
+
+class Mirror(object):
+    """一个镜像的地址、正在下载的段和统计"""
+
+    def __init__(self, address, poem_name=None):
+        self.address = address
+        self.poem_name = poem_name
+        self.version = None
+        self.sock = None
+        self.segment = None
+        self.header_pending = False
+        self.header = bytearray()  # 还没收完的range回复头
+        self.timer = None
+        self.last_data = 0
+        self.started = 0
+        self.busy = 0.0  # 所有连接从发起到结束的总时间
+        self.bytes = 0
+        self.segments = 0
+        self.steals = 0
+        self.failures = 0  # 连续失败的次数
+        self.dead = False
+
+    @property
+    def rate(self):
+        """测得的速度(字节/秒)，没有数据时为None"""
+        busy = self.busy + (time.monotonic() - self.started if self.sock is not None else 0)
+        return self.bytes / busy if self.bytes and busy > 0 else None
+
+    def format_addr(self):
+        return format_address(self.address) + ('/' + self.poem_name if self.poem_name else '')
+
+
+class SegmentedDownload(object):
+
+    def __init__(self, mirrors, loop, segment_size=256 * 1024, min_steal=16 * 1024, connect_timeout=10,
+                 stall_timeout=10, retries=3, output=None):
+        self.mirrors = mirrors
+        self.loop = loop
+        self.segment_size = segment_size
+        self.min_steal = min_steal
+        self.connect_timeout = connect_timeout
+        self.stall_timeout = stall_timeout
+        self.retries = retries
+        self.output = output
+        self.total = None
+        self.buffer = None
+        self.next_offset = 0  # 还没有分出去的部分从这里开始
+        self.returned = collections.deque()  # 失败的连接没有收完、放回来的段
+        self.finished = {}  # 已经完成、但是还没有连到contiguous上的段：offset -> end
+        self.contiguous = 0
+        self.stall_timer = None
+
+    @property
+    def complete(self):
+        return self.total is not None and self.contiguous >= self.total
+
+    def set_total(self, total):
+        self.total = total
+        self.buffer = bytearray(total)
+        for segment in [m.segment for m in self.mirrors if m.segment is not None] + list(self.returned):
+            segment.end = min(segment.end, total)
+
+    def next_segment(self):
+        while self.returned:
+            segment = self.returned.popleft()
+            if segment.remaining > 0:
+                return segment
+        if self.total is not None and self.next_offset >= self.total:
+            return None
+        end = self.next_offset + self.segment_size
+        if self.total is not None:
+            end = min(end, self.total)
+        segment = Segment(self.next_offset, end)
+        self.next_offset = end
+        return segment
+
+    def steal(self, thief):
+        """从剩余时间最长的段分出后半部分给thief，按两个镜像的速度分割，没有可分的段时返回None"""
+        best, best_time = None, 0
+        for mirror in self.mirrors:
+            segment = mirror.segment
+            if segment is None or mirror.header_pending or segment.remaining < 2 * self.min_steal:
+                continue
+            rate = mirror.rate or 1.0
+            if segment.remaining / rate > best_time:
+                best, best_time = mirror, segment.remaining / rate
+        if best is None:
+            return None
+        segment = best.segment
+        victim_rate = best.rate or 1.0
+        thief_rate = thief.rate or victim_rate
+        keep = int(segment.remaining * victim_rate / (victim_rate + thief_rate))
+        keep = min(max(keep, self.min_steal), segment.remaining - self.min_steal)
+        stolen = Segment(segment.pos + keep, segment.end)
+        segment.end = stolen.offset
+        thief.steals += 1
+        return stolen
+
+    def start(self):
+        for mirror in self.mirrors:
+            self.assign(mirror)
+        self.stall_timer = self.loop.call_later(1, self.check_stalls)
+
+    def assign(self, mirror):
+        """给空闲的mirror找一段并发起连接；没有事情可做时检查是否全部结束"""
+        if mirror.dead:
+            return
+        segment = self.next_segment()
+        if segment is None and self.total is not None:
+            segment = self.steal(mirror)
+        if segment is None:
+            self.check_done()
+            return
+        try:
+            sock = connect(mirror.address)
+        except socket.error as e:
+            print('{}: failed to connect: {}'.format(mirror.format_addr(), e))
+            self.returned.append(segment)
+            self.fail(mirror)
+            return
+        mirror.sock, mirror.segment = sock, segment
+        mirror.started = mirror.last_data = time.monotonic()
+        mirror.timer = self.loop.call_later(self.connect_timeout, self.timed_out, mirror)
+        self.loop.add_writer(sock, lambda: self.connected(mirror))
+
+    def connected(self, mirror):
+        self.loop.remove_writer(mirror.sock)
+        self.loop.cancel(mirror.timer)
+        err = mirror.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if err:
+            print('{}: failed to connect: {}'.format(mirror.format_addr(), os.strerror(err)))
+            self.drop(mirror)
+            return
+        segment = mirror.segment
+        mirror.sock.send(format_request(mirror.poem_name, False, segment.pos, segment.remaining))
+        mirror.header_pending = True
+        del mirror.header[:]
+        self.loop.add_reader(mirror.sock, lambda: self.read(mirror))
+
+    def timed_out(self, mirror):
+        print('{}: connection timed out'.format(mirror.format_addr()))
+        self.loop.remove_writer(mirror.sock)
+        self.drop(mirror)
+
+    def read_header(self, mirror):
+        line = recv_header_line(mirror.sock, mirror.header)
+        if not line:
+            raise EOFError()
+        offset, length, total, version = parse_range_header(line)
+        if mirror.version is not None and version != mirror.version:
+            raise RangeError('the poem changed on the server')
+        if self.total is not None and total != self.total:
+            raise RangeError('mirror has {} bytes, expected {}'.format(total, self.total))
+        mirror.version = version
+        mirror.header_pending = False
+        if self.total is None:
+            self.set_total(total)
+        segment = mirror.segment
+        if segment.pos >= total:
+            segment.end = segment.pos  # 开始时分出去的段超出了结尾
+        elif offset != segment.pos:
+            raise RangeError('asked for byte {}, got byte {}'.format(segment.pos, offset))
+        else:
+            segment.end = min(segment.end, offset + length)
+
+    def read(self, mirror):
+        segment = mirror.segment
+        try:
+            if mirror.header_pending:
+                self.read_header(mirror)
+            while segment.pos < segment.end:
+                # 只收到这一段的结尾为止，被分走的部分留在socket中，随着连接一起丢弃
+                n = mirror.sock.recv_into(memoryview(self.buffer)[segment.pos:segment.end])
+                if not n:
+                    raise EOFError()
+                segment.pos += n
+                mirror.bytes += n
+                mirror.last_data = time.monotonic()
+        except BlockingIOError:
+            return
+        except EOFError:
+            print('{}: connection closed at byte {} of [{}, {})'.format(
+                mirror.format_addr(), segment.pos, segment.offset, segment.end))
+            self.drop(mirror)
+            return
+        except (socket.error, RangeError) as e:
+            print('{}: lost connection: {}'.format(mirror.format_addr(), e))
+            self.drop(mirror)
+            return
+        self.close(mirror)
+        mirror.segment = None
+        mirror.failures = 0
+        mirror.segments += 1
+        self.segment_done(segment.offset, segment.end)
+        self.assign(mirror)
+
+    def segment_done(self, offset, end):
+        if end > offset:
+            self.finished[offset] = end
+        start = self.contiguous
+        while self.contiguous in self.finished:
+            self.contiguous = self.finished.pop(self.contiguous)
+        if self.output is not None and self.contiguous > start:
+            self.output.write(memoryview(self.buffer)[start:self.contiguous])
+
+    def close(self, mirror):
+        self.loop.cancel(mirror.timer)
+        self.loop.remove_reader(mirror.sock)
+        self.loop.remove_writer(mirror.sock)
+        mirror.sock.close()
+        mirror.sock = None
+        mirror.busy += time.monotonic() - mirror.started
+
+    def drop(self, mirror):
+        """连接失败：已经收到的部分照样算完成，剩下的部分放回去"""
+        segment = mirror.segment
+        self.close(mirror)
+        mirror.segment = None
+        if segment.pos > segment.offset:
+            self.segment_done(segment.offset, segment.pos)
+        if segment.remaining > 0:
+            self.returned.append(Segment(segment.pos, segment.end))
+            # 放回去的段先让空闲的镜像去领
+            for other in self.mirrors:
+                if other.sock is None and not other.dead and other is not mirror:
+                    self.assign(other)
+        self.fail(mirror)
+
+    def fail(self, mirror):
+        mirror.segment = None
+        mirror.failures += 1
+        if mirror.failures >= self.retries:
+            print('{}: giving up after {} failures'.format(mirror.format_addr(), mirror.failures))
+            mirror.dead = True
+            self.check_done()
+        else:
+            self.assign(mirror)
+
+    def check_stalls(self):
+        now = time.monotonic()
+        for mirror in self.mirrors:
+            if mirror.sock is not None and mirror.segment is not None and now - mirror.last_data > self.stall_timeout:
+                print('{}: stalled for {:.1f}s'.format(mirror.format_addr(), now - mirror.last_data))
+                self.drop(mirror)
+        if not self.check_done():
+            self.stall_timer = self.loop.call_later(1, self.check_stalls)
+
+    def check_done(self):
+        """下载完成，或者所有镜像都已经放弃时停止事件循环"""
+        if self.complete or all(m.dead for m in self.mirrors):
+            if self.stall_timer is not None:
+                self.loop.cancel(self.stall_timer)
+            self.loop.stop()
+            return True
+        return False
+
+    def report(self):
+        lines = ['{:>24} {:>9} {:>12} {:>10} {:>7}'.format('mirror', 'segments', 'bytes', 'KB/s', 'steals')]
+        for mirror in self.mirrors:
+            rate = mirror.rate
+            lines.append('{:>24} {:>9} {:>12} {:>10} {:>7}{}'.format(
+                mirror.format_addr(), mirror.segments, mirror.bytes,
+                '-' if rate is None else '{:.1f}'.format(rate / 1024), mirror.steals,
+                ' (dropped)' if mirror.dead else ''))
+        return '\n'.join(lines)
+
+
+def main():
+    options, mirrors = parse_args()
+    start = datetime.now()
+    loop = SelectorLoop()
+    output = open(options.output, 'wb') if options.output else None
+    download = SegmentedDownload(mirrors, loop, options.segment_size, options.min_steal, options.connect_timeout,
+                                 options.stall_timeout, options.retries, output)
+    try:
+        download.start()
+        loop.run()
+    finally:
+        loop.close()
+        if output is not None:
+            output.close()
+    elapsed = datetime.now() - start
+    print(download.report())
+    if download.complete:
+        print('Got {} bytes of poetry from {} mirrors in {}'.format(download.total, len(mirrors), elapsed))
+    else:
+        print('Incomplete: got {} contiguous bytes of {} in {}'.format(
+            download.contiguous, '?' if download.total is None else download.total, elapsed))
+
+
+if __name__ == '__main__':
+    main()
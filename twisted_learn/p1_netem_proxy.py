@@ -0,0 +1,338 @@
+# -*- coding:utf-8 -*-
+"""模拟网络条件的本地TCP代理
+
+在一台机器上测客户端时，客户端和服务器之间是回环网卡：没有延迟、带宽几乎无限，也不会停顿，
+用慢速服务器(--delay)只能模拟服务器端的限速。这个代理放在任何客户端和服务器之间，
+对每个连接的两个方向分别施加：
+
+* --delay：单向延迟(毫秒)，一次往返就是两倍；--jitter：在延迟上加减的随机抖动(毫秒)。
+TCP不会乱序，所以每块数据的发送时间不早于前一块。
+* --rate：每个方向的带宽(字节/秒)，用p1_paced_server.TokenBucket实现，--burst是桶的容量。
+* --stall-every/--stall-time：平均每隔stall-every秒(指数分布)这个方向停顿stall-time秒，模拟丢包重传或者无线信号的中断。
+
+每个方向是一个Pipe：可读时从一端读出数据，记下它可以发出的时间放进队列，到时间并且有令牌时写到另一端。
+队列中超过--max-buffer字节时暂停读，让TCP的流量控制把压力传回发送方，代理本身的内存占用是有上限的。
+一端关闭写(EOF)并且队列发完后，对另一端shutdown(SHUT_WR)，两个方向都结束后关闭连接。
+
+随机数由--seed、连接的序号和方向决定，两个方向各用一个随机数生成器，抽取的顺序不受两个方向的事件先后影响，
+同样的参数下每次运行的抖动和停顿都一样，测试结果可以重现。
+--profile给出几组常见的网络条件，单独给出的参数会覆盖profile中的值。
+
+    python p1_blocking_server.py --ranges --port 10000 poetry/ecstasy.txt
+    python p1_netem_proxy.py --port 20000 --target 10000 --profile 3g
+    python p1_async_client.py 20000
+
+>>> rng = random.Random(1)
+>>> times = []
+>>> for now in (0.0, 0.001, 0.002):
+...     times.append(release_time(now, times[-1] if times else 0, 0.05, 0.02, rng))
+>>> [round(t, 4) for t in times]
+[0.0354, 0.0649, 0.0649]
+"""
+import collections
+import itertools
+import optparse
+import os
+import random
+import socket
+import time
+
+from p1_async_client import connect, format_address
+from p1_paced_server import TokenBucket
+from p1_selector_loop import SelectorLoop, raise_fd_limit
+
+RECV_SIZE = 65536
+
+Conditions = collections.namedtuple('Conditions', 'delay jitter rate burst stall_every stall_time max_buffer')
+
+# 单位与命令行参数相同：毫秒、毫秒、字节/秒、字节、秒、秒
+PROFILES = {
+    'lan': dict(delay=0.5, jitter=0.1, rate=0),
+    'dsl': dict(delay=15, jitter=3, rate=2 * 1024 * 1024 // 8),
+    '3g': dict(delay=100, jitter=30, rate=750 * 1024 // 8, stall_every=10, stall_time=0.5),
+    'satellite': dict(delay=300, jitter=20, rate=1024 * 1024 // 8),
+    'lossy-wifi': dict(delay=5, jitter=20, rate=5 * 1024 * 1024 // 8, stall_every=2, stall_time=0.2),
+}
+
+
+def parse_args():
+    usage = """usage: %prog [options] --target [hostname:]port
+    A local TCP proxy that adds latency, jitter, bandwidth limits and stalls
+    to every connection between a poetry client and a poetry server.
+      python p1_netem_proxy.py --port 20000 --target 10000 --delay 50 --rate 100000
+    Then point the client at port 20000 instead of 10000.
+    """
+    parser = optparse.OptionParser(usage)
+    parser.add_option('--host', default='localhost',
+                      help='The interface to listen on. Default is localhost.')
+    parser.add_option('-p', '--port', type='int',
+                      help='The port to listen on. Default to a random available port.')
+    parser.add_option('--target',
+                      help='The [hostname:]port of the server to forward connections to.')
+    parser.add_option('--profile', choices=sorted(PROFILES),
+                      help='Start from a preset: {}.'.format(', '.join(sorted(PROFILES))))
+    parser.add_option('--delay', type='float',
+                      help='One-way delay in milliseconds added in each direction. Default is 0.')
+    parser.add_option('--jitter', type='float',
+                      help='Random milliseconds added to or taken from every delay. Default is 0.')
+    parser.add_option('--rate', type='int',
+                      help='Bytes per second in each direction of every connection, 0 for unlimited. Default is 0.')
+    parser.add_option('--burst', type='int',
+                      help='Token bucket size in bytes for --rate. Default is 50ms worth of --rate.')
+    parser.add_option('--stall-every', type='float',
+                      help='Mean seconds between stalls in each direction, 0 for none. Default is 0.')
+    parser.add_option('--stall-time', type='float',
+                      help='Seconds every stall lasts. Default is 0.5.')
+    parser.add_option('--max-buffer', type='int', default=256 * 1024,
+                      help='Bytes queued per direction before the proxy stops reading. Default is 262144.')
+    parser.add_option('--seed', type='int', default=0,
+                      help='Seed for jitter and stalls, so runs are repeatable. Default is 0.')
+    options, args = parser.parse_args()
+    if args or not options.target:
+        parser.error('Provide --target and no other arguments.')
+    host, _, port = options.target.rpartition(':')
+    if not port.isdigit():
+        parser.error('Ports must be integers.')
+    options.target = (host or '127.0.0.1', int(port))
+
+    settings = dict(delay=0, jitter=0, rate=0, burst=0, stall_every=0, stall_time=0.5)
+    settings.update(PROFILES.get(options.profile, {}))
+    for name in settings:
+        if getattr(options, name) is not None:
+            settings[name] = getattr(options, name)
+    rate = settings['rate']
+    conditions = Conditions(delay=settings['delay'] / 1000.0, jitter=settings['jitter'] / 1000.0, rate=rate,
+                            burst=settings['burst'] or max(1, rate // 20),
+                            stall_every=settings['stall_every'], stall_time=settings['stall_time'],
+                            max_buffer=options.max_buffer)
+    return options, conditions
+
+
+def release_time(now, previous, delay, jitter, rng):
+    """now读到的一块数据可以发出的时间：加上延迟和抖动，但不早于前一块(previous)"""
+    delay = max(0.0, delay + rng.uniform(-jitter, jitter)) if jitter else delay
+    return max(previous, now + delay)
+
+
+class Pipe(object):
+    """连接的一个方向：从src读出的数据经过延迟、限速和停顿后写到dst"""
+
+    def __init__(self, loop, src, dst, conditions, rng, finished):
+        self.loop = loop
+        self.src = src
+        self.dst = dst
+        self.conditions = conditions
+        self.rng = rng
+        self.finished = finished  # 这个方向结束(ok=True)或者出错(ok=False)时调用finished(self, ok)
+        self.queue = collections.deque()  # (可以发出的时间, 数据)
+        self.queued = 0
+        self.last_release = 0.0
+        self.bucket = TokenBucket(conditions.rate, conditions.burst) if conditions.rate else None
+        self.stall_until = 0.0
+        self.next_stall = self._next_stall(time.monotonic())
+        self.stalls = 0
+        self.bytes = 0
+        self.eof = False
+        self.done = False
+        self.reading = False
+        self.writing = False
+        self.timer = None
+
+    def _next_stall(self, now):
+        every = self.conditions.stall_every
+        return now + self.rng.expovariate(1.0 / every) if every else None
+
+    def start(self):
+        self.want_read(True)
+
+    def want_read(self, flag):
+        if flag and not self.reading:
+            self.loop.add_reader(self.src, self.read)
+        elif not flag and self.reading:
+            self.loop.remove_reader(self.src)
+        self.reading = flag
+
+    def want_write(self, flag):
+        if flag and not self.writing:
+            self.loop.add_writer(self.dst, self.flush)
+        elif not flag and self.writing:
+            self.loop.remove_writer(self.dst)
+        self.writing = flag
+
+    def wake_after(self, delay):
+        if self.timer is not None:
+            self.loop.cancel(self.timer)
+        self.timer = self.loop.call_later(delay, self.flush)
+
+    def read(self):
+        try:
+            data = self.src.recv(max(1, min(RECV_SIZE, self.conditions.max_buffer - self.queued)))
+        except BlockingIOError:
+            return
+        except socket.error:
+            self.stop(False)
+            return
+        if not data:
+            self.eof = True
+            self.want_read(False)
+        else:
+            c = self.conditions
+            self.last_release = release_time(time.monotonic(), self.last_release, c.delay, c.jitter, self.rng)
+            self.queue.append((self.last_release, memoryview(data)))
+            self.queued += len(data)
+            if self.queued >= c.max_buffer:
+                self.want_read(False)  # 队列满了，让发送方的TCP窗口来限流
+        if not self.writing:
+            self.flush()
+
+    def flush(self):
+        if self.timer is not None:
+            self.loop.cancel(self.timer)
+            self.timer = None
+        while self.queue:
+            now = time.monotonic()
+            if self.next_stall is not None and now >= self.next_stall:
+                self.stall_until = now + self.conditions.stall_time
+                self.next_stall = self._next_stall(self.stall_until)
+                self.stalls += 1
+            release, data = self.queue[0]
+            wait = max(release, self.stall_until) - now
+            if wait > 0:
+                self.want_write(False)
+                self.wake_after(wait)
+                return
+            size = len(data)
+            if self.bucket is not None:
+                # 攒够一整桶(或者整块数据)的令牌再发，免得每次只发几个刚补充的字节
+                wait = self.bucket.wait_time(size)
+                if wait > 0:
+                    self.want_write(False)
+                    self.wake_after(wait)
+                    return
+                size = self.bucket.consume(size)
+            try:
+                sent = self.dst.send(data[:size])
+            except BlockingIOError:
+                sent = 0
+            except socket.error:
+                self.stop(False)
+                return
+            if self.bucket is not None:
+                self.bucket.tokens += size - sent  # 没发出去的令牌还回桶里
+            self.bytes += sent
+            self.queued -= sent
+            if sent == len(data):
+                self.queue.popleft()
+            else:
+                self.queue[0] = (release, data[sent:])
+            if not self.eof and self.queued <= self.conditions.max_buffer // 2:
+                self.want_read(True)  # 队列降到一半以下才重新读，不要一个字节一个字节地读
+            if sent < size:
+                # dst的发送缓冲区满了，只有这时才需要等待可写事件
+                self.want_write(True)
+                return
+        self.want_write(False)
+        if self.eof:
+            try:
+                self.dst.shutdown(socket.SHUT_WR)
+            except socket.error:
+                pass
+            self.stop(True)
+
+    def stop(self, ok):
+        if self.done:
+            return
+        self.done = True
+        if self.timer is not None:
+            self.loop.cancel(self.timer)
+            self.timer = None
+        self.want_read(False)
+        self.want_write(False)
+        self.finished(self, ok)
+
+
+class ProxyConnection(object):
+
+    def __init__(self, loop, number, client, target, conditions, seed):
+        self.loop = loop
+        self.number = number
+        self.client = client
+        self.conditions = conditions
+        self.seed = seed
+        self.pipes = []
+        self.closed = False
+        self.started = time.monotonic()
+        try:
+            self.server = connect(target)
+        except socket.error as e:
+            print('Connection {}: cannot reach {}: {}'.format(number, format_address(target), e))
+            client.close()
+            return
+        loop.add_writer(self.server, self.connected)
+
+    def make_rng(self, direction):
+        return random.Random('{}-{}-{}'.format(self.seed, self.number, direction))
+
+    def connected(self):
+        self.loop.remove_writer(self.server)
+        err = self.server.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if err:
+            print('Connection {}: cannot reach the server: {}'.format(self.number, os.strerror(err)))
+            self.server.close()
+            self.client.close()
+            return
+        up = Pipe(self.loop, self.client, self.server, self.conditions, self.make_rng('up'), self.pipe_finished)
+        down = Pipe(self.loop, self.server, self.client, self.conditions, self.make_rng('down'), self.pipe_finished)
+        self.pipes = [up, down]
+        for pipe in self.pipes:
+            pipe.start()
+
+    def pipe_finished(self, pipe, ok):
+        if self.closed or (ok and not all(p.done for p in self.pipes)):
+            return
+        self.closed = True
+        for p in self.pipes:
+            p.stop(ok)  # 出错时另一个方向也停下
+        self.client.close()
+        self.server.close()
+        up, down = self.pipes
+        elapsed = time.monotonic() - self.started
+        print('Connection {}: {} bytes up, {} bytes down in {:.3f}s, {} stalls{}'.format(
+            self.number, up.bytes, down.bytes, elapsed, up.stalls + down.stalls, '' if ok else ' (aborted)'))
+
+
+def serve(loop, listen_socket, target, conditions, seed):
+    numbers = itertools.count(1)
+
+    def accept():
+        while True:
+            try:
+                client_sock, addr = listen_socket.accept()
+            except BlockingIOError:
+                return
+            client_sock.setblocking(False)
+            ProxyConnection(loop, next(numbers), client_sock, target, conditions, seed)
+
+    listen_socket.setblocking(False)
+    loop.add_reader(listen_socket, accept)
+    loop.run()
+
+
+def main():
+    options, conditions = parse_args()
+    raise_fd_limit(65536)
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((options.host, options.port or 0))
+    sock.listen(1024)
+
+    print('Proxying port {} to {}: delay {:.1f}ms, jitter {:.1f}ms, rate {}, stalls {}.'.format(
+        sock.getsockname()[1], format_address(options.target), conditions.delay * 1000, conditions.jitter * 1000,
+        '{} B/s'.format(conditions.rate) if conditions.rate else 'unlimited',
+        'every {}s for {}s'.format(conditions.stall_every, conditions.stall_time) if conditions.stall_every else 'none'))
+    serve(SelectorLoop(), sock, options.target, conditions, options.seed)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,187 @@
+# -*- coding:utf-8 -*-
+"""事件驱动的慢速诗歌服务器
+
+p1_blocking_server.py用time.sleep(delay)模拟带宽，sleep时整个进程(或者整个工作线程)都被阻塞，
+一个进程同时只能慢慢地服务一个客户端。
+
+这里改用p1_selector_loop.SelectorLoop，每个连接有自己的令牌桶(TokenBucket)：
+令牌以每秒buffer_size / delay字节的速度补充，桶的容量是buffer_size字节。有令牌时就发送，
+令牌用完就用call_later在令牌足够时再发送，只有内核发送缓冲区满了才注册写事件。没有任何地方会sleep，
+因此一个进程可以同时以各自的速率服务成千上万个慢速客户端。
+
+使用--metrics-port/--metrics-file时导出每个连接发出的字节数、首字节时间、传输时间和发送错误(见p1_metrics.py)。
+
+`python p1_paced_server.py --delay 0.3 --buffer-size 100 poetry/ecstasy.txt`
+"""
+import optparse
+import os
+import socket
+import time
+
+from p1_metrics import Metrics, add_metrics_options, start_exporters
+from p1_selector_loop import SelectorLoop, raise_fd_limit
+
+
+def parse_args():
+    usage = """usage: %prog [options] poetry-file
+    This is the Slow Poetry Server, event-driven edition.
+    Run it like this:
+      python p1_paced_server.py <path-to-poetry-file>
+    Every client gets --buffer-size bytes every --delay seconds,
+    independently of all the other clients.
+    """
+    parser = optparse.OptionParser(usage)
+
+    parser.add_option('--host',
+                      help='The interface to listen on. Default is localhost.',
+                      default='localhost')
+    parser.add_option('-p', '--port',
+                      help='The port to listen on. Default to a random available port.',
+                      type='int')
+    parser.add_option('-d', '--delay',
+                      type='float',
+                      help='The number of seconds between sending bytes.',
+                      default=.3)
+    parser.add_option('-b', '--buffer-size',
+                      type='int',
+                      help='The number of bytes to send at a time.',
+                      default=100)
+    parser.add_option('--backlog',
+                      type='int',
+                      help='The listen() backlog. Default is 1024.',
+                      default=1024)
+    add_metrics_options(parser)
+
+    options, args = parser.parse_args()
+    if len(args) != 1:
+        parser.error('Provide exactly one poetry file.')
+    poetry_file = args[0]
+    if not os.path.exists(poetry_file):
+        parser.error('No such file:{}'.format(poetry_file))
+    return options, poetry_file
+
+
+class TokenBucket(object):
+    """
+    >>> bucket = TokenBucket(rate=100, capacity=100, now=0)
+    >>> bucket.consume(150, now=0)
+    100
+    >>> bucket.consume(150, now=0.5)
+    50
+    >>> bucket.wait_time(10, now=0.5)
+    0.1
+    """
+
+    def __init__(self, rate, capacity, now=None):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic() if now is None else now
+
+    def _refill(self, now):
+        now = time.monotonic() if now is None else now
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def consume(self, wanted, now=None):
+        """取出最多wanted个令牌，返回实际取到的个数"""
+        self._refill(now)
+        got = int(min(wanted, self.tokens))
+        self.tokens -= got
+        return got
+
+    def wait_time(self, wanted, now=None):
+        """还要等多少秒桶里才有wanted个令牌"""
+        self._refill(now)
+        return max(0.0, (min(wanted, self.capacity) - self.tokens) / self.rate)
+
+
+class PacedConnection(object):
+
+    def __init__(self, loop, sock, poem, buffer_size, delay, transfer):
+        self.loop = loop
+        self.transfer = transfer
+        self.sock = sock
+        self.poem = memoryview(poem)
+        self.offset = 0
+        self.buffer_size = buffer_size
+        # delay为0表示不限速
+        self.bucket = TokenBucket(buffer_size / delay, buffer_size) if delay else None
+        self.waiting_writable = False
+        self.write()
+
+    def write(self):
+        while self.offset < len(self.poem):
+            size = min(self.buffer_size, len(self.poem) - self.offset)
+            if self.bucket is not None:
+                size = self.bucket.consume(size)
+                if not size:
+                    # 令牌用完：暂时不关心可写事件，等令牌补充后直接再试
+                    self.wait_writable(False)
+                    self.loop.call_later(self.bucket.wait_time(self.buffer_size), self.write)
+                    return
+            try:
+                sent = self.sock.send(self.poem[self.offset:self.offset + size])
+            except BlockingIOError:
+                sent = 0
+            except socket.error:
+                self.transfer.error('lost')
+                self.close()
+                return
+            self.offset += sent
+            self.transfer.data(sent)
+            if self.bucket is not None:
+                self.bucket.tokens += size - sent  # 没发出去的令牌还回桶里
+            if sent < size:
+                # 内核发送缓冲区满了，只有这时才需要等待可写事件
+                self.wait_writable(True)
+                return
+        self.close()
+
+    def wait_writable(self, flag):
+        if flag and not self.waiting_writable:
+            self.loop.add_writer(self.sock, self.write)
+        elif not flag and self.waiting_writable:
+            self.loop.remove_writer(self.sock)
+        self.waiting_writable = flag
+
+    def close(self):
+        self.wait_writable(False)
+        self.sock.close()
+        self.transfer.close()
+
+
+def serve(loop, listen_socket, poem, buffer_size, delay, metrics):
+    def accept():
+        while True:
+            try:
+                client_sock, addr = listen_socket.accept()
+            except BlockingIOError:
+                return
+            client_sock.setblocking(False)
+            PacedConnection(loop, client_sock, poem, buffer_size, delay, metrics.open())
+
+    listen_socket.setblocking(False)
+    loop.add_reader(listen_socket, accept)
+    loop.run()
+
+
+def main():
+    options, poetry_file = parse_args()
+    raise_fd_limit(65536)
+
+    with open(poetry_file, 'rb') as f:
+        poem = f.read()
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((options.host, options.port or 0))
+    sock.listen(options.backlog)
+
+    print('Serving {} on port {}.'.format(poetry_file, sock.getsockname()[1]))
+    metrics = start_exporters(options, Metrics('p1_paced_server', 'server'))
+    serve(SelectorLoop(), sock, poem, options.buffer_size, options.delay, metrics)
+
+
+if __name__ == '__main__':
+    main()
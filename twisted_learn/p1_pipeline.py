@@ -0,0 +1,262 @@
+# -*- coding:utf-8 -*-
+"""收到的诗歌数据块的流式处理管道
+
+客户端原来要等整首诗收完才能处理它，内存占用与诗的大小成正比，第一行诗要等最后一个字节到达后才能输出。
+
+这里用生成器协程(coroutine)组成一条管道：每个阶段是一个协程，`item = yield`接收上一阶段送来的数据，
+处理后send给下一阶段；close()时各阶段依次冲刷还没送出的数据。数据块一到就流过整条管道，
+每个阶段只保存很少的状态(比如一行还没结束的部分)，内存占用与诗的大小无关。
+
+阶段：
+
+* decompress：增量解压zlib数据(对应p1_buffer_pool.ZlibReceiveBuffer)。
+* split_lines：把数据块切成行，每一行保留自己的行尾(b'\\n'或b'\\r\\n')；一行超过max_line字节时先送出已有的部分，
+这一部分没有行尾，下一项是同一行的后续。最后一行没有换行符时原样送出。
+* decode：用增量解码器把bytes解码成str，一个多字节字符被切在两个数据块之间也没有问题。
+* transform：对每一项调用func，返回None的项被丢掉，可以用来做过滤。默认的管道里没有transform，写出的内容与收到的完全一样。
+* write_file/collect：终点(sink)，把每一项原样写到文件中(不再加换行符，也不做换行符转换)或者追加到列表中。
+
+Pipeline在阶段之间插入计数，记录每个阶段收到的项数、字节(字符)数以及第一项到达的时间。
+StreamReceiver提供与ReceiveBuffer一样的recv_into接口，客户端可以直接用它代替ReceiveBuffer。
+
+>>> import functools, zlib
+>>> lines = []
+>>> upper = functools.partial(transform, func=str.upper)
+>>> pipeline = Pipeline([decompress, split_lines, decode, upper], collect(lines))
+>>> data = zlib.compress('Ecstasy\\nWhere, like a pillow on a bed,\\n— John Donne'.encode('utf-8'))
+>>> for i in range(0, len(data), 7):
+...     pipeline.send(data[i:i + 7])
+>>> lines
+['ECSTASY\\n', 'WHERE, LIKE A PILLOW ON A BED,\\n']
+>>> pipeline.close()
+>>> lines[-1]
+'— JOHN DONNE'
+>>> [(s.name, s.items) for s in pipeline.stats]
+[('decompress', 9), ('split_lines', 8), ('decode', 3), ('transform', 3), ('collect', 3)]
+>>> pieces = []
+>>> pipeline = Pipeline([functools.partial(split_lines, max_line=4)], collect(pieces))
+>>> pipeline.send(b'abcdefgh'); pipeline.send(b'ij\\r\\nk'); pipeline.close()
+>>> pieces, b''.join(pieces)
+([b'abcdefgh', b'ij\\r\\n', b'k'], b'abcdefghij\\r\\nk')
+"""
+import codecs
+import functools
+import time
+import zlib
+
+
+def coroutine(func):
+    """创建协程后先执行到第一个yield，之后才能send"""
+    @functools.wraps(func)
+    def start(*args, **kwargs):
+        gen = func(*args, **kwargs)
+        next(gen)
+        return gen
+    return start
+
+
+@coroutine
+def decompress(target):
+    decompressor = zlib.decompressobj()
+    try:
+        while True:
+            data = decompressor.decompress((yield))
+            if data:
+                target.send(data)
+    except GeneratorExit:
+        data = decompressor.flush()
+        if data:
+            target.send(data)
+        target.close()
+
+
+@coroutine
+def split_lines(target, max_line=65536):
+    pending = bytearray()
+    try:
+        while True:
+            pending += yield
+            start = 0
+            while True:
+                end = pending.find(b'\n', start)
+                if end < 0:
+                    break
+                target.send(bytes(pending[start:end + 1]))
+                start = end + 1
+            del pending[:start]
+            if len(pending) > max_line:
+                target.send(bytes(pending))
+                del pending[:]
+    except GeneratorExit:
+        if pending:
+            target.send(bytes(pending))
+        target.close()
+
+
+@coroutine
+def decode(target, encoding='utf-8', errors='replace'):
+    decoder = codecs.getincrementaldecoder(encoding)(errors)
+    try:
+        while True:
+            target.send(decoder.decode((yield)))
+    except GeneratorExit:
+        tail = decoder.decode(b'', final=True)
+        if tail:
+            target.send(tail)
+        target.close()
+
+
+@coroutine
+def transform(target, func):
+    try:
+        while True:
+            item = func((yield))
+            if item is not None:
+                target.send(item)
+    except GeneratorExit:
+        target.close()
+
+
+@coroutine
+def write_file(path, encoding='utf-8'):
+    """每一项原样写到文件中(行尾由split_lines保留)，管道关闭时关闭文件"""
+    with open(path, 'w', encoding=encoding, newline='') as f:
+        while True:
+            f.write((yield))
+
+
+@coroutine
+def collect(items):
+    while True:
+        items.append((yield))
+
+
+class StageStats(object):
+    """一个阶段收到的数据：项数、总长度(bytes是字节数，str是字符数)、第一项和最后一项到达的时间"""
+
+    def __init__(self, name):
+        self.name = name
+        self.items = 0
+        self.size = 0
+        self.first = None
+        self.last = None
+
+
+class Counter(object):
+    """放在两个阶段之间，把收到的每一项计数后原样交给target"""
+
+    def __init__(self, stats, target):
+        self.stats = stats
+        self.target = target
+
+    def send(self, item):
+        stats = self.stats
+        stats.last = time.perf_counter()
+        if stats.first is None:
+            stats.first = stats.last
+        stats.items += 1
+        stats.size += len(item)
+        self.target.send(item)
+
+    def close(self):
+        self.target.close()
+
+
+def stage_name(stage):
+    func = getattr(stage, 'func', stage)  # functools.partial
+    return getattr(func, '__name__', type(func).__name__)
+
+
+class Pipeline(object):
+    """stages是一组callable，stage(target)返回一个协程；sink是已经创建好的终点协程"""
+
+    def __init__(self, stages, sink):
+        self.started = time.perf_counter()
+        self.stats = [StageStats(stage_name(stage)) for stage in stages]
+        self.stats.append(StageStats(sink.__name__))
+        target = Counter(self.stats[-1], sink)
+        for stage, stats in zip(reversed(stages), reversed(self.stats[:-1])):
+            target = Counter(stats, stage(target))
+        self.head = target
+        self.closed = False
+
+    def send(self, chunk):
+        self.head.send(chunk)
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.head.close()
+
+    @property
+    def first_output(self):
+        """从创建管道到终点收到第一项的秒数"""
+        first = self.stats[-1].first
+        return None if first is None else first - self.started
+
+
+def format_stats(pipelines):
+    """把多条相同结构的管道的计数按阶段加起来"""
+    pipelines = list(pipelines)
+    if not pipelines:
+        return ''
+    lines = ['{:>12} {:>10} {:>12}'.format('stage', 'items', 'size')]
+    for stages in zip(*[p.stats for p in pipelines]):
+        lines.append('{:>12} {:>10} {:>12}'.format(
+            stages[0].name, sum(s.items for s in stages), sum(s.size for s in stages)))
+    firsts = sorted(p.first_output for p in pipelines if p.first_output is not None)
+    if firsts:
+        lines.append('first output after {:.1f}ms (median {:.1f}ms)'.format(
+            firsts[0] * 1000, firsts[len(firsts) // 2] * 1000))
+    return '\n'.join(lines)
+
+
+def poem_pipeline(path, compress=False, transforms=()):
+    """客户端使用的管道：(解压)、分行、解码、transforms中的每个函数，最后逐行写到path"""
+    stages = [decompress] if compress else []
+    stages += [split_lines, decode]
+    stages += [functools.partial(transform, func=func) for func in transforms]
+    return Pipeline(stages, write_file(path))
+
+
+class StreamReceiver(object):
+    """与ReceiveBuffer接口相同，但收到的数据直接交给pipeline而不保存，len()是收到的总字节数。
+
+    对方关闭连接时不关闭管道，续传(p1_request.RangeReceiver)时后面的数据还会接着送进来，release()时才关闭管道"""
+
+    def __init__(self, pipeline, pool, recv_size=65536):
+        self.pipeline = pipeline
+        self.pool = pool
+        self.recv_size = recv_size
+        self.length = 0
+
+    def __len__(self):
+        return self.length
+
+    def recv_into(self, sock):
+        scratch = self.pool.acquire(self.recv_size)
+        try:
+            n = sock.recv_into(scratch)
+            if n:
+                self.pipeline.send(bytes(memoryview(scratch)[:n]))
+        finally:
+            self.pool.release(scratch)
+        self.length += n
+        self.pool.bytes_received += n
+        return n
+
+    def getvalue(self):
+        return memoryview(b'')
+
+    def detach(self):
+        """数据已经写进了管道，这里没有内容；管道要等release()时才关闭"""
+        return b''
+
+    def release(self):
+        self.pipeline.close()
+
+
+if __name__ == '__main__':
+    import doctest
+
+    doctest.testmod()
@@ -0,0 +1,193 @@
+# -*- coding:utf-8 -*-
+"""诗歌服务器的请求行与断点续传
+
+客户端连上服务器后可以先发送一行请求(服务器需要使用--named/--framed，或者--compress/--ranges)：
+
+    [诗名] [zlib] [range=START[:LENGTH]]\\r\\n
+
+* 诗名只用于--named/--framed服务器。
+* zlib表示要压缩后的诗。
+* range表示只要从第START个字节开始的LENGTH个字节(没有LENGTH就一直到结尾)。压缩时字节位置指的是压缩后的数据，
+与HTTP的Content-Encoding加Range一样，续传的压缩数据接在已经收到的数据后面就能继续解压。
+
+带range的请求，服务器在正文前先回复一行：
+
+    range START LENGTH TOTAL VERSION\\r\\n
+
+TOTAL是整个文件(或者压缩副本)的字节数，VERSION由文件的mtime和大小得到，文件变化后就不同了。
+
+连接中途断开时，客户端用RangeReceiver记录已经收到的正文字节数，重新连接后发送range=已收到的字节数，
+只下载缺少的部分；VERSION变了说明文件已经被修改，已经收到的部分不能再用了。
+
+>>> parse_request(b'ecstasy zlib range=100:50\\r')
+Request(name='ecstasy', compress=True, offset=100, length=50)
+>>> parse_request(b'zlib')
+Request(name='', compress=True, offset=None, length=None)
+>>> format_request('ecstasy', offset=3001)
+b'ecstasy range=3001\\r\\n'
+>>> parse_range_header(format_range_header(100, 50, 3001, 'a-bb9'))
+(100, 50, 3001, 'a-bb9')
+>>> clamp_range(2990, None, 3001), clamp_range(4000, 10, 3001)
+((2990, 11), (3001, 0))
+"""
+import collections
+import errno
+import socket
+
+MAX_HEADER = 256
+
+Request = collections.namedtuple('Request', 'name compress offset length')
+
+
+class RangeError(Exception):
+    """回复头格式不对，或者文件在两次连接之间变了，无法续传"""
+
+
+def parse_request(line):
+    words = line.strip().decode('utf-8', 'replace').split()
+    compress = False
+    offset = length = None
+    while words and (words[-1] == 'zlib' or words[-1].startswith('range=')):
+        word = words.pop()
+        if word == 'zlib':
+            compress = True
+            continue
+        start, _, count = word[len('range='):].partition(':')
+        try:
+            offset = max(0, int(start))
+            length = max(0, int(count)) if count else None
+        except ValueError:
+            offset = length = None
+    return Request(' '.join(words), compress, offset, length)
+
+
+def format_request(name=None, compress=False, offset=None, length=None):
+    words = [name] if name else []
+    if compress:
+        words.append('zlib')
+    if offset is not None:
+        words.append('range={}'.format(offset) + (':{}'.format(length) if length is not None else ''))
+    return ' '.join(words).encode('utf-8') + b'\r\n'
+
+
+def clamp_range(offset, length, total):
+    """把请求的范围限制在[0, total)之内，返回(offset, length)"""
+    offset = min(offset, total)
+    remaining = total - offset
+    return offset, remaining if length is None else min(length, remaining)
+
+
+def version_of(st):
+    """由os.stat的结果得到文件的版本标记"""
+    return '{:x}-{:x}'.format(st.st_mtime_ns, st.st_size)
+
+
+def format_range_header(offset, length, total, version):
+    return 'range {} {} {} {}\r\n'.format(offset, length, total, version).encode('ascii')
+
+
+def parse_range_header(line):
+    words = line.decode('ascii', 'replace').split()
+    if len(words) != 5 or words[0] != 'range':
+        raise RangeError('bad range header: {!r}'.format(line))
+    try:
+        offset, length, total = map(int, words[1:4])
+    except ValueError:
+        raise RangeError('bad range header: {!r}'.format(line))
+    return offset, length, total, words[4]
+
+
+def recv_header_line(sock, partial):
+    """从非阻塞的socket中取走range回复头这一行并返回，连接已关闭时返回b''，还没有收完一行时抛出BlockingIOError。
+
+    partial是调用者为每个连接保存的bytearray：已经到达的半行先从socket中取走放在这里，
+    否则数据一直留在socket中，select会不停地报告可读，客户端就空转到剩下的部分到达为止"""
+    # MSG_PEEK只看不取，确定回复头的长度后只取走回复头，正文留在socket中直接recv_into
+    data = sock.recv(MAX_HEADER - len(partial), socket.MSG_PEEK)
+    if not data:
+        return data
+    end = data.find(b'\n')
+    if end < 0:
+        if len(partial) + len(data) >= MAX_HEADER:
+            raise RangeError('range header too long')
+        partial += sock.recv(len(data))
+        raise BlockingIOError(errno.EAGAIN, 'partial range header')
+    partial += sock.recv(end + 1)
+    line = bytes(partial)
+    del partial[:]
+    return line
+
+
+class RangeReceiver(object):
+    """包装一个ReceiveBuffer(或者ZlibReceiveBuffer、StreamReceiver)：每个连接先读掉range回复头，
+    再把正文交给receiver，记录收到的正文字节数received。连接断开后can_resume()为True时重新连接，用request()续传。
+
+    recv_into返回的只是正文的字节数，读完回复头而正文还没有到达时抛出BlockingIOError"""
+
+    def __init__(self, receiver):
+        self.receiver = receiver
+        self.received = 0
+        self.total = None
+        self.version = None
+        self.retries = 0
+        self.failed = False
+        self._header_pending = True
+        self._partial = bytearray()  # 还没收完的回复头
+
+    def __len__(self):
+        return len(self.receiver)
+
+    @property
+    def complete(self):
+        return self.total is not None and self.received >= self.total
+
+    def can_resume(self, max_retries):
+        """连接失败或断开后是否应该重新连接，每次返回True都算一次重试"""
+        if self.complete or self.failed or self.retries >= max_retries:
+            return False
+        self.retries += 1
+        return True
+
+    def request(self, name=None, compress=False):
+        """新连接建立后要发送的请求行，从已经收到的位置继续"""
+        self._header_pending = True
+        del self._partial[:]
+        return format_request(name, compress, self.received)
+
+    def _read_header(self, sock):
+        """读完回复头时返回True，连接已关闭时返回False"""
+        line = recv_header_line(sock, self._partial)
+        if not line:
+            return False
+        self.failed = True  # 下面出错时不能再续传
+        offset, length, total, version = parse_range_header(line)
+        if self.version is not None and version != self.version:
+            raise RangeError('the poem changed on the server')
+        if offset != self.received:
+            raise RangeError('asked for byte {}, got byte {}'.format(self.received, offset))
+        self.failed = False
+        self.total, self.version = total, version
+        self._header_pending = False
+        return True
+
+    def recv_into(self, sock):
+        if self._header_pending and not self._read_header(sock):
+            return 0
+        n = self.receiver.recv_into(sock)
+        self.received += n
+        return n
+
+    def getvalue(self):
+        return self.receiver.getvalue()
+
+    def detach(self):
+        return self.receiver.detach()
+
+    def release(self):
+        self.receiver.release()
+
+
+if __name__ == '__main__':
+    import doctest
+
+    doctest.testmod()
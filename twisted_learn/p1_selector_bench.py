@@ -0,0 +1,91 @@
+# -*- coding:utf-8 -*-
+"""比较select.select与selectors.DefaultSelector的唤醒代价
+
+构造N个socketpair，全部处于监视状态，但每次只有其中一个可读。这正是大量慢速诗歌服务器的典型场景：
+连接很多，同一时刻就绪的很少。
+
+select.select每次唤醒都要遍历全部N个socket，耗时随N线性增长，而且文件描述符超过FD_SETSIZE就无法使用；
+epoll只返回就绪的socket，耗时基本与N无关。
+
+`python p1_selector_bench.py -n 100,1000,10000`
+"""
+import optparse
+import select
+import selectors
+import socket
+import time
+
+from p1_selector_loop import raise_fd_limit
+
+
+def parse_args():
+    usage = """usage: %prog [options]
+    Measure the cost of one wakeup with N registered sockets, select.select vs selectors.
+    """
+    parser = optparse.OptionParser(usage)
+    parser.add_option('-n', '--sockets', default='10,100,1000,10000',
+                      help='Comma separated socket counts. Default is 10,100,1000,10000.')
+    parser.add_option('-i', '--iterations', type='int', default=2000,
+                      help='Wakeups measured per socket count. Default is 2000.')
+    options, _ = parser.parse_args()
+    options.sockets = [int(n) for n in options.sockets.split(',')]
+    return options
+
+
+def bench_select(readers, writers, iterations):
+    active_r, active_w = readers[-1], writers[-1]
+    try:
+        start = time.perf_counter()
+        for _ in range(iterations):
+            active_w.send(b'x')
+            rlist, _, _ = select.select(readers, [], [])
+            rlist[0].recv(1)
+        return (time.perf_counter() - start) / iterations
+    except ValueError:  # filedescriptor out of range in select()
+        active_r.recv(1)
+        return None
+
+
+def bench_selector(readers, writers, iterations):
+    sel = selectors.DefaultSelector()
+    for r in readers:
+        sel.register(r, selectors.EVENT_READ)
+    active_w = writers[-1]
+    start = time.perf_counter()
+    for _ in range(iterations):
+        active_w.send(b'x')
+        for key, _ in sel.select():
+            key.fileobj.recv(1)
+    elapsed = (time.perf_counter() - start) / iterations
+    sel.close()
+    return elapsed
+
+
+def format_cost(seconds):
+    if seconds is None:
+        return '{:>14}'.format('n/a')
+    return '{:>11.2f} us'.format(seconds * 1e6)
+
+
+def main():
+    options = parse_args()
+    limit = raise_fd_limit(2 * max(options.sockets) + 64)
+    print('{} selector, fd limit {}'.format(selectors.DefaultSelector.__name__, limit))
+    print('{:>8} {:>14} {:>14}'.format('sockets', 'select', 'selectors'))
+    for n in options.sockets:
+        if 2 * n + 16 > limit:
+            print('{:>8} skipped: fd limit too low'.format(n))
+            continue
+        pairs = [socket.socketpair() for _ in range(n)]
+        readers = [r for r, _ in pairs]
+        writers = [w for _, w in pairs]
+        cost_select = bench_select(readers, writers, options.iterations)
+        cost_selector = bench_selector(readers, writers, options.iterations)
+        print('{:>8} {} {}'.format(n, format_cost(cost_select), format_cost(cost_selector)))
+        for r, w in pairs:
+            r.close()
+            w.close()
+
+
+if __name__ == '__main__':
+    main()
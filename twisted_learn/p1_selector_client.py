@@ -0,0 +1,177 @@
+# -*- coding:utf-8 -*-
+"""selectors(epoll)版的异步模型客户端
+
+与p1_async_client.py的区别只在于事件循环：get_poetry不再每次循环都把全部socket交给select.select，
+而是在开始时把每个socket注册到SelectorLoop一次，诗歌下载完成时注销。每次唤醒只处理就绪的socket，
+因此可以同时下载上万首诗歌(需要足够大的文件描述符上限，见p1_selector_loop.raise_fd_limit)。
+
+连接是非阻塞地发起的(见p1_async_client.connect)：每个socket先注册写事件，可写时检查SO_ERROR，
+成功就改为注册读事件；超过connect_timeout还没连上的socket被关闭。
+
+--zlib与p1_async_client.py一样：连上后发送`zlib\r\n`，读到的数据由ZlibReceiveBuffer增量解压。
+--output-dir也一样：每收到一块数据就流过p1_pipeline的管道写到文件，不在内存中保存诗歌。
+--resume也一样：断开的下载重新连接后从已经收到的字节继续(服务器需要使用--ranges)。
+--metrics-port/--metrics-file也一样：每个任务是p1_metrics中的一个Transfer。
+
+`python p1_selector_client.py 8000 8001 8002`
+"""
+import os
+import socket
+import zlib
+from datetime import datetime
+
+from p1_buffer_pool import BufferPool
+from p1_async_client import (parse_args, format_address, connect, receive_buffer, format_compression, stream_receivers,
+                             error_kind, format_failure, format_failures)
+from p1_metrics import Metrics, start_exporters
+from p1_pipeline import format_stats
+from p1_request import RangeError, RangeReceiver
+from p1_selector_loop import SelectorLoop, raise_fd_limit
+
+
+def get_poetry(sockets, verbose=True, pool=None, connect_timeout=None, compress=False, receivers=None,
+               addresses=None, resume=0, metrics=None, errors=None):
+    sockets = list(sockets)
+    pool = pool or BufferPool()
+    receivers = receivers or [receive_buffer(pool, compress) for _ in sockets]
+    if resume:
+        receivers = [RangeReceiver(receiver) for receiver in receivers]
+    poems = dict(zip(sockets, receivers))
+    sock2task = dict([(s, i) for i, s in enumerate(sockets, start=1)])
+    origins = dict(zip(sockets, sockets))  # 重新连接的socket -> 调用者传入的socket
+    peers = dict(zip(sockets, addresses)) if addresses is not None else {}
+    metrics = metrics or Metrics('p1_selector_client', 'client')
+    transfers = dict((i, metrics.open()) for i in sock2task.values())
+    errors = {} if errors is None else errors
+
+    def fail(s, kind):
+        """记一次错误，任务算作失败；续传最终完成的任务在最后会从errors中去掉"""
+        transfers[sock2task[s]].error(kind)
+        errors[origins[s]] = kind
+    loop = SelectorLoop()
+
+    def reconnect(s):
+        receiver = poems[s]
+        transfer = transfers[sock2task[s]]
+        if not resume or s not in peers or not receiver.can_resume(resume):
+            transfer.close()
+            return
+        try:
+            new = connect(peers[s])
+        except socket.error as e:
+            print('Task {}: failed to reconnect: {}'.format(sock2task[s], e))
+            fail(s, 'connect')
+            transfer.close()
+            return
+        for d in (poems, sock2task, origins, peers):
+            d[new] = d.pop(s)
+        loop.add_writer(new, make_connected(new))
+        print('Task {}: resuming from byte {} (retry {})'.format(sock2task[new], receiver.received, receiver.retries))
+
+    def make_connected(s):
+        timer = None
+
+        def connected():
+            loop.remove_writer(s)
+            if timer is not None:
+                loop.cancel(timer)
+            err = s.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if err:
+                print('Task {}: failed to connect: {}'.format(sock2task[s], os.strerror(err)))
+                fail(s, 'connect')
+                s.close()
+                reconnect(s)
+            else:
+                if resume:
+                    peers.setdefault(s, s.getpeername())
+                    s.send(poems[s].request(compress=compress))
+                elif compress:
+                    s.send(b'zlib\r\n')
+                loop.add_reader(s, make_reader(s))
+
+        def timed_out():
+            loop.remove_writer(s)
+            print('Task {}: connection timed out'.format(sock2task[s]))
+            fail(s, 'timeout')
+            s.close()
+            reconnect(s)
+
+        if connect_timeout is not None:
+            timer = loop.call_later(connect_timeout, timed_out)
+        return connected
+
+    def make_reader(s):
+        def read():
+            received = 0
+            done = False  # 只读到range回复头时received为0但连接还在
+            transfer = transfers[sock2task[s]]
+            while True:
+                try:
+                    n = poems[s].recv_into(s)
+                except BlockingIOError:
+                    break
+                except (socket.error, zlib.error, RangeError) as e:
+                    print('Task {}: lost connection: {}'.format(sock2task[s], e))
+                    fail(s, error_kind(e))
+                    done = True
+                    break
+                if not n:
+                    done = True
+                    break
+                received += n
+                transfer.data(n)
+
+            if done:
+                loop.remove_reader(s)
+                s.close()
+                reconnect(s)
+            elif received and verbose:
+                addr_fmt = format_address(s.getpeername())
+                msg = 'Task {}: got {} bytes of poetry from {}'.format(sock2task[s], received, addr_fmt)
+                print(msg)
+        return read
+
+    for s in sockets:
+        loop.add_writer(s, make_connected(s))
+    loop.run()
+    loop.close()
+    for s, receiver in poems.items():
+        if resume and not receiver.complete:
+            print('Task {}: incomplete, got {} bytes'.format(sock2task[s], receiver.received))
+            fail(s, 'incomplete')
+        elif resume:
+            errors.pop(origins[s], None)  # 中途出过错，但续传完成了
+    return dict((origins[s], buf.detach()) for s, buf in poems.items())  # bytes，arena都还给池子
+
+
+def main():
+    options, address_list = parse_args()
+    address_list = list(address_list)
+    raise_fd_limit(len(address_list) + 64)
+    metrics = start_exporters(options, Metrics('p1_selector_client', 'client'))
+    start = datetime.now()
+    sockets = list(map(connect, address_list))
+    pool = BufferPool()
+    receivers = None
+    if options.output_dir:
+        receivers = stream_receivers(options.output_dir, len(sockets), pool, options.zlib)
+    errors = {}
+    poems = get_poetry(sockets, verbose=len(sockets) <= 100, pool=pool,
+                       connect_timeout=options.connect_timeout, compress=options.zlib, receivers=receivers,
+                       addresses=address_list, resume=options.resume, metrics=metrics, errors=errors)
+    elapsed = datetime.now() - start
+    for i, sock in enumerate(sockets, start=1):
+        print('Task {}:{} bytes of poetry'.format(i, len(poems[sock])) + format_failure(errors.get(sock)))
+
+    print('Got {} poems in {}'.format(len(address_list) - len(errors), elapsed) + format_failures(errors))
+    print(pool.report())
+    if receivers:
+        for receiver in receivers:
+            receiver.release()
+        print(format_stats(r.pipeline for r in receivers))
+    elif options.zlib:
+        print(format_compression(sum(len(poem) for poem in poems.values()), pool.bytes_received))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,148 @@
+# -*- coding:utf-8 -*-
+"""基于selectors模块的事件循环核心
+
+p1_async_client.py每次循环都调用select.select(sockets, [], [])：
+
+1.select受FD_SETSIZE(Linux上通常是1024)限制，文件描述符的数值超过它就会抛出ValueError。
+
+2.每次调用都要把整个socket列表拷贝进内核，内核再逐个检查，唤醒的代价是O(n)，与就绪的socket数量无关。
+
+selectors.DefaultSelector会选择当前平台上最高效的实现(Linux上是epoll，BSD/macOS上是kqueue)。
+epoll把关注的文件描述符保存在内核中，只需在注册(register)和注销(unregister)时增量修改一次，
+每次唤醒的代价只与就绪的文件描述符数量有关。
+
+SelectorLoop就是一个最简单的reactor：为socket注册读/写回调，循环等待事件并分派给回调。
+"""
+import heapq
+import itertools
+import resource
+import selectors
+import time
+
+
+def raise_fd_limit(wanted):
+    """尽量把进程可打开的文件描述符上限(RLIMIT_NOFILE)提高到wanted，返回提高后的软上限"""
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft >= wanted:
+        return soft
+    if hard != resource.RLIM_INFINITY:
+        wanted = min(wanted, hard)
+    try:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (wanted, hard))
+    except (ValueError, OSError):
+        return soft
+    return wanted
+
+
+class SelectorLoop(object):
+    """
+    >>> import socket
+    >>> loop = SelectorLoop()
+    >>> a, b = socket.socketpair()
+    >>> def on_read():
+    ...     print(a.recv(1024))
+    ...     loop.remove_reader(a)
+    >>> loop.add_reader(a, on_read)
+    >>> b.sendall(b'poetry')
+    >>> loop.run()
+    b'poetry'
+    >>> a.close(); b.close(); loop.close()
+    """
+
+    def __init__(self, selector=None):
+        self.selector = selector or selectors.DefaultSelector()
+        self._timers = []
+        self._timer_seq = itertools.count()
+        self._running = False
+
+    def _update(self, fileobj, reader, writer):
+        # key.data保存(读回调, 写回调)，读写关注的变化只需一次modify，而不是重新注册
+        events = (selectors.EVENT_READ if reader else 0) | (selectors.EVENT_WRITE if writer else 0)
+        try:
+            self.selector.get_key(fileobj)
+        except KeyError:
+            if events:
+                self.selector.register(fileobj, events, (reader, writer))
+            return
+        if events:
+            self.selector.modify(fileobj, events, (reader, writer))
+        else:
+            self.selector.unregister(fileobj)
+
+    def _callbacks(self, fileobj):
+        try:
+            return self.selector.get_key(fileobj).data
+        except KeyError:
+            return None, None
+
+    def add_reader(self, fileobj, callback):
+        _, writer = self._callbacks(fileobj)
+        self._update(fileobj, callback, writer)
+
+    def remove_reader(self, fileobj):
+        _, writer = self._callbacks(fileobj)
+        self._update(fileobj, None, writer)
+
+    def add_writer(self, fileobj, callback):
+        reader, _ = self._callbacks(fileobj)
+        self._update(fileobj, reader, callback)
+
+    def remove_writer(self, fileobj):
+        reader, _ = self._callbacks(fileobj)
+        self._update(fileobj, reader, None)
+
+    def call_later(self, delay, callback, *args):
+        """delay秒后调用callback(*args)，返回的timer可以传给cancel"""
+        timer = [time.monotonic() + delay, next(self._timer_seq), callback, args]
+        heapq.heappush(self._timers, timer)
+        return timer
+
+    def cancel(self, timer):
+        timer[2] = None  # 惰性删除，到期时跳过
+
+    def _next_timeout(self):
+        while self._timers and self._timers[0][2] is None:
+            heapq.heappop(self._timers)
+        if not self._timers:
+            return None
+        return max(0, self._timers[0][0] - time.monotonic())
+
+    def _run_timers(self):
+        now = time.monotonic()
+        while self._timers and self._timers[0][0] <= now:
+            _, _, callback, args = heapq.heappop(self._timers)
+            if callback is not None:
+                callback(*args)
+
+    def run(self):
+        """一直运行到没有需要监视的文件描述符和定时器，或者调用了stop"""
+        self._running = True
+        while self._running and (self.selector.get_map() or self._next_timeout() is not None):
+            timeout = self._next_timeout()
+            if not self.selector.get_map():
+                time.sleep(timeout)
+                events = []
+            else:
+                events = self.selector.select(timeout)
+            for key, mask in events:
+                reader, writer = key.data
+                if mask & selectors.EVENT_READ and reader is not None:
+                    reader()
+                # 读回调可能已经注销了这个socket
+                if mask & selectors.EVENT_WRITE and writer is not None:
+                    if self._callbacks(key.fileobj)[1] is writer:
+                        writer()
+            self._run_timers()
+        self._running = False
+
+    def stop(self):
+        self._running = False
+
+    def close(self):
+        self.selector.close()
+
+
+if __name__ == '__main__':
+    import doctest
+
+    doctest.testmod()
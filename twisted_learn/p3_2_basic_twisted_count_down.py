@@ -1,6 +1,14 @@
 # -*- coding:utf-8 -*-
+import os
+
 from twisted.internet import reactor
 
+from p3_reactor_monitor import install_from_env
+from p3_timing_wheel import TimingWheel
+
+# TIMING_WHEEL=1时由时间轮安排定时器，它和reactor一样提供callLater
+clock = TimingWheel(reactor) if os.environ.get('TIMING_WHEEL') else reactor
+
 class CountDown:
     counter = 5
 
@@ -10,9 +18,10 @@ class CountDown:
         else:
             print('counter:{}'.format(self.counter))
             self.counter -= 1
-            reactor.callLater(1, self.count)
+            clock.callLater(1, self.count)
 
 
+install_from_env(reactor)  # REACTOR_MONITOR=1时统计每个callLater晚了多久
 reactor.callWhenRunning(CountDown().count)
 print('Start run')
 reactor.run()
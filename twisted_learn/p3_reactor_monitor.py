@@ -0,0 +1,213 @@
+# -*- coding:utf-8 -*-
+"""reactor事件循环的健康状况监控
+
+reactor是单线程的，任何一个回调执行得太久，所有其他的连接和定时器都要跟着等。ReactorMonitor是一个可选的监控层，
+install()之后记录：
+
+1.每个callLater实际执行的时间比预定时间晚了多少(loop lag)。
+
+2.每个回调(callLater、callWhenRunning以及I/O事件的doRead/doWrite)的执行时间直方图，按回调的名字分别统计。
+
+3.执行最慢的若干个回调，以及安排这个回调时的调用栈(I/O回调则是对应的文件描述符对象)。
+
+4.reactor每秒循环的次数，以及循环中花在执行回调上的时间比例。
+
+dump()随时可以输出这些统计。install_from_env在环境变量REACTOR_MONITOR非空时安装监控，
+收到SIGUSR1以及reactor停止时输出统计，不需要修改任何业务代码：
+
+    REACTOR_MONITOR=1 python p3_2_basic_twisted_count_down.py
+    kill -USR1 <pid>
+
+I/O回调的统计依赖于posixbase中的私有方法_doReadOrWrite(epoll/poll/select reactor都有)，没有这个方法的reactor只统计定时器。
+"""
+import collections
+import heapq
+import itertools
+import os
+import signal
+import sys
+import time
+import traceback
+
+
+def callback_name(f):
+    """
+    >>> callback_name(callback_name)
+    'callback_name'
+    >>> class CountDown:
+    ...     def count(self): pass
+    >>> callback_name(CountDown().count)
+    'CountDown.count'
+    """
+    name = getattr(f, '__qualname__', None) or getattr(f, '__name__', None) or repr(f)
+    return name.split('<locals>.')[-1]
+
+
+class Histogram(object):
+    """以2为底的对数直方图，单位是微秒：第i个桶统计[2**(i-1), 2**i)微秒的样本
+
+    >>> h = Histogram()
+    >>> for seconds in (0.000001, 0.0000015, 0.003, 0.5):
+    ...     h.add(seconds)
+    >>> h.count, h.max
+    (4, 0.5)
+    >>> h.buckets[1], h.buckets[12], h.buckets[19]
+    (2, 1, 1)
+    """
+
+    def __init__(self):
+        self.buckets = collections.Counter()
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        self.buckets[int(seconds * 1e6).bit_length()] += 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def format(self):
+        lines = []
+        for i in sorted(self.buckets):
+            upper = 1 << i
+            lines.append('    < {:>9} us: {}'.format(upper, self.buckets[i]))
+        return '\n'.join(lines)
+
+
+class ReactorMonitor(object):
+
+    def __init__(self, reactor, slowest=10, capture_stacks=True, stack_limit=4):
+        self.reactor = reactor
+        self.slowest = slowest
+        self.capture_stacks = capture_stacks
+        self.stack_limit = stack_limit
+        self.lateness = Histogram()
+        self.durations = collections.defaultdict(Histogram)
+        self._slow = []  # 最小堆，保存最慢的slowest个(耗时, 序号, 名字, 栈)
+        self._seq = itertools.count()
+        self.iterations = 0
+        self.busy = 0.0
+        self.started = None
+        self._originals = {}
+
+    def record(self, name, duration, stack):
+        self.durations[name].add(duration)
+        entry = (duration, next(self._seq), name, stack)
+        if len(self._slow) < self.slowest:
+            heapq.heappush(self._slow, entry)
+        elif duration > self._slow[0][0]:
+            heapq.heapreplace(self._slow, entry)
+
+    def _stack(self):
+        if not self.capture_stacks:
+            return None
+        # 去掉monitor自己的栈帧
+        frames = [frame for frame in traceback.extract_stack(limit=self.stack_limit + 4)
+                  if frame.filename != __file__]
+        return traceback.format_list(frames[-self.stack_limit:])
+
+    def _timed(self, f, stack, delayed_call=None):
+        """delayed_call是一个列表，callLater返回后把DelayedCall放进去。执行时才读它的getTime()，
+        回调被reset()或者delay()推迟过时，迟到的时间也是从最后的预定时间算起"""
+        name = callback_name(f)
+
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            if delayed_call:
+                self.lateness.add(max(0.0, self.reactor.seconds() - delayed_call[0].getTime()))
+            try:
+                return f(*args, **kwargs)
+            finally:
+                self.record(name, time.perf_counter() - start, stack)
+        return wrapper
+
+    def install(self):
+        reactor = self.reactor
+        self.started = time.perf_counter()
+        original_call_later = reactor.callLater
+        original_call_when_running = reactor.callWhenRunning
+        original_do_iteration = reactor.doIteration
+        self._originals = {'callLater': original_call_later,
+                           'callWhenRunning': original_call_when_running,
+                           'doIteration': original_do_iteration}
+
+        def callLater(delay, f, *args, **kwargs):
+            delayed_call = []
+            call = original_call_later(delay, self._timed(f, self._stack(), delayed_call), *args, **kwargs)
+            delayed_call.append(call)
+            return call
+
+        def callWhenRunning(f, *args, **kwargs):
+            return original_call_when_running(self._timed(f, self._stack()), *args, **kwargs)
+
+        def doIteration(delay):
+            # doIteration等待I/O事件并执行I/O回调，两次doIteration之间reactor在执行定时器
+            self.iterations += 1
+            return original_do_iteration(delay)
+
+        reactor.callLater = callLater
+        reactor.callWhenRunning = callWhenRunning
+        reactor.doIteration = doIteration
+
+        original_do_read_or_write = getattr(reactor, '_doReadOrWrite', None)
+        if original_do_read_or_write is not None:
+            self._originals['_doReadOrWrite'] = original_do_read_or_write
+
+            def _doReadOrWrite(selectable, *args):
+                start = time.perf_counter()
+                try:
+                    return original_do_read_or_write(selectable, *args)
+                finally:
+                    duration = time.perf_counter() - start
+                    self.busy += duration
+                    self.record('%s I/O' % type(selectable).__name__, duration, [repr(selectable) + '\n'])
+
+            reactor._doReadOrWrite = _doReadOrWrite
+        return self
+
+    def uninstall(self):
+        for name, original in self._originals.items():
+            setattr(self.reactor, name, original)
+        self._originals = {}
+
+    def dump(self, out=None):
+        out = out or sys.stdout
+        elapsed = time.perf_counter() - (self.started or time.perf_counter())
+        timer_busy = sum(h.total for name, h in self.durations.items() if not name.endswith(' I/O'))
+        w = out.write
+        w('=== reactor monitor: {:.1f}s ===\n'.format(elapsed))
+        if elapsed:
+            w('iterations: {} ({:.1f}/s), busy in callbacks: {:.1f}%\n'.format(
+                self.iterations, self.iterations / elapsed, 100 * (self.busy + timer_busy) / elapsed))
+        if self.lateness.count:
+            w('callLater lateness: {} calls, mean {:.3f}ms, max {:.3f}ms\n'.format(
+                self.lateness.count, 1000 * self.lateness.total / self.lateness.count, 1000 * self.lateness.max))
+            w(self.lateness.format() + '\n')
+        for name, h in sorted(self.durations.items(), key=lambda item: -item[1].total):
+            w('{}: {} calls, total {:.3f}ms, max {:.3f}ms\n'.format(name, h.count, 1000 * h.total, 1000 * h.max))
+            w(h.format() + '\n')
+        if self._slow:
+            w('slowest callbacks:\n')
+            for duration, _, name, stack in sorted(self._slow, reverse=True):
+                w('  {:.3f}ms {}\n'.format(1000 * duration, name))
+                for line in stack or []:
+                    w('    ' + line.replace('\n', '\n    ').rstrip() + '\n')
+        out.flush()
+
+
+def install_from_env(reactor, variable='REACTOR_MONITOR'):
+    """环境变量非空时安装监控：SIGUSR1时以及reactor停止前输出统计。返回monitor或None"""
+    if not os.environ.get(variable):
+        return None
+    monitor = ReactorMonitor(reactor).install()
+    if hasattr(signal, 'SIGUSR1'):
+        signal.signal(signal.SIGUSR1, lambda signum, frame: monitor.dump(sys.stderr))
+    reactor.addSystemEventTrigger('before', 'shutdown', monitor.dump, sys.stderr)
+    return monitor
+
+
+if __name__ == '__main__':
+    import doctest
+
+    doctest.testmod()
@@ -0,0 +1,220 @@
+# -*- coding:utf-8 -*-
+"""分层时间轮(hierarchical timing wheel)
+
+reactor.callLater把每个DelayedCall放进一个最小堆，安排一个定时器是O(log n)；cancel只是做个标记，
+取消的定时器多到一定程度时reactor还要重建整个堆。CountDown那样每秒重新callLater一次的定时器，
+或者每个连接一个、每收到数据就重新安排的空闲超时，数量一多这些开销就很可观了。
+
+TimingWheel把时间分成长度为tick秒的格子，定时器按到期的格子放进多层的轮子(每层是一组槽，槽是一个dict)：
+
+1.第0层有2**8个槽，每个槽是一个tick；第1层的每个槽是第0层转一圈的时间，依此类推。默认4层共2**26个tick，
+tick为10ms时可以安排7天多以内的定时器，更远的先放在最高层的最后一个槽里，转到时再重新安排。
+
+2.安排和取消都是O(1)：算出层和槽的下标放进dict，取消时从所在的dict中删除即可，不需要标记和重建。
+
+3.每过一个tick处理第0层的一个槽；第0层转完一圈时，把上一层当前槽中的定时器重新分配到下面的层(cascade)。
+
+4.TimingWheel自己只在reactor中安排一个DelayedCall，每个tick醒来一次，与定时器的数量无关；没有定时器时不会唤醒reactor。
+
+代价是精度：定时器总是在到期时间所在的tick结束时触发，不会提前，但最多晚一个tick(加上reactor本身的延迟)。
+
+TimingWheel提供IReactorTime的callLater/seconds/getDelayedCalls，返回的WheelTimer提供IDelayedCall，
+所以可以用在任何接受clock参数的地方，比如task.LoopingCall的clock属性或Deferred.addTimeout：
+
+    wheel = TimingWheel(reactor)
+    wheel.callLater(1, countdown.count)
+
+>>> from twisted.internet.task import Clock
+>>> clock = Clock()
+>>> wheel = TimingWheel(clock, tick=0.01)
+>>> fired = []
+>>> a = wheel.callLater(0.05, fired.append, 'a')
+>>> b = wheel.callLater(3, fired.append, 'b')    # 超过第0层一圈(2.56s)，放在第1层
+>>> c = wheel.callLater(1, fired.append, 'c')
+>>> c.cancel()
+>>> len(wheel), c.active()
+(2, False)
+>>> clock.advance(0.05); fired
+['a']
+>>> clock.advance(2.9); fired
+['a']
+>>> clock.advance(0.1); fired, len(wheel), clock.getDelayedCalls()
+(['a', 'b'], 0, [])
+"""
+from zope.interface import implementer
+
+from twisted.internet import error
+from twisted.internet.interfaces import IDelayedCall, IReactorTime
+from twisted.python import log
+
+
+@implementer(IDelayedCall)
+class WheelTimer(object):
+    __slots__ = ('wheel', 'time', 'expires', 'func', 'args', 'kwargs', 'slot', 'cancelled', 'called')
+
+    def __init__(self, wheel, time, func, args, kwargs):
+        self.wheel = wheel
+        self.time = time
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.expires = 0
+        self.slot = None  # 所在的槽，触发或取消后为None
+        self.cancelled = False
+        self.called = False
+
+    def getTime(self):
+        return self.time
+
+    def active(self):
+        return not (self.cancelled or self.called)
+
+    def _check(self):
+        if self.cancelled:
+            raise error.AlreadyCancelled()
+        if self.called:
+            raise error.AlreadyCalled()
+
+    def cancel(self):
+        self._check()
+        self.cancelled = True
+        self.wheel._remove(self)
+
+    def reset(self, secondsFromNow):
+        self._check()
+        self.wheel._remove(self)
+        self.time = self.wheel.seconds() + secondsFromNow
+        self.wheel._add(self)
+
+    def delay(self, secondsLater):
+        self.reset(self.time + secondsLater - self.wheel.seconds())
+
+    def __repr__(self):
+        return '<WheelTimer {} at {:.3f}>'.format(getattr(self.func, '__name__', self.func), self.time)
+
+
+@implementer(IReactorTime)
+class TimingWheel(object):
+
+    def __init__(self, reactor, tick=0.01, wheel_bits=(8, 6, 6, 6)):
+        self.reactor = reactor
+        self.tick = tick
+        self.start = reactor.seconds()
+        self.current = 0  # 下一个要处理的tick，第k个tick在start + k * tick时处理
+        self.shifts = []  # 每层的槽下标是到期tick的哪几位
+        self.limits = []  # 离现在不到limits[i]个tick的定时器放在第i层(或更低的层)
+        shift = 0
+        for bits in wheel_bits:
+            self.shifts.append(shift)
+            shift += bits
+            self.limits.append(1 << shift)
+        self.masks = [(1 << bits) - 1 for bits in wheel_bits]
+        self.span = 1 << shift
+        self.levels = [[{} for _ in range(1 << bits)] for bits in wheel_bits]
+        self.count = 0
+        self._driver = None
+
+    def __len__(self):
+        return self.count
+
+    def seconds(self):
+        return self.reactor.seconds()
+
+    def _tick_of(self, when):
+        # 向上取整时忽略浮点误差，否则0.05 / 0.01会取整成6个tick
+        ticks = (when - self.start) / self.tick
+        whole = int(ticks)
+        return whole + 1 if ticks - whole > 1e-9 else whole
+
+    def callLater(self, delay, callable, *args, **kw):
+        timer = WheelTimer(self, self.seconds() + delay, callable, args, kw)
+        self._add(timer)
+        return timer
+
+    def getDelayedCalls(self):
+        return [timer for level in self.levels for slot in level for timer in slot]
+
+    def _add(self, timer):
+        if not self.count:
+            # 轮子空着的时候不会转动，先把current追到现在，免得之后空转补上这段时间
+            self.current = max(self.current, self._tick_of(self.seconds()))
+        timer.expires = max(self.current, self._tick_of(timer.time))
+        self._place(timer)
+        self.count += 1
+        if self._driver is None:
+            self._schedule_driver()
+
+    def _place(self, timer):
+        expires = timer.expires
+        delta = expires - self.current
+        if delta < self.limits[0]:
+            slot = self.levels[0][expires & self.masks[0]]
+        else:
+            if delta >= self.span:
+                # 超出轮子范围的定时器先放在最高层最晚的槽里，cascade时会重新计算
+                expires = self.current + self.span - 1
+            level = 1
+            while delta >= self.limits[level] and level < len(self.limits) - 1:
+                level += 1
+            slot = self.levels[level][(expires >> self.shifts[level]) & self.masks[level]]
+        slot[timer] = None  # dict当作有序集合用
+        timer.slot = slot
+
+    def _remove(self, timer):
+        if timer.slot is not None:
+            del timer.slot[timer]
+            timer.slot = None
+            self.count -= 1
+        if not self.count and self._driver is not None:
+            self._driver.cancel()
+            self._driver = None
+
+    def _cascade(self, level, index):
+        slot = self.levels[level][index]
+        if slot:
+            self.levels[level][index] = {}
+            for timer in slot:
+                self._place(timer)
+
+    def _advance(self):
+        """处理第current个tick：必要时cascade，然后触发第0层当前槽中的定时器"""
+        if not self.current & self.masks[0]:
+            for level in range(1, len(self.levels)):
+                index = (self.current >> self.shifts[level]) & self.masks[level]
+                self._cascade(level, index)
+                if index:
+                    break
+        index = self.current & self.masks[0]
+        slot = self.levels[0][index]
+        self.current += 1
+        if not slot:
+            return
+        self.levels[0][index] = {}
+        for timer in list(slot):
+            if timer.slot is not slot:
+                continue  # 被同一个tick中先触发的回调取消或者reset了
+            timer.slot = None
+            self.count -= 1
+            timer.called = True
+            try:
+                timer.func(*timer.args, **timer.kwargs)
+            except Exception:
+                log.err(None, 'Unhandled error in timer {!r}'.format(timer))
+
+    def _run(self):
+        self._driver = None
+        now_tick = int((self.seconds() - self.start) / self.tick + 1e-9)
+        while self.count and self.current <= now_tick:
+            self._advance()
+        if self.count and self._driver is None:
+            self._schedule_driver()
+
+    def _schedule_driver(self):
+        delay = self.start + self.current * self.tick - self.seconds()
+        self._driver = self.reactor.callLater(max(0, delay), self._run)
+
+
+if __name__ == '__main__':
+    import doctest
+
+    doctest.testmod()
@@ -0,0 +1,104 @@
+# -*- coding:utf-8 -*-
+"""比较reactor.callLater与TimingWheel在大量定时器下的开销
+
+对每个N分别用reactor.callLater和TimingWheel.callLater做同样的事情，按每个定时器的平均耗时(微秒)报告：
+
+* schedule：安排N个定时器，到期时间在[0, --horizon)秒内均匀分布。
+* rearm：其中一半定时器取消后重新安排，也就是每次收到数据就推迟空闲超时的做法。
+* cancel：再取消一半。
+* fire：时间走到--horizon之后，触发剩下的全部定时器。
+
+为了不受真实时间的影响，reactor.seconds被换成一个手动推进的假时钟，每个阶段结束时调用一次runUntilCurrent，
+把reactor处理取消(重建堆)以及TimingWheel自己的DelayedCall的代价都算进去。
+
+`python p3_timing_wheel_bench.py -n 10000,100000,1000000`
+"""
+import gc
+import optparse
+import random
+import time
+
+from twisted.internet.selectreactor import SelectReactor
+
+from p3_timing_wheel import TimingWheel
+
+
+def parse_args():
+    usage = """usage: %prog [options]
+    Measure schedule/rearm/cancel/fire costs of reactor.callLater vs TimingWheel.
+    """
+    parser = optparse.OptionParser(usage)
+    parser.add_option('-n', '--timers', default='10000,100000,1000000',
+                      help='Comma separated live timer counts. Default is 10000,100000,1000000.')
+    parser.add_option('--horizon', type='float', default=60,
+                      help='Timers expire uniformly within this many seconds. Default is 60.')
+    parser.add_option('--tick', type='float', default=0.01,
+                      help='TimingWheel tick in seconds. Default is 0.01.')
+    options, _ = parser.parse_args()
+    options.timers = [int(n) for n in options.timers.split(',')]
+    return options
+
+
+def noop():
+    pass
+
+
+def bench(make_clock, n, horizon):
+    reactor = SelectReactor()
+    now = [0.0]
+    reactor.seconds = lambda: now[0]
+    clock = make_clock(reactor)
+    rng = random.Random(n)
+    delays = [rng.random() * horizon for _ in range(n)]
+    results = {}
+
+    def phase(name, f, count):
+        gc.collect()
+        start = time.perf_counter()
+        f()
+        reactor.runUntilCurrent()
+        results[name] = (time.perf_counter() - start) / count * 1e6
+
+    timers = []
+    phase('schedule', lambda: timers.extend(clock.callLater(d, noop) for d in delays), n)
+
+    half = rng.sample(range(n), n // 2)
+
+    def rearm():
+        for i in half:
+            timers[i].cancel()
+            timers[i] = clock.callLater(delays[i], noop)
+    phase('rearm', rearm, len(half))
+
+    def cancel():
+        for i in half:
+            timers[i].cancel()
+    phase('cancel', cancel, len(half))
+
+    def fire():
+        now[0] = horizon + 1
+    phase('fire', fire, n - len(half))
+
+    fired = sum(1 for t in timers if t.called)
+    if fired != n - len(half):
+        raise RuntimeError('{} timers fired, expected {}'.format(fired, n - len(half)))
+    reactor.disconnectAll()
+    return results
+
+
+def main():
+    options = parse_args()
+    kinds = [
+        ('callLater', lambda reactor: reactor),
+        ('wheel', lambda reactor: TimingWheel(reactor, options.tick)),
+    ]
+    print('{:>9} {:>10} {:>10} {:>10} {:>10} {:>10}'.format('timers', 'kind', 'schedule', 'rearm', 'cancel', 'fire'))
+    for n in options.timers:
+        for name, make_clock in kinds:
+            r = bench(make_clock, n, options.horizon)
+            print('{:>9} {:>10} {:>8.2f}us {:>8.2f}us {:>8.2f}us {:>8.2f}us'.format(
+                n, name, r['schedule'], r['rearm'], r['cancel'], r['fire']))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,14 +1,72 @@
 # -*- coding:utf-8 -*-
 # This is the Twisted Fast Poetry Server, version 1.0
+"""
+诗歌保存在p4_poem_store.PoemStore中，每首诗都用mmap映射。传入一个目录时，目录中的每首诗各占一个端口，
+从--port开始依次递增(没有指定--port时每首诗使用一个随机端口)。
 
-import optparse, os
+transport.write只接受bytes，直接写mmap就要先拷贝一份。所以服务器暂时让transport停止读写，由SocketWriter在
+socket可写时直接发送，发送完毕后再把连接交还给transport关闭：
 
-from twisted.internet.protocol import ServerFactory, Protocol
+* MmapWriter把mmap的memoryview切片交给socket.send，内核直接从共享的页缓存拷贝，不需要read，也没有每个连接的缓冲区。
+
+* 使用--sendfile时由SendfileWriter调用os.sendfile，数据完全不经过用户空间。
+os.sendfile不可用(或者对这个文件/socket不支持)时退回到MmapWriter。
+
+使用--named时服务器只监听一个端口，客户端连接后先发送一行诗的名字(文件名去掉扩展名，如`ecstasy\r\n`；几个文件的诗名相同时用完整的文件名，见p4_poem_store.py)，
+服务器通过目录索引找到这首诗发送给它；没有这首诗时直接关闭连接。--cache-bytes限制PoemStore中映射的总字节数。
+
+使用--framed时连接不会在发完一首诗后关闭：客户端可以连续(流水线式)发送多行诗名，服务器按请求的顺序回复，
+每个回复是一个5字节的头(1字节状态：0表示成功，1表示没有这首诗；4字节大端序的长度)加上诗的内容，
+直到客户端关闭连接。这样取很多首小诗时就不用每首都付出TCP建立和关闭连接的代价。
+
+客户端可以要求zlib压缩：--named/--framed模式下在诗名后面加上` zlib`(如`ecstasy zlib\r\n`)，
+--framed模式的回复状态为2表示内容是压缩过的；其它模式需要服务器使用--compress，服务器连接后先等客户端发来一行，
+`zlib\r\n`表示要压缩，其它内容(如空行)表示不压缩。压缩是客户端选择的：--request-window秒(默认0.2)内
+没有收到这一行就当作普通客户端，直接发送未压缩的诗，原来的客户端不需要任何改动。所有客户端都发送请求行时使用--require-request，
+不用等待不发请求的客户端，请求行来得晚的zlib客户端也不会收到未压缩的诗：服务器最多等REQUEST_TIMEOUT秒，没有请求行就关闭连接。压缩副本是Poem.compressed，每首诗只压缩一次，
+文件变化后随新的映射一起更新，发送时不再消耗CPU。
+
+请求行(格式见p1_request.py)中还可以加上range=START[:LENGTH]，只要诗的一段，服务器先回复一行
+`range START LENGTH TOTAL VERSION`再发送这一段，连接断开的客户端可以从断开的地方续传。
+--named模式总是支持range，单首诗的端口需要使用--ranges(或--compress)让服务器先等请求行；--framed模式不支持range。
+带range的回复总是通过PoemProducer发送，回复头和正文由它按顺序发出。
+
+一个reactor只能用满一个CPU核。使用--processes N时主进程启动N个工作进程，每个工作进程有自己的reactor，
+各自创建一个设置了SO_REUSEPORT的监听socket绑定到同一个端口，由内核把新连接分给这些进程。
+工作进程是重新执行本脚本得到的，而不是直接fork：reactor在import时就创建了epoll，fork出来的子进程会共用同一个epoll实例。
+诗歌用mmap映射，所有工作进程共享页缓存中的同一份数据。
+
+使用--stream时改用Twisted的生产者/消费者机制发送：PoemProducer是注册在transport上的IPushProducer，
+每次从mmap中取一块(--chunk-size字节)发送：transport的缓冲区空着时直接把memoryview切片交给socket，
+否则拷贝成bytes写给transport。transport的缓冲区超过bufferSize时调用pauseProducing，
+缓冲区发空时调用resumeProducing，所以对于读得很慢的客户端，每个连接占用的内存不超过一块加上transport的缓冲区，
+即使同时给成千上万个慢速客户端发送几个GB的文件也是如此。--framed模式总是这样发送未压缩的诗，
+一首诗发完后才处理流水线中的下一个请求，积压的请求太多时暂停读取客户端的数据。
+
+使用--metrics-port/--metrics-file时导出每个连接的字节数、首字节时间、传输时间和错误(见p1_metrics.py)，
+--processes模式下第i个工作进程使用端口--metrics-port加i。
+
+`python p4_1_fast_poetry.py --processes 4 --port 10000 --named poetry/`
+"""
+import abc, collections, errno, optparse, os, signal, socket, struct, subprocess, sys
+
+from zope.interface import implementer
+
+from twisted.internet.interfaces import IPushProducer
+from twisted.internet.protocol import ServerFactory
+from twisted.protocols.basic import LineReceiver
+from twisted.internet import error
+from twisted.internet import main as twisted_main
 from twisted.internet import reactor
 
+from p1_metrics import Metrics, add_metrics_options, start_exporters
+from p1_request import clamp_range, format_range_header, parse_request
+from p3_reactor_monitor import install_from_env
+from p4_poem_store import PoemStore
+
 
 def parse_args():
-    usage = """usage: %prog [options] poetry-file
+    usage = """usage: %prog [options] poetry-file-or-directory
             This is the Fast Poetry Server, Twisted edition.
             Run it like this:
               python fastpoetry.py <path-to-poetry-file>
@@ -23,10 +81,40 @@ def parse_args():
     parser.add_option('--host', help=h, default='localhost')
     h = "The port to listen on. Default to a random available port."
     parser.add_option('--port', type='int', help=h)
+    h = "Send the poem with os.sendfile() straight from the page cache."
+    parser.add_option('--sendfile', action='store_true', help=h, default=False)
+    h = "Serve every poem on one port, the client sends the poem name first."
+    parser.add_option('--named', action='store_true', help=h, default=False)
+    h = "Like --named, but keep the connection open and answer each request with a length-prefixed frame."
+    parser.add_option('--framed', action='store_true', help=h, default=False)
+    h = "Wait for a request line first and send a precompressed copy to clients asking for zlib."
+    parser.add_option('--compress', action='store_true', help=h, default=False)
+    h = "Wait for a request line first and honour range=START[:LENGTH] so clients can resume."
+    parser.add_option('--ranges', action='store_true', help=h, default=False)
+    h = ("Seconds --compress/--ranges wait for a request line before sending the plain poem. "
+         "Default is 0.2.")
+    parser.add_option('--request-window', type='float', help=h, default=0.2)
+    h = ("Make --compress/--ranges wait for every request line instead of falling back to the plain poem "
+         "after --request-window; clients that send none are dropped.")
+    parser.add_option('--require-request', action='store_true', help=h, default=False)
+    h = "Stream poems through a flow-controlled producer instead of taking over the socket."
+    parser.add_option('--stream', action='store_true', help=h, default=False)
+    h = "Bytes handed to the transport at a time by --stream. Default is 65536."
+    parser.add_option('--chunk-size', type='int', help=h, default=65536)
+    h = "Upper bound of mapped poem bytes kept in the cache. Default is unlimited."
+    parser.add_option('--cache-bytes', type='int', help=h)
+    h = "Run N worker processes sharing the port through SO_REUSEPORT. Needs --port. Default is 1."
+    parser.add_option('--processes', type='int', help=h, default=1)
+    parser.add_option('--worker', type='int', help=optparse.SUPPRESS_HELP, default=0)
+    add_metrics_options(parser)
 
     options, args = parser.parse_args()
     if len(args) != 1:
-        parser.error('Provide exactly one poetry file.')
+        parser.error('Provide exactly one poetry file or directory.')
+    if options.processes > 1 and not options.port:
+        parser.error('--processes needs an explicit --port.')
+    if options.processes > 1 and not hasattr(socket, 'SO_REUSEPORT'):
+        parser.error('SO_REUSEPORT is not available on this platform.')
 
     poetry_file = args[0]
     if not os.path.exists(args[0]):
@@ -34,30 +122,454 @@ def parse_args():
     return options, poetry_file
 
 
-class PoetryProtocol(Protocol):
+class SocketWriter(abc.ABC):
+    """IWriteDescriptor：接管transport的socket，可写时调用send_some发送，直到发完或者出错。
+    子类实现send_some：SendfileWriter用os.sendfile，MmapWriter发送mmap的memoryview切片"""
 
-    def connectionMade(self):
-        self.transport.write(self.factory.poem)
+    def __init__(self, transport, size, transfer=None):
+        self.transport = transport
+        self.sock = transport.getHandle()
+        self.size = size
+        self.offset = 0
+        self.transfer = transfer
+
+    def fileno(self):
+        try:
+            return self.sock.fileno()
+        except OSError:
+            return -1
+
+    @abc.abstractmethod
+    def send_some(self):
+        """从self.offset开始发送一次，返回发送的字节数；socket不可写时抛出BlockingIOError"""
+
+    def sent(self, n):
+        self.offset += n
+        if self.transfer is not None:
+            self.transfer.data(n)
+
+    def start(self):
+        """返回False表示这种发送方式不可用，调用者应换一种方式"""
+        try:
+            self.sent(self.send_some())
+        except BlockingIOError:
+            pass
+        except OSError as e:
+            if e.errno in (errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP):
+                self.close_source()
+                return False
+            self.connectionLost(e)
+            return True
+        # 由我们接管socket，避免transport同时读写同一个文件描述符
+        self.transport.stopReading()
+        self.transport.stopWriting()
+        if self.offset < self.size:
+            reactor.addWriter(self)
+        else:
+            self.finish()
+        return True
+
+    def doWrite(self):
+        while self.offset < self.size:
+            try:
+                sent = self.send_some()
+            except BlockingIOError:
+                return None
+            except OSError:
+                return twisted_main.CONNECTION_LOST
+            if not sent:  # 文件在发送过程中被截短了
+                break
+            self.sent(sent)
+        reactor.removeWriter(self)
+        self.finish()
+
+    def close_source(self):
+        pass
+
+    def finish(self):
+        self.close_source()
         self.transport.loseConnection()
 
+    def connectionLost(self, reason):
+        reactor.removeWriter(self)
+        self.close_source()
+        self.transport.abortConnection()
+
+    def logPrefix(self):
+        return 'poetry'
+
+
+class SendfileWriter(SocketWriter):
+
+    def __init__(self, transport, poetry_file, transfer=None):
+        self.file = open(poetry_file, 'rb')
+        super().__init__(transport, os.fstat(self.file.fileno()).st_size, transfer)
+
+    def send_some(self):
+        return os.sendfile(self.sock.fileno(), self.file.fileno(), self.offset, self.size - self.offset)
+
+    def close_source(self):
+        self.file.close()
+
+
+class MmapWriter(SocketWriter):
+
+    def __init__(self, transport, poem, transfer=None):
+        self.view = memoryview(poem.data)
+        super().__init__(transport, len(self.view), transfer)
+
+    def send_some(self):
+        return self.sock.send(self.view[self.offset:])
+
+    def close_source(self):
+        # 释放对mmap的引用，PoemStore重新映射后旧的映射才能被回收
+        self.view.release()
+
+
+def transport_idle(transport):
+    """transport的发送缓冲区是否已经发空。Twisted没有公开这个状态，这里读的是tcp.Connection(FileDescriptor)的属性，
+    其它transport(比如测试用的StringTransport)一律当作不空闲"""
+    try:
+        return transport.offset == len(transport.dataBuffer) and not transport._tempDataLen
+    except AttributeError:
+        return False
+
+
+@implementer(IPushProducer)
+class PoemProducer(object):
+    """按块把data写给transport，transport的缓冲区满了就暂停；发完后注销自己并调用finished()
+
+    transport.write只接受bytes，每一块都要拷贝一次。所以transport的缓冲区空着时，直接把memoryview切片交给socket
+    (header不为空时用sendmsg把它和第一块一起发出)，内核从mmap拷贝，没有中间的bytes；内核收不下的部分才拷贝后交给transport，
+    之后transport缓冲区超过bufferSize暂停本生产者，发空后再恢复，又可以直接发送了。数据的顺序不会乱。"""
+
+    def __init__(self, transport, data, chunk_size=65536, finished=None, transfer=None, header=b''):
+        self.transport = transport
+        self.view = memoryview(data)
+        self.chunk_size = chunk_size
+        self.finished = finished
+        self.transfer = transfer
+        self.header = header  # 在正文之前发送，不计入transfer
+        self.offset = 0
+        self.paused = False
+
+    def start(self):
+        self.transport.registerProducer(self, True)
+        self.resumeProducing()
+
+    def send_direct(self, chunk):
+        """返回内核接受的正文字节数，已经发出的那部分header从self.header中去掉"""
+        sock = self.transport.getHandle()
+        try:
+            if self.header:
+                n = sock.sendmsg([self.header, chunk])
+                header_sent = min(n, len(self.header))
+                self.header = self.header[header_sent:]
+                return n - header_sent
+            return sock.send(chunk)
+        except OSError:  # 包括BlockingIOError；连接的错误留给transport去发现
+            return 0
+
+    def resumeProducing(self):
+        self.paused = False
+        # transport.write在缓冲区超过bufferSize时会同步地调用pauseProducing
+        while not self.paused and self.view is not None and self.offset < len(self.view):
+            chunk = self.view[self.offset:self.offset + self.chunk_size]
+            self.offset += len(chunk)
+            if self.transfer is not None:
+                self.transfer.data(len(chunk))
+            sent = self.send_direct(chunk) if transport_idle(self.transport) else 0
+            if self.header:
+                self.transport.write(self.header)
+                self.header = b''
+            if sent < len(chunk):
+                self.transport.write(bytes(chunk[sent:]))
+        if self.view is not None and self.offset >= len(self.view):
+            if self.header:  # 空的正文
+                self.transport.write(self.header)
+                self.header = b''
+            self.transport.unregisterProducer()
+            self.stopProducing()
+            if self.finished is not None:
+                self.finished()
+
+    def pauseProducing(self):
+        self.paused = True
+
+    def stopProducing(self):
+        # 释放对mmap的引用；连接断开时transport也会调用这个方法
+        if self.view is not None:
+            self.view.release()
+            self.view = None
+
+
+def send_poem(transport, poem, sendfile=False, compress=False, stream=False, chunk_size=65536,
+              offset=None, length=None, transfer=None):
+    """transfer是p1_metrics.Transfer，统计交给内核或者transport的正文字节数"""
+    if offset is not None:
+        data = poem.compressed if compress else poem.data
+        offset, length = clamp_range(offset, length, len(data))
+        version = ('z' if compress else '') + poem.version
+        view = memoryview(data)[offset:offset + length]
+        PoemProducer(transport, view, chunk_size, transport.loseConnection, transfer,
+                     format_range_header(offset, length, len(data), version)).start()
+        return
+    if compress:
+        # 压缩副本本来就是bytes，transport直接引用它，不需要拷贝
+        if transfer is not None:
+            transfer.data(len(poem.compressed))
+        transport.write(poem.compressed)
+        transport.loseConnection()
+        return
+    if not stream:
+        if sendfile and hasattr(os, 'sendfile'):
+            if SendfileWriter(transport, poem.path, transfer).start():
+                return
+        if poem.mapped and MmapWriter(transport, poem, transfer).start():
+            return
+    PoemProducer(transport, poem.data, chunk_size, transport.loseConnection, transfer).start()
+
+
+def connection_lost(transfer, reason):
+    if not reason.check(error.ConnectionDone, error.ConnectionAborted):  # abortConnection是服务器自己断开的
+        transfer.error('lost')
+    transfer.close()
+
+
+REQUEST_TIMEOUT = 5  # --require-request时最多等待请求行的秒数
+
+
+class PoetryProtocol(LineReceiver):
+    MAX_LENGTH = 1024
+    timeout_call = None
+
+    def connectionMade(self):
+        self.transfer = self.factory.metrics.open()
+        if not (self.factory.compress or self.factory.ranges):
+            self.setRawMode()  # 发送时客户端再发来的数据都忽略
+            self.send()
+            return
+        # 等待客户端的请求行，不发请求的(原来的)客户端过一会儿就收到普通的诗，require_request时就断开
+        window = REQUEST_TIMEOUT if self.factory.require_request else self.factory.request_window
+        self.timeout_call = reactor.callLater(window, self.noRequest)
+
+    def noRequest(self):
+        if self.factory.require_request:
+            print('No request line from %s' % (self.transport.getPeer(),))
+            self.transfer.error('timeout')
+            self.transport.loseConnection()
+            return
+        self.setRawMode()
+        self.send()
+
+    def lineReceived(self, line):
+        # 只有--compress或--ranges时才会等待这一行请求，请求中的诗名被忽略
+        self.timeout_call.cancel()
+        self.setRawMode()
+        self.send(parse_request(line))
+
+    def connectionLost(self, reason):
+        if self.timeout_call is not None and self.timeout_call.active():
+            self.timeout_call.cancel()
+        connection_lost(self.transfer, reason)
+
+    def rawDataReceived(self, data):
+        pass
+
+    def send(self, request=None):
+        factory = self.factory
+        poem = factory.store.get(factory.poem_name)
+        if request is None:
+            send_poem(self.transport, poem, factory.sendfile, stream=factory.stream, chunk_size=factory.chunk_size,
+                      transfer=self.transfer)
+        else:
+            send_poem(self.transport, poem, factory.sendfile, request.compress, factory.stream, factory.chunk_size,
+                      request.offset, request.length, self.transfer)
+
+
+class NamedPoetryProtocol(LineReceiver):
+    MAX_LENGTH = 1024
+
+    def connectionMade(self):
+        self.transfer = self.factory.metrics.open()
+
+    def lineReceived(self, line):
+        request = parse_request(line)
+        try:
+            poem = self.factory.store.get(request.name)
+        except KeyError:
+            print('No such poem: %r' % request.name)
+            self.transfer.error('not_found')
+            self.transport.loseConnection()
+            return
+        self.setRawMode()  # 之后客户端再发送的数据都忽略
+        factory = self.factory
+        send_poem(self.transport, poem, factory.sendfile, request.compress, factory.stream, factory.chunk_size,
+                  request.offset, request.length, self.transfer)
+
+    def connectionLost(self, reason):
+        connection_lost(self.transfer, reason)
+
+    def rawDataReceived(self, data):
+        pass
+
+
+FRAME_HEADER = struct.Struct('!BI')
+FRAME_OK, FRAME_NOT_FOUND, FRAME_OK_ZLIB = 0, 1, 2
+
+
+class FramedPoetryProtocol(LineReceiver):
+    MAX_LENGTH = 1024
+    max_pending = 64  # 积压的请求超过这个数就暂停读取
+
+    def connectionMade(self):
+        self.requests = collections.deque()
+        self.producer = None
+        self.responding = False
+        self.reading_paused = False
+        self.transfer = self.factory.metrics.open()
+
+    def lineReceived(self, line):
+        self.requests.append(parse_request(line))
+        if len(self.requests) > self.max_pending and not self.reading_paused:
+            self.reading_paused = True
+            self.transport.pauseProducing()
+        self.respond()
+
+    def respond(self):
+        # 请求按到达的顺序处理，一首诗的帧全部交给transport之后才处理下一个请求，所以回复的顺序与请求一致
+        if self.responding:
+            return
+        self.responding = True
+        try:
+            while self.requests and self.producer is None:
+                name, compress = self.requests.popleft()[:2]
+                try:
+                    poem = self.factory.store.get(name)
+                except KeyError:
+                    self.transfer.error('not_found')
+                    self.transport.write(FRAME_HEADER.pack(FRAME_NOT_FOUND, 0))
+                    continue
+                if compress:
+                    data = poem.compressed
+                    self.transfer.data(len(data))
+                    self.transport.writeSequence([FRAME_HEADER.pack(FRAME_OK_ZLIB, len(data)), data])
+                    continue
+                # 帧头和mmap的切片一起直接交给socket，见PoemProducer
+                self.producer = PoemProducer(self.transport, poem.data, self.factory.chunk_size,
+                                             self.producerFinished, self.transfer,
+                                             FRAME_HEADER.pack(FRAME_OK, len(poem)))
+                self.producer.start()
+        finally:
+            self.responding = False
+        if self.reading_paused and len(self.requests) <= self.max_pending // 2:
+            self.reading_paused = False
+            self.transport.resumeProducing()
+
+    def producerFinished(self):
+        # 小诗在start()中就发完了，这时由respond中的循环继续处理下一个请求
+        self.producer = None
+        self.respond()
+
+    def connectionLost(self, reason):
+        self.requests.clear()
+        connection_lost(self.transfer, reason)
+
 
 class PoetryFactory(ServerFactory):
     protocol = PoetryProtocol
 
-    def __init__(self, poem):
-        self.poem = poem
+    def __init__(self, store, poem_name, sendfile=False, compress=False, stream=False, chunk_size=65536,
+                 ranges=False, metrics=None, request_window=0.2, require_request=False):
+        self.store = store
+        self.request_window = request_window
+        self.require_request = require_request
+        self.metrics = metrics or Metrics('p4_1_fast_poetry', 'server')
+        self.poem_name = poem_name
+        self.sendfile = sendfile
+        self.compress = compress
+        self.ranges = ranges
+        self.stream = stream
+        self.chunk_size = chunk_size
 
 
-def main():
-    options, poetry_file = parse_args()
+class NamedPoetryFactory(ServerFactory):
+    protocol = NamedPoetryProtocol
+
+    def __init__(self, store, sendfile=False, stream=False, chunk_size=65536, metrics=None):
+        self.store = store
+        self.metrics = metrics or Metrics('p4_1_fast_poetry', 'server')
+        self.sendfile = sendfile
+        self.stream = stream
+        self.chunk_size = chunk_size
 
-    f = open(poetry_file, 'rb')
-    poem = f.read()
-    f.close()
 
-    factory = PoetryFactory(poem)
-    port = reactor.listenTCP(options.port, factory, interface=options.host)
-    print('Serving %s on %s.' % (poetry_file, port.getHost()))
+class FramedPoetryFactory(ServerFactory):
+    protocol = FramedPoetryProtocol
+
+    def __init__(self, store, chunk_size=65536, metrics=None):
+        self.store = store
+        self.metrics = metrics or Metrics('p4_1_fast_poetry', 'server')
+        self.chunk_size = chunk_size
+
+
+def listen(port, factory, interface, reuse_port=False):
+    if not reuse_port:
+        return reactor.listenTCP(port, factory, interface=interface)
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((interface, port))
+    sock.listen(128)
+    sock.setblocking(False)
+    listening_port = reactor.adoptStreamPort(sock.fileno(), socket.AF_INET, factory)
+    sock.close()  # adoptStreamPort复制了文件描述符
+    return listening_port
+
+
+def run_workers(count):
+    """启动count个工作进程，把SIGINT/SIGTERM转发给它们，等它们全部退出"""
+    cmd = [sys.executable, os.path.abspath(__file__)] + sys.argv[1:]
+    workers = [subprocess.Popen(cmd + ['--worker', str(i)]) for i in range(1, count + 1)]
+
+    def stop(signum, frame):
+        for worker in workers:
+            if worker.poll() is None:
+                worker.send_signal(signal.SIGTERM)
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+    for worker in workers:
+        worker.wait()
+
+
+def main():
+    options, poetry_source = parse_args()
+    if options.processes > 1 and not options.worker:
+        run_workers(options.processes)
+        return
+
+    install_from_env(reactor)
+    metrics = start_exporters(options, Metrics('p4_1_fast_poetry', 'server'), options.worker)
+    reuse_port = bool(options.worker)
+    prefix = '[worker %d] ' % os.getpid() if options.worker else ''
+    store = PoemStore(poetry_source, max_bytes=options.cache_bytes)
+    reactor.addSystemEventTrigger('before', 'shutdown', lambda: print(prefix + store.stats()))
+    if options.named or options.framed:
+        if options.framed:
+            factory = FramedPoetryFactory(store, options.chunk_size, metrics)
+        else:
+            factory = NamedPoetryFactory(store, options.sendfile, options.stream, options.chunk_size, metrics)
+        port = listen(options.port or 0, factory, options.host, reuse_port)
+        print(prefix + 'Serving %d poems from %s on %s.' % (len(store.names()), poetry_source, port.getHost()))
+    else:
+        for i, name in enumerate(store.names()):
+            factory = PoetryFactory(store, name, options.sendfile, options.compress,
+                                    options.stream, options.chunk_size, options.ranges, metrics,
+                                    options.request_window, options.require_request)
+            port_num = options.port + i if options.port else 0
+            port = listen(port_num, factory, options.host, reuse_port)
+            print(prefix + 'Serving %s on %s.' % (store.get(name).path, port.getHost()))
     reactor.run()
 
 
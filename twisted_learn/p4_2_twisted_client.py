@@ -6,12 +6,43 @@ It uses low-level Twisted APIs as a learning exercise.
 我们开始学习使用Twisted时会使用一些低层Twisted的APIs。这样做是为揭去Twisted的抽象层，这样我们就可以从内向外的来
 学习Twisted。记住一点就行：这些代码只是用作练习，而不是写真实软件的例子。
 
+地址写成[hostname:]port/poem时，连接后先发送一行poem(诗的名字)，用于`p4_1_fast_poetry.py --named`服务器：
+  python p4_2_twisted_client.py 10000/ecstasy 10000/science
+
+PoetrySocket非阻塞地发起连接：先用connect_ex发起TCP握手，把自己作为writer交给reactor，socket可写时检查SO_ERROR，
+连接成功后再发送请求、改为监视读事件。超过--connect-timeout还没有连上就放弃。这样所有连接的握手是同时进行的。
+
+使用--framed时对应`p4_1_fast_poetry.py --framed`服务器：ConnectionPool为每个地址最多保持--connections个长连接，
+同一个地址的多首诗在这些连接上流水线式地请求，按长度前缀拆分回复，不再每首诗都建立一次连接。
+这些长连接也是非阻塞地建立的，连不上的地址上的请求都算作没有得到这首诗：
+  python p4_2_twisted_client.py --framed 10000/ecstasy 10000/science 10000/fascination
+
+使用--zlib时请求zlib压缩的诗：有诗名时请求行是`poem zlib`，没有诗名时发送一行`zlib`(服务器需要使用--compress)。
+doRead每读到一块数据就由ZlibReceiveBuffer增量解压；--framed模式下压缩的回复(状态2)收齐一帧后解压。
+
+使用--output-dir时PoetrySocket用StreamReceiver代替ReceiveBuffer，doRead读到的每块数据直接流过p1_pipeline的管道，
+逐行写到output-dir/poem-N.txt，见p1_async_client.py。
+
+使用--resume N时请求行带上range=已经收到的字节数(服务器需要使用--ranges)：连接失败、超时或者中途断开后，
+connectionLost用同一个PoetrySocket重新连接，最多N次，只下载还缺少的部分。--framed模式不支持续传。
+
+使用--metrics-port/--metrics-file时导出收到的字节数、首字节时间、传输时间和各种错误(见p1_metrics.py)：
+每个PoetrySocket(包括续传)是一个Transfer，--framed模式下每个请求是一个Transfer。
+
 """
-import datetime, errno, optparse, socket
+import collections, datetime, errno, optparse, os, socket, zlib
 
-from twisted.internet import main
+from twisted.internet import error, main
 from twisted.internet import reactor
 
+from p1_async_client import format_compression, format_failure, format_failures, stream_receivers
+from p1_buffer_pool import BufferPool, ReceiveBuffer, ZlibReceiveBuffer
+from p1_metrics import Metrics, add_metrics_options, start_exporters
+from p1_pipeline import format_stats
+from p3_reactor_monitor import install_from_env
+from p1_request import RangeError, RangeReceiver, format_request
+from p4_1_fast_poetry import FRAME_HEADER, FRAME_OK, FRAME_OK_ZLIB
+
 
 def parse_args():
     usage = """usage: %prog [options] [hostname]:port ...
@@ -26,12 +57,29 @@ def parse_args():
         for that to work.
         """
     parser = optparse.OptionParser(usage)
-    _, addresses = parser.parse_args()
+    h = "Fetch [hostname:]port/poem requests over persistent length-prefixed connections."
+    parser.add_option('--framed', action='store_true', help=h, default=False)
+    h = "Connections kept open per address in --framed mode. Default is 1."
+    parser.add_option('--connections', type='int', help=h, default=1)
+    h = "Seconds to wait for each connection to be established. Default is 10."
+    parser.add_option('--connect-timeout', type='float', help=h, default=10)
+    h = "Ask the servers for zlib-compressed poems."
+    parser.add_option('--zlib', action='store_true', help=h, default=False)
+    h = "Stream every poem line by line into OUTPUT_DIR/poem-N.txt instead of keeping it in memory."
+    parser.add_option('--output-dir', help=h)
+    h = ("Reconnect up to RETRIES times after a broken download and fetch only the missing bytes "
+         "(servers must run with --ranges). Default is 0.")
+    parser.add_option('--resume', type='int', metavar='RETRIES', help=h, default=0)
+    add_metrics_options(parser)
+    options, addresses = parser.parse_args()
     if not addresses:
         print(parser.format_help())
         parser.exit()
 
     def parse_address(addr):
+        poem_name = None
+        if '/' in addr:
+            addr, poem_name = addr.split('/', 1)
         if ':' not in addr:
             host = '127.0.0.1'
             port = addr
@@ -39,24 +87,76 @@ def parse_args():
             host, port = addr.split(':', 1)
         if not port.isdigit():
             parser.error('Ports must be integers.')
-        return host, int(port)
+        if options.framed and poem_name is None:
+            parser.error('--framed needs [hostname:]port/poem addresses.')
+        return (host, int(port)), poem_name
 
-    return list(map(parse_address, addresses))
+    return options, list(map(parse_address, addresses))
 
 
 class PoetrySocket(object):
-    poem = b''
 
-    def __init__(self, task_num, address):
+    def __init__(self, task_num, address, pool=None, poem_name=None, connect_timeout=10, compress=False,
+                 receiver=None, resume=0, metrics=None):
         self.task_num = task_num
         self.address = address
+        self.poem_name = poem_name
+        self.compress = compress
+        self.connect_timeout = connect_timeout
+        self.resume = resume
+        if receiver is None:
+            pool = pool or BufferPool()
+            receiver = ZlibReceiveBuffer(pool) if compress else ReceiveBuffer(pool)
+        self.poem = receiver
+        # 续传时由RangeReceiver读掉每个连接的range回复头，再把正文交给self.poem
+        self.reader = RangeReceiver(receiver) if resume else receiver
+        self.transfer = (metrics or Metrics('p4_2_twisted_client', 'client')).open()
+        self.error = None  # 失败时是错误种类，这时poem只是收到的那一部分
+        self.connect()
+
+    def fail(self, kind):
+        self.transfer.error(kind)
+        self.error = kind
+
+    def connect(self):
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.sock.connect(address)
         self.sock.setblocking(0)
+        self.connecting = True
+        err = self.sock.connect_ex(self.address)
+        if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            self.sock.close()
+            raise socket.error(err, os.strerror(err))
+
+        # socket可写时三次握手就结束了
+        reactor.addWriter(self)
+        self.timeout_call = reactor.callLater(self.connect_timeout, self.connectTimedOut)
+
+    def doWrite(self):
+        """IWriteDescriptor：只用来等待非阻塞的connect完成"""
+        self.connecting = False
+        self.timeout_call.cancel()
+        reactor.removeWriter(self)
+        err = self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if err:
+            print('Task %d: failed to connect to %s: %s' % (self.task_num, self.format_addr(), os.strerror(err)))
+            self.fail('connect')
+            return main.CONNECTION_LOST
+        # 请求只有一行，一定能放进刚建立的连接的发送缓冲区
+        if self.resume:
+            self.sock.send(self.reader.request(self.poem_name, self.compress))
+        elif self.poem_name is not None or self.compress:
+            self.sock.send(format_request(self.poem_name, self.compress))
 
         # tell the Twisted reactor to monitor this socket for reading
         reactor.addReader(self)
 
+    def connectTimedOut(self):
+        print('Task %d: connection to %s timed out' % (self.task_num, self.format_addr()))
+        self.fail('timeout')
+        self.connecting = False
+        reactor.removeWriter(self)
+        self.connectionLost(error.TimeoutError())
+
     def fileno(self):
         """IReadDescriptor是IFileDescriptor的一个子类"""
         try:
@@ -66,15 +166,38 @@ class PoetrySocket(object):
 
     def connectionLost(self, reason):
         """IReadDescriptor是IFileDescriptor的一个子类"""
+        if self.connecting:
+            # 连接失败时reactor可能不调用doWrite，而是直接调用connectionLost
+            print('Task %d: failed to connect to %s' % (self.task_num, self.format_addr()))
+            self.fail('connect')
+            self.connecting = False
+            if self.timeout_call.active():
+                self.timeout_call.cancel()
         self.sock.close()
 
         # stop monitoring this socket
         from twisted.internet import reactor
         reactor.removeReader(self)
+        reactor.removeWriter(self)
 
-        # see if there are any poetry sockets left
-        for reader in reactor.getReaders():
-            if isinstance(reader, PoetrySocket):
+        if self.resume and self.reader.can_resume(self.resume):
+            print('Task %d: resuming from byte %d (retry %d)' % (self.task_num, self.reader.received,
+                                                                 self.reader.retries))
+            try:
+                self.connect()
+                return
+            except socket.error as e:
+                print('Task %d: failed to reconnect: %s' % (self.task_num, e))
+                self.fail('connect')
+        if self.resume and not self.reader.complete:
+            self.fail('incomplete')
+        elif self.resume:
+            self.error = None  # 中途出过错，但续传完成了
+        self.transfer.close()
+
+        # see if there are any poetry sockets left, still connecting or reading
+        for selectable in reactor.getReaders() + reactor.getWriters():
+            if isinstance(selectable, PoetrySocket):
                 return
         reactor.stop()  # no more poetry
 
@@ -85,26 +208,37 @@ class PoetrySocket(object):
         这也是Twisted框架中的惯例——不是直接传递实现某个接口的函数而是传递实现它的对象。这样我们通过一个
         对象参数就可以传递一组相关的回调函数。而且也可以让回调函数之间通过存储在对象中的数据进行通信。
         """
-        data = b''
+        received = 0
+        done = False  # 只读到range回复头时received为0但连接还在
         while True:
             try:
-                buff = self.sock.recv(1024)
-                if not buff:
+                n = self.reader.recv_into(self.sock)
+                if not n:
+                    done = True
                     break
                 else:
-                    data += buff
+                    received += n
+                    self.transfer.data(n)
+            except zlib.error as e:
+                print('Task %d: corrupt compressed poetry: %s' % (self.task_num, e))
+                self.fail('zlib')
+                return main.CONNECTION_LOST
+            except RangeError as e:
+                print('Task %d: cannot resume: %s' % (self.task_num, e))
+                self.fail('range')
+                return main.CONNECTION_LOST
             except socket.error as e:
                 if e.args[0] == errno.EWOULDBLOCK:
                     break
+                self.fail('lost')
                 return main.CONNECTION_LOST
 
-        if not data:
+        if done:
             print('Task %d finished' % self.task_num)
             return main.CONNECTION_DONE
-        else:
+        elif received:
             msg = 'Task %d: got %d bytes of poetry from %s'
-            print(msg % (self.task_num, len(data), self.format_addr()))
-        self.poem += data
+            print(msg % (self.task_num, received, self.format_addr()))
 
     def logPrefix(self):
         """IFileDescriptor继承了ILooggingContext"""
@@ -115,15 +249,227 @@ class PoetrySocket(object):
         return '%s:%s' % (host or '127.0.0.1', port)
 
 
+class FramedPoetryConnection(object):
+    """一个长连接：request可以连续调用，回复按请求的顺序到达，callback(name, poem)中poem为None表示没有这首诗
+
+    和PoetrySocket一样非阻塞地发起连接，连上之前的请求先放在outgoing中，连上后由doWrite一起发出。
+    连接失败或者超时时由connectionLost让所有还在等待的callback得到None。
+    """
+
+    def __init__(self, address, recv_size=65536, compress=False, metrics=None, connect_timeout=10):
+        self.address = address
+        self.recv_size = recv_size
+        self.compress = compress
+        self.metrics = metrics or Metrics('p4_2_twisted_client', 'client')
+        self.pending = collections.deque()
+        self.outgoing = bytearray()
+        self.incoming = bytearray()
+        self.connected = True
+        self.connecting = True
+        self.failure = 'lost'  # 断开时还在等待的请求记为这种错误
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setblocking(0)
+        err = self.sock.connect_ex(address)
+        if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            # 调用者还在排队请求，下一轮reactor循环再断开，让这些请求的callback都得到None
+            print('Failed to connect to %s:%s: %s' % (address + (os.strerror(err),)))
+            self.failure = 'connect'
+            self.timeout_call = reactor.callLater(0, self.connectionLost, error.ConnectError())
+            return
+        reactor.addWriter(self)
+        self.timeout_call = reactor.callLater(connect_timeout, self.connectTimedOut)
+
+    def fileno(self):
+        try:
+            return self.sock.fileno()
+        except socket.error:
+            return -1
+
+    def request(self, name, callback):
+        self.pending.append((name, callback, self.metrics.open()))
+        self.outgoing += name.encode('utf-8') + (b' zlib\r\n' if self.compress else b'\r\n')
+        if self.connecting:  # 连上之后doWrite会发出来
+            return
+        if self.doWrite() is not None:  # 不是由reactor调用的，出错时要自己断开
+            self.connectionLost(error.ConnectionLost())
+
+    def connectTimedOut(self):
+        print('Connection to %s:%s timed out' % self.address)
+        self.failure = 'timeout'
+        self.connectionLost(error.TimeoutError())
+
+    def doWrite(self):
+        if self.connecting:
+            # socket可写时三次握手就结束了
+            self.connecting = False
+            self.timeout_call.cancel()
+            err = self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if err:
+                print('Failed to connect to %s:%s: %s' % (self.address + (os.strerror(err),)))
+                self.failure = 'connect'
+                return main.CONNECTION_LOST
+            reactor.addReader(self)
+        try:
+            sent = self.sock.send(self.outgoing)
+        except socket.error as e:
+            if e.args[0] != errno.EWOULDBLOCK:
+                return main.CONNECTION_LOST
+            sent = 0
+        del self.outgoing[:sent]
+        if self.outgoing:
+            reactor.addWriter(self)
+        else:
+            reactor.removeWriter(self)
+
+    def doRead(self):
+        while True:
+            try:
+                buff = self.sock.recv(self.recv_size)
+            except socket.error as e:
+                if e.args[0] == errno.EWOULDBLOCK:
+                    break
+                return main.CONNECTION_LOST
+            if not buff:
+                return main.CONNECTION_DONE
+            if self.pending:
+                # 一次读到的数据可能跨过两个回复，都算在最早的请求上，总字节数不受影响
+                self.pending[0][2].data(len(buff))
+            self.incoming += buff
+        return self.parse_frames()
+
+    def parse_frames(self):
+        """处理收齐的回复帧；服务器发来没有请求过的帧时返回CONNECTION_LOST"""
+        header_size = FRAME_HEADER.size
+        while len(self.incoming) >= header_size:
+            status, length = FRAME_HEADER.unpack_from(self.incoming)
+            if len(self.incoming) < header_size + length:
+                break
+            if not self.pending:
+                print('Protocol error: unexpected frame from %s:%s' % self.address)
+                with self.metrics.lock:
+                    self.metrics.errors['protocol'] += 1
+                return main.CONNECTION_LOST
+            poem = bytes(self.incoming[header_size:header_size + length])
+            del self.incoming[:header_size + length]
+            name, callback, transfer = self.pending.popleft()
+            transfer.close()
+            if status == FRAME_OK_ZLIB:
+                callback(name, zlib.decompress(poem))
+            else:
+                if status != FRAME_OK:
+                    transfer.error('not_found')
+                callback(name, poem if status == FRAME_OK else None)
+
+    def close(self):
+        self.connectionLost(None)
+
+    def connectionLost(self, reason):
+        if not self.connected:
+            return
+        self.connected = False
+        if self.connecting:
+            # 连接失败时reactor可能不调用doWrite，而是直接调用connectionLost
+            if self.failure == 'lost':
+                print('Failed to connect to %s:%s' % self.address)
+                self.failure = 'connect'
+            self.connecting = False
+        if self.timeout_call.active():
+            self.timeout_call.cancel()
+        reactor.removeReader(self)
+        reactor.removeWriter(self)
+        self.sock.close()
+        while self.pending:  # 连接断开时还没收到回复的请求都算失败
+            name, callback, transfer = self.pending.popleft()
+            transfer.error(self.failure)
+            transfer.close()
+            callback(name, None)
+
+    def logPrefix(self):
+        return 'poetry'
+
+
+class ConnectionPool(object):
+    """按地址保存FramedPoetryConnection，每个地址最多max_per_address个连接，请求交给排队最短的连接"""
+
+    def __init__(self, max_per_address=1, compress=False, metrics=None, connect_timeout=10):
+        self.max_per_address = max_per_address
+        self.connect_timeout = connect_timeout
+        self.compress = compress
+        self.metrics = metrics
+        self.connections = {}
+
+    def get(self, address):
+        conns = [c for c in self.connections.get(address, []) if c.connected]
+        if len(conns) < self.max_per_address and all(c.pending for c in conns):
+            conns.append(FramedPoetryConnection(address, compress=self.compress, metrics=self.metrics,
+                                               connect_timeout=self.connect_timeout))
+        self.connections[address] = conns
+        return min(conns, key=lambda c: len(c.pending))
+
+    def fetch(self, address, name, callback):
+        self.get(address).request(name, callback)
+
+    def close(self):
+        for conns in self.connections.values():
+            for conn in conns:
+                conn.close()
+        self.connections.clear()
+
+
+def framed_main(options, addresses, metrics=None):
+    start = datetime.datetime.now()
+    pool = ConnectionPool(options.connections, options.zlib, metrics, options.connect_timeout)
+    poems = [None] * len(addresses)
+    remaining = [len(addresses)]
+
+    def make_callback(task_num, address):
+        def got_poem(name, poem):
+            poems[task_num - 1] = poem
+            if poem is None:
+                print('Task %d: no poem %r from %s:%s' % ((task_num, name) + address))
+            remaining[0] -= 1
+            if not remaining[0]:
+                pool.close()
+                reactor.stop()
+        return got_poem
+
+    for i, (address, name) in enumerate(addresses, start=1):
+        pool.fetch(address, name, make_callback(i, address))
+    reactor.run()
+    elapsed = datetime.datetime.now() - start
+    for i, poem in enumerate(poems, start=1):
+        print('Task %d: %d bytes of poetry' % (i, len(poem or b'')))
+    print('Got %d poems in %s' % (len(addresses) - poems.count(None), elapsed))
+
+
 def poetry_main():
-    addresses = parse_args()
+    options, addresses = parse_args()
+    install_from_env(reactor)
+    metrics = start_exporters(options, Metrics('p4_2_twisted_client', 'client'))
+    if options.framed:
+        return framed_main(options, addresses, metrics)
     start = datetime.datetime.now()
-    sockets = [PoetrySocket(i, addr) for i, addr in enumerate(addresses, start=1)]
+    pool = BufferPool()
+    receivers = [None] * len(addresses)
+    if options.output_dir:
+        receivers = stream_receivers(options.output_dir, len(addresses), pool, options.zlib)
+    sockets = [PoetrySocket(i, addr, pool, name, options.connect_timeout, options.zlib, receiver, options.resume,
+                            metrics)
+               for i, ((addr, name), receiver) in enumerate(zip(addresses, receivers), start=1)]
     reactor.run()
     elapsed = datetime.datetime.now() - start
+    errors = dict((sock, sock.error) for sock in sockets if sock.error is not None)
     for i, sock in enumerate(sockets):
-        print('Task %d: %d bytes of poetry' % (i + 1, len(sock.poem)))
-    print('Got %d poems in %s' % (len(addresses), elapsed))
+        print('Task %d: %d bytes of poetry' % (i + 1, len(sock.poem)) + format_failure(sock.error))
+    print('Got %d poems in %s' % (len(addresses) - len(errors), elapsed) + format_failures(errors))
+    print(pool.report())
+    poetry_bytes = sum(len(sock.poem) for sock in sockets)
+    for sock in sockets:
+        sock.poem.release()  # 关闭管道和文件，或者把arena还给池子
+    if options.output_dir:
+        print(format_stats(sock.poem.pipeline for sock in sockets))
+    elif options.zlib:
+        print(format_compression(poetry_bytes, pool.bytes_received))
 
 
 if __name__ == '__main__':
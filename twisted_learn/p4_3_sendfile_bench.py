@@ -0,0 +1,115 @@
+# -*- coding:utf-8 -*-
+"""比较两个诗歌服务器在普通读写模式与sendfile模式下的吞吐量
+
+先把poetry/ecstasy.txt重复拼接成一首很大的诗，然后分别以普通模式和--sendfile模式启动p1_blocking_server.py
+和p4_1_fast_poetry.py，用一个只负责收数据的客户端下载若干次，取最好的一次计算吞吐量。
+
+`python p4_3_sendfile_bench.py --size 512`
+"""
+import optparse
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+SERVERS = [
+    ('blocking read/sendall', ['p1_blocking_server.py', '-d', '0', '-b', '65536']),
+    ('blocking sendfile', ['p1_blocking_server.py', '-d', '0', '-b', '65536', '--sendfile']),
+    ('twisted mmap send', ['p4_1_fast_poetry.py']),
+    ('twisted sendfile', ['p4_1_fast_poetry.py', '--sendfile']),
+]
+
+
+def parse_args():
+    usage = """usage: %prog [options]
+    Compare poetry server throughput with and without sendfile().
+    """
+    parser = optparse.OptionParser(usage)
+    parser.add_option('-s', '--size', type='int', default=256,
+                      help='Size of the generated poem in MB. Default is 256.')
+    parser.add_option('-r', '--repeat', type='int', default=3,
+                      help='Downloads per server, the best one is reported. Default is 3.')
+    options, _ = parser.parse_args()
+    return options
+
+
+def make_poem(directory, size_mb):
+    with open(os.path.join(HERE, 'poetry', 'ecstasy.txt'), 'rb') as f:
+        stanza = f.read()
+    path = os.path.join(directory, 'big_ecstasy.txt')
+    block = stanza * ((1 << 20) // len(stanza) + 1)
+    with open(path, 'wb') as f:
+        written = 0
+        while written < size_mb << 20:
+            chunk = block[:(size_mb << 20) - written]
+            f.write(chunk)
+            written += len(chunk)
+    return path
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def wait_for(port, timeout=10):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port)).close()
+            return
+        except ConnectionRefusedError:
+            time.sleep(0.05)
+    raise RuntimeError('server on port {} did not start'.format(port))
+
+
+def download(port):
+    """只计数不保存，避免客户端本身成为瓶颈"""
+    buff = memoryview(bytearray(1 << 20))
+    sock = socket.create_connection(('127.0.0.1', port))
+    received = 0
+    start = time.perf_counter()
+    while True:
+        n = sock.recv_into(buff)
+        if not n:
+            break
+        received += n
+    elapsed = time.perf_counter() - start
+    sock.close()
+    return received, elapsed
+
+
+def main():
+    options = parse_args()
+    directory = tempfile.mkdtemp()
+    try:
+        poem = make_poem(directory, options.size)
+        print('{:>24} {:>10} {:>12}'.format('server', 'MB', 'MB/s'))
+        for name, args in SERVERS:
+            port = free_port()
+            cmd = [sys.executable, os.path.join(HERE, args[0]), '--port', str(port)] + args[1:] + [poem]
+            server = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            try:
+                wait_for(port)
+                # wait_for本身也连了一次，阻塞服务器要先把那一首诗发完
+                best = min((download(port) for _ in range(options.repeat)), key=lambda r: r[1])
+            finally:
+                server.kill()
+                server.wait()
+            received, elapsed = best
+            mb = received / float(1 << 20)
+            print('{:>24} {:>10.1f} {:>12.1f}'.format(name, mb, mb / elapsed))
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,304 @@
+# -*- coding:utf-8 -*-
+"""诗歌服务器/客户端的端到端压测
+
+在本机回环地址上为每种服务器启动N个实例，再用每种客户端并发下载M首诗(M个下载按轮询分配到N个服务器上)，
+统计总吞吐量、延迟分位数(p50/p95/p99)、CPU时间和内存峰值(RSS)，结果写成JSON，方便比较不同版本之间有没有性能回退。
+
+* 每个客户端在单独的子进程中运行(Twisted的reactor不能重启)，CPU时间和内存峰值来自os.wait4返回的rusage。
+* 服务器的CPU时间是压测前后/proc/<pid>/stat的差值，内存峰值是/proc/<pid>/status中的VmHWM，因此只支持Linux。
+* 延迟是从这一批下载开始到每个下载完成的时间。阻塞客户端一次只下载一首诗，它的延迟自然会依次变大。
+* p1_blocking_server的监听队列默认只有5，并发客户端的连接会被丢掉再等SYN重传，测出来的是重传的延迟而不是传输，
+所以启动它时--backlog至少是这一批下载的个数。
+
+`python p4_4_poetry_bench.py --servers 4 --downloads 200 --output bench.json`
+"""
+import contextlib
+import json
+import optparse
+import os
+import platform
+import socket
+import subprocess
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+SERVERS = {
+    'blocking': ['p1_blocking_server.py', '-d', '0', '-b', '4096'],
+    'threaded': ['p1_blocking_server.py', '-d', '0', '-b', '4096', '-w', '16'],
+    'sendmsg': ['p1_blocking_server.py', '-d', '0', '-b', '4096', '--sendmsg', '16'],
+    'fast': ['p4_1_fast_poetry.py'],
+    'paced': ['p1_paced_server.py', '-d', '0', '-b', '4096'],
+}
+
+CLIENTS = ['blocking', 'async', 'selector', 'asyncio', 'twisted']
+
+
+def parse_args():
+    usage = """usage: %prog [options]
+    Benchmark every poetry client against every poetry server on loopback.
+    """
+    parser = optparse.OptionParser(usage)
+    parser.add_option('-n', '--servers', type='int', default=4,
+                      help='Server instances started per server kind. Default is 4.')
+    parser.add_option('-m', '--downloads', type='int', default=100,
+                      help='Concurrent downloads per client run. Default is 100.')
+    parser.add_option('--server-kinds', default=','.join(sorted(SERVERS)),
+                      help='Comma separated server kinds. Default is all of them.')
+    parser.add_option('--clients', default=','.join(CLIENTS),
+                      help='Comma separated client kinds. Default is all of them.')
+    parser.add_option('--poem', default=os.path.join(HERE, 'poetry', 'ecstasy.txt'),
+                      help='The poetry file to serve. Default is poetry/ecstasy.txt.')
+    parser.add_option('-o', '--output', default='poetry_bench.json',
+                      help='Where to write the JSON results. Default is poetry_bench.json.')
+    # 子进程模式，内部使用，服务器地址从标准输入读取
+    parser.add_option('--run-client', help=optparse.SUPPRESS_HELP)
+    options, _ = parser.parse_args()
+    return options
+
+
+def percentile(sorted_values, p):
+    """最近秩(nearest-rank)法
+
+    >>> percentile([1, 2, 3, 4, 5, 6, 7, 8, 9, 10], 95)
+    10
+    >>> percentile([1, 2, 3, 4, 5, 6, 7, 8, 9, 10], 50)
+    5
+    """
+    if not sorted_values:
+        return None
+    rank = max(1, -(-len(sorted_values) * p // 100))
+    return sorted_values[int(rank) - 1]
+
+
+# ---------- 子进程：运行一种客户端 ----------
+
+def parse_address(addr):
+    host, port = addr.split(':', 1)
+    return host, int(port)
+
+
+class TimedSocket(socket.socket):
+    """select/selectors客户端读到EOF时会close socket，借此记录每个下载的完成时间；
+    连接失败或者被重置时也会close，这些下载由get_poetry的errors排除"""
+    closed_at = None
+
+    def close(self):
+        if self.closed_at is None:
+            self.closed_at = time.perf_counter()
+        super().close()
+
+
+def connect_timed(address):
+    sock = TimedSocket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setblocking(0)
+    sock.connect_ex(address)  # 与p1_async_client.connect一样非阻塞地连接
+    return sock
+
+
+def run_blocking(addresses):
+    import p1_blocking_client
+    start = time.perf_counter()
+    sizes, done = [], []
+    for address in addresses:
+        try:
+            sizes.append(len(p1_blocking_client.get_poetry(address)))
+            done.append(time.perf_counter())
+        except OSError:
+            sizes.append(0)
+            done.append(None)
+    return start, sizes, done
+
+
+def run_select(module_name, addresses):
+    module = __import__(module_name)
+    start = time.perf_counter()
+    sockets = [connect_timed(address) for address in addresses]
+    errors = {}
+    poems = module.get_poetry(sockets, connect_timeout=30, errors=errors)
+    return start, [len(poems[s]) for s in sockets], [None if s in errors else s.closed_at for s in sockets]
+
+
+def run_asyncio(addresses):
+    import asyncio
+    import p1_asyncio_client
+    start = time.perf_counter()
+    results = asyncio.run(p1_asyncio_client.get_poetry_all(addresses, len(addresses), 30))
+    done = [start + r.latency if r.error is None else None for r in results]
+    return start, [len(r.poem) for r in results], done
+
+
+def run_twisted(addresses):
+    import p4_2_twisted_client
+    from twisted.internet import reactor
+
+    class TimedPoetrySocket(p4_2_twisted_client.PoetrySocket):
+        closed_at = None
+
+        def connectionLost(self, reason):
+            self.closed_at = time.perf_counter()
+            super().connectionLost(reason)
+
+    start = time.perf_counter()
+    sockets = [TimedPoetrySocket(i, address) for i, address in enumerate(addresses, start=1)]
+    reactor.run()
+    return start, [len(s.poem) for s in sockets], [None if s.error else s.closed_at for s in sockets]
+
+
+def run_client(kind, addresses):
+    from p1_selector_loop import raise_fd_limit
+    raise_fd_limit(len(addresses) + 64)
+    runners = {
+        'blocking': lambda: run_blocking(addresses),
+        'async': lambda: run_select('p1_async_client', addresses),
+        'selector': lambda: run_select('p1_selector_client', addresses),
+        'asyncio': lambda: run_asyncio(addresses),
+        'twisted': lambda: run_twisted(addresses),
+    }
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        start, sizes, done = runners[kind]()
+    elapsed = max(t for t in done if t is not None) - start if any(done) else 0
+    latencies = sorted(t - start for t in done if t is not None)
+    print(json.dumps({'sizes': sizes, 'latencies': latencies, 'elapsed': elapsed,
+                      'errors': sum(1 for t in done if t is None)}))
+
+
+# ---------- 父进程：启动服务器，驱动客户端 ----------
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def wait_for(port, timeout=10):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port)).close()
+            return
+        except ConnectionRefusedError:
+            time.sleep(0.05)
+    raise RuntimeError('server on port {} did not start'.format(port))
+
+
+def proc_cpu_seconds(pid):
+    with open('/proc/{}/stat'.format(pid)) as f:
+        fields = f.read().rsplit(')', 1)[1].split()
+    ticks = os.sysconf('SC_CLK_TCK')
+    return (int(fields[11]) + int(fields[12])) / float(ticks)  # utime + stime
+
+
+def proc_peak_rss_kb(pid):
+    with open('/proc/{}/status'.format(pid)) as f:
+        for line in f:
+            if line.startswith('VmHWM:'):
+                return int(line.split()[1])
+    return None
+
+
+def start_servers(kind, count, poem, downloads):
+    servers = []
+    for _ in range(count):
+        port = free_port()
+        script = SERVERS[kind]
+        cmd = [sys.executable, os.path.join(HERE, script[0]), '--port', str(port)] + script[1:]
+        if script[0] == 'p1_blocking_server.py':
+            cmd += ['--backlog', str(max(downloads, 128))]
+        cmd.append(poem)
+        proc = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        servers.append((proc, port))
+    for _, port in servers:
+        wait_for(port)
+    return servers
+
+
+def bench_client(client, servers, downloads):
+    ports = [port for _, port in servers]
+    addresses = ['127.0.0.1:{}'.format(ports[i % len(ports)]) for i in range(downloads)]
+    server_cpu = sum(proc_cpu_seconds(proc.pid) for proc, _ in servers)
+    cmd = [sys.executable, os.path.abspath(__file__), '--run-client', client]
+    proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, cwd=HERE)
+    try:
+        proc.stdin.write('\n'.join(addresses).encode('utf-8'))
+        proc.stdin.close()
+        output = proc.stdout.read()
+        _, status, rusage = os.wait4(proc.pid, 0)
+        proc.returncode = os.waitstatus_to_exitcode(status)
+    finally:
+        # 客户端失败时服务器的CPU时间也要记下来
+        server_cpu = sum(proc_cpu_seconds(proc.pid) for proc, _ in servers) - server_cpu
+    if proc.returncode != 0:
+        return {'client': client, 'failed': True, 'returncode': proc.returncode, 'server_cpu_s': server_cpu}
+    run = json.loads(output.decode('utf-8'))
+
+    latencies = run['latencies']
+    total_bytes = sum(run['sizes'])
+    elapsed = run['elapsed']
+    return {
+        'client': client,
+        'downloads': downloads,
+        'errors': run['errors'],
+        'bytes': total_bytes,
+        'elapsed_s': elapsed,
+        'throughput_bytes_per_s': total_bytes / elapsed if elapsed else None,
+        'latency_s': {'p50': percentile(latencies, 50),
+                      'p95': percentile(latencies, 95),
+                      'p99': percentile(latencies, 99)},
+        'client_cpu_s': rusage.ru_utime + rusage.ru_stime,
+        'client_peak_rss_kb': rusage.ru_maxrss,
+        'server_cpu_s': server_cpu,
+    }
+
+
+def format_row(server, r):
+    if r.get('failed'):
+        return '{:>9} {:>9}  failed (exit status {}, srv cpu {:.2f})'.format(
+            server, r['client'], r['returncode'], r['server_cpu_s'])
+    ms = dict((k, v * 1000 if v is not None else float('nan')) for k, v in r['latency_s'].items())
+    return '{:>9} {:>9} {:>10.1f} {:>8.1f} {:>8.1f} {:>8.1f} {:>8.2f} {:>8.2f} {:>9}'.format(
+        server, r['client'], (r['throughput_bytes_per_s'] or 0) / 1024,
+        ms['p50'], ms['p95'], ms['p99'], r['client_cpu_s'], r['server_cpu_s'], r['client_peak_rss_kb'])
+
+
+def main():
+    options = parse_args()
+    if options.run_client:
+        run_client(options.run_client, [parse_address(a) for a in sys.stdin.read().split()])
+        return
+
+    results = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'servers_per_kind': options.servers,
+        'downloads': options.downloads,
+        'poem': os.path.basename(options.poem),
+        'runs': [],
+    }
+    print('{:>9} {:>9} {:>10} {:>8} {:>8} {:>8} {:>8} {:>8} {:>9}'.format(
+        'server', 'client', 'KB/s', 'p50 ms', 'p95 ms', 'p99 ms', 'cli cpu', 'srv cpu', 'rss KB'))
+    for kind in options.server_kinds.split(','):
+        servers = start_servers(kind, options.servers, options.poem, options.downloads)
+        try:
+            for client in options.clients.split(','):
+                r = bench_client(client, servers, options.downloads)
+                print(format_row(kind, r))
+                r['server'] = kind
+                results['runs'].append(r)
+        finally:
+            for proc, _ in servers:
+                results.setdefault('server_peak_rss_kb', {}).setdefault(kind, []).append(proc_peak_rss_kb(proc.pid))
+                proc.kill()
+                proc.wait()
+
+    with open(options.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print('Results written to {}'.format(options.output))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,249 @@
+# -*- coding:utf-8 -*-
+"""用mmap保存诗歌的PoemStore
+
+PoetryFactory原来在启动时把一首诗读成bytes。PoemStore可以管理一整个目录(比如poetry/)的诗：
+
+1.每首诗用mmap映射到内存，映射的是内核的页缓存，所有连接、甚至多个进程共享同一份物理页，
+连接再多，服务器的内存占用也不会增加；热门的诗一直在页缓存中，发送时不需要任何read调用。
+
+2.get()最多每check_interval秒os.stat一次文件，mtime、大小或inode变化时重新映射，修改诗歌不需要重启服务器。
+旧的映射还在被连接使用时不会被关闭，等最后一个引用消失后由垃圾回收释放。
+
+3.映射过的诗保存在一个LRU缓存中，max_bytes限制所有映射的总字节数，超出时先淘汰最久没有用过的诗，
+hits/misses记录命中与未命中(需要重新映射)的次数。这样一个服务器可以面对很大的诗歌库，内存占用却是可预期的。
+
+4.Poem.compressed是这首诗的zlib压缩副本，第一次用到时压缩一次，之后所有连接直接发送这份bytes；
+文件变化后PoemStore映射出新的Poem，压缩副本也就跟着更新了。压缩副本也占内存，同样计入cached_bytes，
+受max_bytes的限制。
+
+诗名是文件名去掉扩展名。几个文件的诗名相同时(比如ode.txt和ode.md)，谁也不能独占这个诗名，
+这几个文件都改用完整的文件名作为诗名；完整的文件名也相同(不同目录中的同名文件)时抛出ValueError。
+
+注意：修改诗歌时应该写一个新文件再rename覆盖旧文件。如果原地截短一个正在被映射的文件，访问超出文件末尾的页会收到SIGBUS。
+
+>>> import os, tempfile, zlib
+>>> d = tempfile.mkdtemp()
+>>> with open(os.path.join(d, 'ode.txt'), 'wb') as f:
+...     _ = f.write(b'Thou still unravish\\'d bride of quietness')
+>>> store = PoemStore(d, check_interval=0)
+>>> store.names()
+['ode']
+>>> poem = store.get('ode')
+>>> len(poem), bytes(poem.data[:5])
+(40, b'Thou ')
+>>> store.get('ode') is poem
+True
+>>> with open(os.path.join(d, 'ode.new'), 'wb') as f:
+...     _ = f.write(b'Thou foster-child of silence and slow time')
+>>> os.replace(os.path.join(d, 'ode.new'), os.path.join(d, 'ode.txt'))
+>>> len(store.get('ode')), store.maps
+(42, 2)
+>>> zlib.decompress(store.get('ode').compressed)
+b'Thou foster-child of silence and slow time'
+>>> store.get('sonnet')
+Traceback (most recent call last):
+  ...
+KeyError: 'sonnet'
+>>> store.hits, store.misses, store.cached_bytes == 42 + len(store.get('ode').compressed)
+(2, 2, True)
+>>> with open(os.path.join(d, 'ode2.txt'), 'wb') as f:
+...     _ = f.write(b'Heard melodies are sweet')
+>>> store.max_bytes = 50
+>>> len(store.get('ode2')), sorted(store.cached_names()), store.cached_bytes
+(24, ['ode2'], 24)
+>>> with open(os.path.join(d, 'ode.md'), 'wb') as f:
+...     _ = f.write(b'# Ode on a Grecian Urn')
+>>> len(store.get('ode.md')), store.names()
+(22, ['ode.md', 'ode.txt', 'ode2'])
+>>> store.get('ode')
+Traceback (most recent call last):
+  ...
+KeyError: 'ode'
+>>> PoemStore([os.path.join(d, 'ode.txt'), os.path.join(d, 'ode.md')]).names()
+['ode.md', 'ode.txt']
+>>> PoemStore(['a/ode.txt', 'b/ode.txt'])
+Traceback (most recent call last):
+  ...
+ValueError: duplicate poem file name: 'ode.txt'
+"""
+import collections
+import mmap
+import os
+import time
+import zlib
+
+from p1_request import version_of
+
+
+class Poem(object):
+    """一首诗。data是mmap(空文件是b'')，可以用memoryview切片而不拷贝"""
+
+    def __init__(self, name, path, on_compress=None):
+        """on_compress(poem)在压缩副本生成后调用，PoemStore用它把压缩副本计入缓存大小"""
+        self.name = name
+        self.on_compress = on_compress
+        self.path = path
+        with open(path, 'rb') as f:
+            st = os.fstat(f.fileno())
+            if st.st_size:
+                self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                self.data = b''
+        self.signature = (st.st_mtime_ns, st.st_size, st.st_ino)
+        self.version = version_of(st)  # 断点续传时用来判断文件有没有变
+        self.checked = time.monotonic()
+        self._compressed = None
+
+    def __len__(self):
+        return len(self.data)
+
+    @property
+    def nbytes(self):
+        """这首诗占用的内存：映射加上压缩副本"""
+        return len(self.data) + len(self._compressed or b'')
+
+    @property
+    def mapped(self):
+        return isinstance(self.data, mmap.mmap)
+
+    @property
+    def compressed(self):
+        if self._compressed is None:
+            self._compressed = zlib.compress(self.data, 9)
+            if self.on_compress is not None:
+                self.on_compress(self)
+        return self._compressed
+
+
+def poem_name(path):
+    return os.path.splitext(os.path.basename(path))[0]
+
+
+def build_index(paths):
+    """诗名 -> 路径；诗名相同的文件改用完整的文件名，完整的文件名也相同时抛出ValueError"""
+    groups = collections.defaultdict(list)
+    for path in paths:
+        groups[poem_name(path)].append(path)
+    index = {}
+
+    def add(name, path):
+        if name in index:
+            raise ValueError('duplicate poem file name: {!r}'.format(name))
+        index[name] = path
+
+    # 先放改用完整文件名的诗，比如ode.txt和ode.md，再放其它的诗；ode.txt.bak的诗名ode.txt已经被占用时也用完整的文件名
+    for group in groups.values():
+        if len(group) > 1:
+            for path in group:
+                add(os.path.basename(path), path)
+    for name, group in groups.items():
+        if len(group) == 1:
+            add(name if name not in index else os.path.basename(group[0]), group[0])
+    return index
+
+
+class PoemStore(object):
+
+    def __init__(self, source, check_interval=1.0, max_bytes=None):
+        """source可以是一个目录，也可以是一组诗歌文件的路径；max_bytes为None表示不限制缓存大小"""
+        self.check_interval = check_interval
+        self.max_bytes = max_bytes
+        self._poems = collections.OrderedDict()  # 按最近使用的顺序排列，最久没用的在前面
+        self.cached_bytes = 0
+        self.maps = 0
+        self.hits = 0
+        self.misses = 0
+        if isinstance(source, str) and os.path.isdir(source):
+            self.directory = source
+            self._dir_mtime = None
+            self._index = {}
+            self._scan()
+        else:
+            paths = [source] if isinstance(source, str) else list(source)
+            self.directory = None
+            self._index = build_index(paths)
+        self._index_checked = time.monotonic()
+
+    def _scan(self):
+        mtime = os.stat(self.directory).st_mtime_ns
+        if mtime == self._dir_mtime:
+            return
+        self._dir_mtime = mtime
+        self._index = build_index(entry.path for entry in os.scandir(self.directory)
+                                  if entry.is_file() and not entry.name.startswith('.'))
+
+    def names(self):
+        return sorted(self._index)
+
+    def _expired(self, checked, now):
+        return now - checked >= self.check_interval
+
+    def cached_names(self):
+        return list(self._poems)
+
+    def _discard(self, name):
+        poem = self._poems.pop(name, None)
+        if poem is not None:
+            self.cached_bytes -= poem.nbytes
+
+    def _count_compressed(self, poem):
+        if self._poems.get(poem.name) is poem:  # 已经被淘汰的诗不再计入
+            self.cached_bytes += len(poem.compressed)
+            self._evict()
+
+    def _add(self, poem):
+        self._discard(poem.name)
+        self._poems[poem.name] = poem
+        self.cached_bytes += poem.nbytes
+        self._evict()
+
+    def _evict(self):
+        # 只淘汰映射的引用，正在发送这首诗的连接还持有memoryview，发送完后映射才会被释放
+        while self.max_bytes is not None and self.cached_bytes > self.max_bytes and len(self._poems) > 1:
+            self._discard(next(iter(self._poems)))
+
+    def get(self, name):
+        now = time.monotonic()
+        if self.directory is not None and self._expired(self._index_checked, now):
+            self._index_checked = now
+            self._scan()
+        path = self._index.get(name)
+        if path is None:
+            self._discard(name)
+            raise KeyError(name)
+
+        poem = self._poems.get(name)
+        if poem is not None and poem.path == path:
+            if not self._expired(poem.checked, now):
+                self.hits += 1
+                self._poems.move_to_end(name)
+                return poem
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                self._discard(name)
+                raise KeyError(name)
+            poem.checked = now
+            if (st.st_mtime_ns, st.st_size, st.st_ino) == poem.signature:
+                self.hits += 1
+                self._poems.move_to_end(name)
+                return poem
+        self.misses += 1
+        try:
+            poem = Poem(name, path, self._count_compressed)
+        except FileNotFoundError:
+            self._discard(name)
+            raise KeyError(name)
+        self.maps += 1
+        self._add(poem)
+        return poem
+
+    def stats(self):
+        return 'poems cached: {} ({} bytes), hits: {}, misses: {}'.format(
+            len(self._poems), self.cached_bytes, self.hits, self.misses)
+
+
+if __name__ == '__main__':
+    import doctest
+
+    doctest.testmod()